@@ -3,6 +3,7 @@ GUI for chiptune extender
 The basic structure for this is using Israel Dryer's Media player code, which is an open sourse project
 https://github.com/israel-dryer/Media-Player
 """
+import numpy as np
 import vlc
 import pafy
 import PySimpleGUI as sg
@@ -10,7 +11,7 @@ from sys import platform as PLATFORM
 from os import listdir
 import sys
 sys.path.insert(0, '..')
-from modules import mcc_parser, mcc_markov, mcc_waves, mcc_builder
+from modules import mcc_parser, mcc_markov, mcc_waves, mcc_builder, mcc_render
 
 PATH = './Assets/'
 BUTTON_DICT = {img[:-4].upper(): PATH + img for img in listdir(PATH)}
@@ -257,27 +258,23 @@ class MediaPlayer:
         else:
             # creating new filename for the result .wav file
             new_filename = track.split("/")[-1].replace(".mid", "")
-            mid = mcc_parser.open_midi(track)
-            # Extract attributes such as tempo and time signature from header track.
-            info = mcc_parser.extract_midi_info(mid.tracks[0])
-            tracks = mcc_parser.extract_midi_tracks(mid.tracks)
+            # Parse the tracks' notes and attributes such as tempo and time signature from the header track.
+            # Converting the same file again loads them from the parse cache.
+            song = mcc_parser.PARSE_CACHE.parse(track)
 
-            out = []
-
-            for track in tracks:
-                track = mcc_parser.midi_to_rtttl(track, mid.ticks_per_beat)
+            generated = []
 
+            for track in song["tracks"]:
                 # Train and predict.
                 mm = mcc_markov.KMarkov(3)
                 mm.fit(track)
-                gen = mm.predict(100)
-
-                # Join the original notes with the generated notes.
-                full = mcc_builder.join(track, ",", gen)
-                
-                # Render the notes as a waveform.
-                res = mcc_waves.notes_to_waveform(full, bpm=info["tempo"][0], wave_function=mcc_waves.triangle_wave)
-                out.append(res)
+                generated.append(mm.predict(100))
+
+            # Play the generated notes after the original song, which is rendered from its timelines so its tracks stay in sync.
+            timelines = mcc_parser.extend_timelines(song["timelines"], generated, song["ticks_per_beat"])
+
+            # Render the tracks as waveforms on separate threads, following the song's tempo changes.
+            out = mcc_render.render_parallel(timelines, song["tempo_map"], wave_function=mcc_waves.triangle_wave, sr=sr, mix=False)
 
             done = mcc_builder.combine_tracks(out)
             mcc_builder.export_to_wav(done, sr, new_filename)
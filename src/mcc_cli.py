@@ -0,0 +1,202 @@
+# mcc_cli.py
+# Headless batch version of the GUI's "extend a MIDI file" action.
+# - Every MIDI file given (or found in the directories given) goes through
+# 	parse -> fit -> predict -> render -> export, the same steps as
+# 	MediaPlayer.convert_midi_to_wav in interface/gui.py.
+# - Each stage runs on its own thread(s) and hands its results to the next through
+# 	a bounded queue, so a file can be rendered while the next is parsed, and a slow
+# 	stage holds the others back instead of piling up songs in memory.
+# - Per-stage timings are printed at the end.
+#
+# Run from the /src directory:
+# 	python mcc_cli.py data/ --order 3 --length 100 --seed 0 --wave triangle --workers 4
+
+import argparse
+import os
+import queue
+import sys
+import threading
+import time
+import numpy as np
+from modules import mcc_parser, mcc_markov, mcc_waves, mcc_builder, mcc_corpus
+
+# Marks the end of a stage's input.
+_DONE = object()
+
+
+class Stage:
+	def __init__(self, name:str, fn, workers:int=1):
+		"""
+		One step of the pipeline: `fn` turns an item from the previous stage into an item for
+		the next one, on `workers` threads. Time spent in `fn` is added up per stage.
+		"""
+		self.name = name
+		self.fn = fn
+		self.workers = workers
+		self.items = 0
+		self.busy = 0.0
+		self._lock = threading.Lock()
+
+
+	def run(self, inbox:queue.Queue, outbox:queue.Queue, errors:list):
+		"""
+		Start the stage's threads, taking items from inbox until _DONE and putting results
+		in outbox, then _DONE once every thread is finished. Items that fail are reported
+		to `errors` as (path, stage, exception) and dropped. Returns the threads.
+		"""
+		left = [self.workers]
+
+		def work():
+			while True:
+				item = inbox.get()
+				if item is _DONE:
+					# Put it back for the stage's other threads.
+					inbox.put(_DONE)
+					break
+				t0 = time.perf_counter()
+				try:
+					result = self.fn(item)
+				except Exception as e:
+					errors.append((item[0], self.name, e))
+					result = None
+				with self._lock:
+					self.busy += time.perf_counter() - t0
+					self.items += 1
+				if result is not None:
+					outbox.put(result)
+			with self._lock:
+				left[0] -= 1
+				last = left[0] == 0
+			if last:
+				outbox.put(_DONE)
+
+		threads = [threading.Thread(target=work, name=f"mcc-{self.name}-{i}", daemon=True) for i in range(self.workers)]
+		for thread in threads:
+			thread.start()
+		return threads
+
+
+def midi_paths(inputs:list) -> list:
+	"""
+	The MIDI files among `inputs`, with directories replaced by the MIDI files in them, sorted by name.
+	"""
+	paths = []
+	for path in inputs:
+		if os.path.isdir(path):
+			paths += mcc_corpus.corpus_files(path)
+		else:
+			paths.append(path)
+	return paths
+
+
+def build_stages(args) -> list:
+	"""
+	The stages of the pipeline for the parsed command line. Items are tuples starting with the file's path.
+	"""
+	wave_function = mcc_waves.WAVES[args.wave]
+	cache = None if args.no_cache else mcc_parser.ParseCache(args.cache_dir or os.path.join(args.out_dir, ".midi_cache"))
+
+	def parse(item):
+		path, = item
+		song = mcc_parser.parse_midi(path) if cache is None else cache.parse(path)
+		return path, song
+
+	def fit(item):
+		path, song = item
+		return path, song, mcc_markov.fit_tracks(song["tracks"], args.order, args.backoff)
+
+	def predict(item):
+		path, song, models = item
+		generated = []
+		for i, model in enumerate(models):
+			seed = None if args.seed is None else args.seed + i
+			generated.append(None if model is None else model.predict(args.length, seed=seed))
+		return path, song, generated
+
+	def render(item):
+		path, song, generated = item
+		# The song from its timelines, so its tracks stay in sync, with the generated notes played after it.
+		timelines = mcc_parser.extend_timelines(song["timelines"], generated, song["ticks_per_beat"])
+		waves = mcc_waves.timeline_to_waveform(timelines, song["tempo_map"], wave_function=wave_function, sr=args.sr, mix=False)
+		return path, mcc_builder.combine_tracks(waves, normalize=True) if len(waves) > 0 else np.zeros(0)
+
+	def export(item):
+		path, waveform = item
+		name = os.path.splitext(os.path.basename(path))[0] + args.suffix + ".wav"
+		# Written with a WavWriter rather than export_to_wav() so the pcm16 dither follows --seed too.
+		with mcc_builder.WavWriter(os.path.join(args.out_dir, name), args.sr, fmt=args.format, seed=args.seed) as wav:
+			wav.write(waveform)
+		return None
+
+	return [Stage("parse", parse), Stage("fit", fit), Stage("predict", predict),
+		Stage("render", render, workers=args.workers), Stage("export", export)]
+
+
+def run(paths:list, stages:list, queue_size:int=4) -> tuple:
+	"""
+	Push every path through the stages, with a queue of at most queue_size items between
+	each pair of stages. Returns the list of (path, stage, exception) for the files that
+	failed, and the wall-clock time taken.
+	"""
+	errors = []
+	queues = [queue.Queue(maxsize=queue_size) for _ in range(len(stages) + 1)]
+	t0 = time.perf_counter()
+	threads = []
+	for stage, inbox, outbox in zip(stages, queues, queues[1:]):
+		threads += stage.run(inbox, outbox, errors)
+	for path in paths:
+		queues[0].put((path,))
+	queues[0].put(_DONE)
+	# The last stage puts nothing but _DONE.
+	while queues[-1].get() is not _DONE:
+		pass
+	for thread in threads:
+		thread.join()
+	return errors, time.perf_counter() - t0
+
+
+def report(stages:list, wall:float, files:int, errors:list, out=sys.stderr):
+	"""
+	Print how long each stage spent working, in total and per item.
+	"""
+	print(f"{'stage':<10}{'items':>8}{'busy (s)':>12}{'per item (ms)':>16}", file=out)
+	for stage in stages:
+		per_item = 1e3 * stage.busy / stage.items if stage.items > 0 else 0.0
+		print(f"{stage.name:<10}{stage.items:>8}{stage.busy:>12.2f}{per_item:>16.1f}", file=out)
+	print(f"{files} file(s) in {wall:.2f}s, {len(errors)} failed", file=out)
+	for path, stage, e in errors:
+		print(f"  {path}: {stage} failed: {e!r}", file=out)
+
+
+def main(argv:list=None) -> int:
+	parser = argparse.ArgumentParser(description="Extend MIDI files with Markov-generated notes and render them to WAV, without the GUI.")
+	parser.add_argument("inputs", nargs="+", help="MIDI files, or directories of MIDI files")
+	parser.add_argument("-o", "--out-dir", default="../out/", help="directory for the .wav files (default: ../out/)")
+	parser.add_argument("--suffix", default="", help="added to each output file name, before .wav")
+	parser.add_argument("--order", type=int, default=3, help="order k of the KMarkov model fitted to each track (default: 3)")
+	parser.add_argument("--backoff", choices=mcc_markov.KMarkov.BACKOFFS, default="reduce", help="back-off for unseen priors")
+	parser.add_argument("--length", type=int, default=100, help="number of notes to generate per track (default: 100)")
+	parser.add_argument("--seed", type=int, default=None, help="seed for generation, for repeatable output")
+	parser.add_argument("--wave", choices=sorted(mcc_waves.WAVES), default="triangle", help="waveform to render with (default: triangle)")
+	parser.add_argument("--format", choices=sorted(mcc_builder.WavWriter.FORMATS), default="float32", help="WAV sample format (default: float32)")
+	parser.add_argument("--sr", type=int, default=44100, help="sampling rate (default: 44100)")
+	parser.add_argument("--workers", type=int, default=os.cpu_count() or 1, help="render threads (default: one per CPU)")
+	parser.add_argument("--queue-size", type=int, default=4, help="most files waiting between two stages (default: 4)")
+	parser.add_argument("--cache-dir", default=None, help="directory of the parse cache (default: .midi_cache in the output directory)")
+	parser.add_argument("--no-cache", action="store_true", help="parse every file instead of using the parse cache")
+	parser.add_argument("-q", "--quiet", action="store_true", help="don't print the timings")
+	args = parser.parse_args(argv)
+	if args.order < 1 or args.length < 0 or args.workers < 1 or args.queue_size < 1:
+		parser.error("--order, --workers and --queue-size must be at least 1, and --length at least 0")
+
+	paths = midi_paths(args.inputs)
+	os.makedirs(args.out_dir, exist_ok=True)
+	stages = build_stages(args)
+	errors, wall = run(paths, stages, args.queue_size)
+	if not args.quiet or errors:
+		report(stages, wall, len(paths), errors)
+	return 1 if errors else 0
+
+
+if __name__ == "__main__":
+	sys.exit(main())
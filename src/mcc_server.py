@@ -0,0 +1,476 @@
+# mcc_server.py
+# Local HTTP service that extends MIDI files with Markov-generated notes and streams them back as WAV.
+# - Built on asyncio alone (no web framework), so it runs anywhere the rest of /src does.
+# - Parsed songs and their fitted KMarkov models are kept warm in a ModelPool, and the
+# 	note cache (mcc_waves.NOTE_CACHE) lives as long as the server, so repeat requests
+# 	neither reparse nor retrain and reuse the notes already rendered.
+# - Concurrent requests for the same song and settings are batched: their notes are
+# 	generated together with KMarkov.predict_batch().
+# - Parsing, fitting, generating and rendering run in a thread pool, off the event loop.
+# 	The WAV is rendered and sent a block at a time, so the first bytes go out long
+# 	before the song is finished.
+# - GET /metrics reports latency, throughput, batching and cache figures as JSON.
+#
+# Run from the /src directory:
+# 	python mcc_server.py --port 8765
+# then e.g.
+# 	curl -o out.wav "http://127.0.0.1:8765/generate?song=zeldaund.mid&length=100&seed=0"
+
+import argparse
+import asyncio
+import io
+import json
+import os
+import sys
+import threading
+import time
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlsplit, parse_qs
+import numpy as np
+from modules import mcc_parser, mcc_markov, mcc_waves, mcc_builder
+
+REASONS = {200: "OK", 400: "Bad Request", 404: "Not Found", 405: "Method Not Allowed", 500: "Internal Server Error"}
+
+
+class HTTPError(Exception):
+	def __init__(self, status:int, message:str):
+		super().__init__(message)
+		self.status = status
+
+
+class WarmSong:
+	def __init__(self, song:dict, order:int, backoff:str):
+		"""
+		A parsed song (see mcc_parser.parse_midi) with one KMarkov of the given order fitted to each
+		of its tracks, or None for tracks too short to fit. Generating from the models is done
+		under a lock, as their tables are built lazily on first use.
+		"""
+		self.song = song
+		self.models = mcc_markov.fit_tracks(song["tracks"], order, backoff)
+		self.lock = threading.Lock()
+
+
+	def generate(self, n:int, length:int, seed=None) -> list:
+		"""
+		Extend every track with `length` generated notes, n times over. Returns n lists of tracks.
+		Each track is continued from its own last notes. Without a seed, the n extensions are
+		independent and drawn with predict_batch(), which only steps them together with NumPy
+		for batches large enough to gain from it (KMarkov.MIN_BATCH) and otherwise samples them
+		one by one; with a seed, they are all the same one from predict() (seed + i for track i),
+		so a request gets the same notes whatever it is batched with.
+		"""
+		out = [[] for _ in range(n)]
+		with self.lock:
+			for i, (track, model) in enumerate(zip(self.song["tracks"], self.models)):
+				if model is None or length == 0:
+					rows = [track[:0]] * n
+				elif seed is None:
+					rows = model.predict_batch(n, length, priors=track, decode=True)
+				else:
+					# predict() returns the k priors it started from before the new notes.
+					rows = [model.predict(length, priors=track, seed=None if seed is None else seed + i)[model.k:]] * n
+				for j in range(n):
+					out[j].append(np.concatenate((track, rows[j])))
+		return out
+
+
+class ModelPool:
+	def __init__(self, executor, max_songs:int=32, cache:mcc_parser.ParseCache=mcc_parser.PARSE_CACHE):
+		"""
+		Up to max_songs WarmSongs, least recently used first out. Songs are keyed by path,
+		modification time, order and back-off, so an edited file is parsed and fitted again.
+		Songs are loaded in `executor`, and requests for a song that is still loading wait
+		for that load instead of starting their own. Loads of one file with different orders
+		or back-offs likewise share a single parse.
+		"""
+		self.executor = executor
+		self.max_songs = max_songs
+		self.cache = cache
+		self._songs = OrderedDict()
+		self._loading = {}
+		self._parsing = {}
+		self.hits = 0
+		self.misses = 0
+
+
+	def __len__(self) -> int:
+		return len(self._songs)
+
+
+	def _parse(self, path:str) -> dict:
+		return mcc_parser.parse_midi(path) if self.cache is None else self.cache.parse(path)
+
+
+	async def _load(self, path:str, mtime:int, order:int, backoff:str) -> WarmSong:
+		loop = asyncio.get_running_loop()
+		key = (path, mtime)
+		if key not in self._parsing:
+			self._parsing[key] = loop.run_in_executor(self.executor, self._parse, path)
+		future = self._parsing[key]
+		try:
+			song = await asyncio.shield(future)
+		finally:
+			if future.done():
+				self._parsing.pop(key, None)
+		return await loop.run_in_executor(self.executor, WarmSong, song, order, backoff)
+
+
+	async def get(self, path:str, order:int, backoff:str) -> WarmSong:
+		key = (path, os.stat(path).st_mtime_ns, order, backoff)
+		if key in self._songs:
+			self.hits += 1
+			self._songs.move_to_end(key)
+			return self._songs[key]
+		self.misses += 1
+		if key not in self._loading:
+			self._loading[key] = asyncio.ensure_future(self._load(*key))
+		future = self._loading[key]
+		try:
+			warm = await asyncio.shield(future)
+		finally:
+			if future.done():
+				self._loading.pop(key, None)
+		self._songs[key] = warm
+		while len(self._songs) > self.max_songs:
+			self._songs.popitem(last=False)
+		return warm
+
+
+class Batcher:
+	def __init__(self, executor, window:float=0.01, max_batch:int=16):
+		"""
+		Collects generation requests that want the same song with the same length and seed,
+		for up to `window` seconds or max_batch requests, and generates notes for all of them
+		with one WarmSong.generate() call in `executor`.
+		"""
+		self.executor = executor
+		self.window = window
+		self.max_batch = max_batch
+		self._pending = {}
+		self.batches = deque(maxlen=1024)
+
+
+	async def generate(self, warm:WarmSong, length:int, seed=None) -> list:
+		"""
+		The extended tracks for one request, once its batch is generated.
+		"""
+		loop = asyncio.get_running_loop()
+		key = (warm, length, seed)
+		if key not in self._pending:
+			self._pending[key] = []
+			loop.call_later(self.window, self._flush, key, warm)
+		batch = self._pending[key]
+		future = loop.create_future()
+		batch.append(future)
+		if len(batch) >= self.max_batch:
+			self._flush(key, warm)
+		return await future
+
+
+	def _flush(self, key:tuple, warm:WarmSong):
+		# The timer of a batch that was already flushed for being full finds another batch, or none.
+		batch = self._pending.pop(key, None)
+		if not batch:
+			return
+		self.batches.append(len(batch))
+		loop = asyncio.get_running_loop()
+		_, length, seed = key
+		done = loop.run_in_executor(self.executor, warm.generate, len(batch), length, seed)
+
+		def deliver(done):
+			for j, future in enumerate(batch):
+				if future.cancelled():
+					continue
+				if done.exception() is not None:
+					future.set_exception(done.exception())
+				else:
+					future.set_result(done.result()[j])
+		done.add_done_callback(deliver)
+
+
+class Metrics:
+	def __init__(self, window:int=1024):
+		"""
+		Counters since the server started, and latencies of the last `window` requests to /generate.
+		"""
+		self.started = time.time()
+		self.requests = 0
+		self.errors = 0
+		self.in_flight = 0
+		self.completed = 0
+		self.bytes_sent = 0
+		self.audio_seconds = 0.0
+		self.first_byte = deque(maxlen=window)
+		self.total = deque(maxlen=window)
+		self.finished = deque(maxlen=window)
+
+
+	def record(self, first_byte:float, total:float, audio_seconds:float):
+		self.completed += 1
+		self.audio_seconds += audio_seconds
+		self.first_byte.append(first_byte)
+		self.total.append(total)
+		self.finished.append(time.time())
+
+
+	def snapshot(self, pool:ModelPool, batcher:Batcher) -> dict:
+		"""
+		Everything as a dict ready for json.dumps(). Latencies are in milliseconds. Throughput is
+		over the whole uptime, and over the last minute of finished requests.
+		"""
+		def percentiles(values):
+			if len(values) == 0:
+				return None
+			p = np.percentile(np.array(values) * 1e3, [50, 95, 99])
+			return {"p50": round(p[0], 2), "p95": round(p[1], 2), "p99": round(p[2], 2), "max": round(max(values) * 1e3, 2)}
+
+		now = time.time()
+		uptime = now - self.started
+		recent = sum(1 for t in self.finished if now - t <= 60.0)
+		return {
+			"uptime_s": round(uptime, 2),
+			"requests": self.requests,
+			"completed": self.completed,
+			"errors": self.errors,
+			"in_flight": self.in_flight,
+			"latency_first_byte_ms": percentiles(self.first_byte),
+			"latency_total_ms": percentiles(self.total),
+			"throughput": {
+				"requests_per_s": round(self.completed / uptime, 3) if uptime > 0 else 0.0,
+				"requests_per_s_last_minute": round(recent / min(60.0, uptime), 3) if uptime > 0 else 0.0,
+				"audio_seconds_per_s": round(self.audio_seconds / uptime, 3) if uptime > 0 else 0.0,
+				"bytes_sent": self.bytes_sent,
+			},
+			"batches": {"count": len(batcher.batches), "mean_size": round(float(np.mean(batcher.batches)), 2) if batcher.batches else None},
+			"models": {"warm": len(pool), "hits": pool.hits, "misses": pool.misses},
+			"note_cache": mcc_waves.NOTE_CACHE.stats(),
+		}
+
+
+class Server:
+	def __init__(self, data_dir:str="./data", workers:int=None, max_songs:int=32, batch_window:float=0.01,
+			max_batch:int=16, block_size:int=2**15, sr:int=44100):
+		"""
+		The generation service. Songs are the MIDI files in data_dir, named by file name.
+		Work is done on a pool of `workers` threads (default: one per CPU). Songs are
+		streamed in blocks of block_size samples.
+
+		Endpoints (all GET):
+			/generate?song=NAME[&order=3&backoff=reduce&length=100&seed=&wave=triangle&format=pcm16]
+				The song with every track extended by `length` generated notes, as a WAV file.
+			/songs		The songs that can be generated from, as a JSON list.
+			/metrics	Latency, throughput, batching and cache figures, as JSON.
+			/health		"ok".
+
+		>>> server = Server("./data")
+		>>> asyncio.run(server.serve("127.0.0.1", 8765))
+		"""
+		self.data_dir = data_dir
+		self.block_size = block_size
+		self.sr = sr
+		self.executor = ThreadPoolExecutor(max_workers=workers or os.cpu_count() or 1, thread_name_prefix="mcc-server")
+		self.pool = ModelPool(self.executor, max_songs)
+		self.batcher = Batcher(self.executor, batch_window, max_batch)
+		self.metrics = Metrics()
+		self._server = None
+
+
+	async def start(self, host:str="127.0.0.1", port:int=0) -> int:
+		"""
+		Start listening, and return the port listened on (useful with port=0, to let the OS pick one).
+		"""
+		self._server = await asyncio.start_server(self._handle, host, port)
+		return self._server.sockets[0].getsockname()[1]
+
+
+	async def serve(self, host:str="127.0.0.1", port:int=8765):
+		"""
+		Start listening and serve until cancelled.
+		"""
+		port = await self.start(host, port)
+		print(f"MCC server on http://{host}:{port}/", file=sys.stderr)
+		async with self._server:
+			await self._server.serve_forever()
+
+
+	async def close(self):
+		if self._server is not None:
+			self._server.close()
+			await self._server.wait_closed()
+		self.executor.shutdown(wait=False)
+
+
+	def songs(self) -> list:
+		return [f for f in sorted(os.listdir(self.data_dir)) if f.lower().endswith((".mid", ".midi"))]
+
+
+	async def _handle(self, reader:asyncio.StreamReader, writer:asyncio.StreamWriter):
+		"""
+		Serve one request per connection: read the request line and headers, route, respond, close.
+		"""
+		try:
+			request = await reader.readline()
+			while (await reader.readline()) not in (b"\r\n", b"\n", b""):
+				pass
+			parts = request.decode("latin-1").split()
+			if len(parts) != 3:
+				return await self._respond(writer, 400, {"error": "malformed request line"})
+			method, target, _ = parts
+			url = urlsplit(target)
+			if method != "GET":
+				return await self._respond(writer, 405, {"error": f"{method} not allowed"})
+			if url.path == "/generate":
+				return await self._generate(writer, parse_qs(url.query))
+			if url.path == "/songs":
+				return await self._respond(writer, 200, self.songs())
+			if url.path == "/metrics":
+				return await self._respond(writer, 200, self.metrics.snapshot(self.pool, self.batcher))
+			if url.path == "/health":
+				return await self._respond(writer, 200, "ok")
+			await self._respond(writer, 404, {"error": f"no such endpoint {url.path}"})
+		except (ConnectionError, asyncio.IncompleteReadError):
+			pass
+		finally:
+			writer.close()
+
+
+	async def _respond(self, writer:asyncio.StreamWriter, status:int, body):
+		data = (body if isinstance(body, str) else json.dumps(body)).encode()
+		kind = "text/plain" if isinstance(body, str) else "application/json"
+		writer.write(self._head(status, kind, len(data)) + data)
+		await writer.drain()
+
+
+	def _head(self, status:int, kind:str, length:int) -> bytes:
+		return (f"HTTP/1.1 {status} {REASONS[status]}\r\nContent-Type: {kind}\r\n"
+			f"Content-Length: {length}\r\nConnection: close\r\n\r\n").encode()
+
+
+	def _params(self, query:dict) -> dict:
+		"""
+		The /generate query as typed params, checked. Raises HTTPError for bad ones.
+		"""
+		def get(name, default=None, kind=str):
+			value = query.get(name, [None])[-1]
+			if value is None or value == "":
+				return default
+			try:
+				return kind(value)
+			except ValueError:
+				raise HTTPError(400, f"{name} must be of type {kind.__name__}")
+
+		params = {"song": get("song"), "order": get("order", 3, int), "backoff": get("backoff", "reduce"),
+			"length": get("length", 100, int), "seed": get("seed", None, int), "wave": get("wave", "triangle"),
+			"format": get("format", "pcm16")}
+		if params["song"] is None:
+			raise HTTPError(400, "song is required")
+		# Only file names in data_dir, never paths.
+		if params["song"] != os.path.basename(params["song"]) or params["song"] not in self.songs():
+			raise HTTPError(404, f"no song {params['song']}")
+		if params["order"] < 1 or params["length"] < 0:
+			raise HTTPError(400, "order must be at least 1 and length at least 0")
+		if params["backoff"] not in mcc_markov.KMarkov.BACKOFFS:
+			raise HTTPError(400, f"backoff must be one of {mcc_markov.KMarkov.BACKOFFS}")
+		if params["wave"] not in mcc_waves.WAVES:
+			raise HTTPError(400, f"wave must be one of {sorted(mcc_waves.WAVES)}")
+		if params["format"] not in mcc_builder.WavWriter.FORMATS:
+			raise HTTPError(400, f"format must be one of {sorted(mcc_builder.WavWriter.FORMATS)}")
+		return params
+
+
+	async def _generate(self, writer:asyncio.StreamWriter, query:dict):
+		"""
+		Get the song's models from the pool, have the batcher generate its notes, and stream the WAV.
+		"""
+		self.metrics.requests += 1
+		self.metrics.in_flight += 1
+		t0 = time.perf_counter()
+		started = False
+		chunks = None
+		try:
+			params = self._params(query)
+			warm = await self.pool.get(os.path.join(self.data_dir, params["song"]), params["order"], params["backoff"])
+			tracks = await self.batcher.generate(warm, params["length"], params["seed"])
+
+			loop = asyncio.get_running_loop()
+			frames, size, chunks = await loop.run_in_executor(self.executor, self._open_stream, warm.song, tracks, params)
+			writer.write(self._head(200, "audio/wav", size))
+			started = True
+			first_byte = None
+			while True:
+				chunk = await loop.run_in_executor(self.executor, next, chunks, None)
+				if chunk is None:
+					break
+				writer.write(chunk)
+				self.metrics.bytes_sent += len(chunk)
+				await writer.drain()
+				if first_byte is None:
+					first_byte = time.perf_counter() - t0
+			self.metrics.record(first_byte or time.perf_counter() - t0, time.perf_counter() - t0, frames / self.sr)
+		except Exception as e:
+			self.metrics.errors += 1
+			if not started:
+				status = e.status if isinstance(e, HTTPError) else 500
+				await self._respond(writer, status, {"error": str(e) or type(e).__name__})
+			elif not isinstance(e, ConnectionError):
+				# Too late for an error status: the client gets a short file.
+				print(f"MCC: /generate failed mid-stream: {e!r}", file=sys.stderr)
+			if chunks is not None:
+				# Not running: an exception here comes from the client, or from chunks itself.
+				chunks.close()
+		finally:
+			self.metrics.in_flight -= 1
+
+
+	def _open_stream(self, song:dict, tracks:list, params:dict) -> tuple:
+		"""
+		Number of frames and of bytes of the WAV, and a generator of its bytes. The tracks are mixed
+		from mcc_waves.stream_waveform() blocks, each scaled by 1/(number of tracks) since the
+		peak of the mix isn't known until it has all been rendered.
+		"""
+		kwargs = dict(tempo_map=song["tempo_map"], sr=self.sr)
+		bpm = mcc_parser.start_bpm(song["info"])
+		frames = max((mcc_waves.waveform_length(track, bpm, **kwargs) for track in tracks), default=0)
+		streams = [mcc_waves.stream_waveform(track, bpm, wave_function=mcc_waves.WAVES[params["wave"]], block_size=self.block_size, **kwargs)
+			for track in tracks]
+		gain = 1.0 / max(1, len(tracks))
+
+		# The header is written as soon as the writer is made, which gives the size of the whole file.
+		buf = io.BytesIO()
+		wav = mcc_builder.WavWriter(buf, self.sr, fmt=params["format"], n_frames=frames, seed=params["seed"])
+		size = len(buf.getvalue()) + frames * mcc_builder.WavWriter.FORMATS[params["format"]][1]
+
+		def chunks():
+			with wav:
+				for block in mcc_builder.mix_streams(streams):
+					wav.write(block * gain)
+					yield buf.getvalue()
+					buf.seek(0)
+					buf.truncate()
+			# The header, for an empty song.
+			if buf.tell() > 0:
+				yield buf.getvalue()
+
+		return frames, size, chunks()
+
+
+def main(argv:list=None):
+	parser = argparse.ArgumentParser(description="Serve MIDI files extended with Markov-generated notes as WAV over HTTP.")
+	parser.add_argument("--host", default="127.0.0.1", help="address to listen on (default: 127.0.0.1, this machine only)")
+	parser.add_argument("--port", type=int, default=8765, help="port to listen on, 0 for any free one (default: 8765)")
+	parser.add_argument("--data-dir", default="./data", help="directory of the MIDI files to serve (default: ./data)")
+	parser.add_argument("--workers", type=int, default=None, help="threads for parsing, fitting and rendering (default: one per CPU)")
+	parser.add_argument("--max-songs", type=int, default=32, help="songs whose models are kept warm (default: 32)")
+	parser.add_argument("--batch-window", type=float, default=0.01, help="seconds to wait for requests to batch together (default: 0.01)")
+	parser.add_argument("--max-batch", type=int, default=16, help="most requests generated in one batch (default: 16)")
+	args = parser.parse_args(argv)
+	server = Server(args.data_dir, args.workers, args.max_songs, args.batch_window, args.max_batch)
+	try:
+		asyncio.run(server.serve(args.host, args.port))
+	except KeyboardInterrupt:
+		pass
+
+
+if __name__ == "__main__":
+	main()
@@ -2,24 +2,87 @@
 # Functions to build and compile list (i.e. waves) together 
 # as well as export audio files.
 
+import os
+import struct
 import numpy as np
-from scipy.io.wavfile import write
 
 
-def combine_tracks(tracks: list) -> np.array:
+def combine_tracks(tracks: list, gains: list=None, pans: list=None, dtype=np.float64, normalize: bool=False) -> np.array:
 	"""
 	Takes a list of tracks, each track in its waveform. Add them elementwise.
+
+	Each track is added in place into its slice of one preallocated output, 
+	so shorter tracks are never padded or copied.
+
+	:param: gains, optional per-track gain factors.
+	:param: pans, optional per-track pan positions in [-1.0 (left), 1.0 (right)]. 
+		If given, the output is stereo with shape (samples, 2), using constant-power panning.
+	:param: dtype, the dtype of the output, e.g. np.float32 to halve memory.
+	:param: normalize, if True, scale the mix down so its peak is at most 1.0 and will not clip on export.
 	"""
+	assert gains is None or len(gains) == len(tracks), "MCC: Need one gain per track."
+	assert pans is None or len(pans) == len(tracks), "MCC: Need one pan position per track."
+	assert pans is None or all(-1.0 <= p <= 1.0 for p in pans), "MCC: Pan positions must be in [-1.0, 1.0]."
+
 	maxlen = max(list(map(len, tracks)))
-	combined = np.zeros(maxlen)
-	for t in tracks:
-		if type(t) is list:
-			t = np.array(t)
-		t = np.pad(t, (0,maxlen-t.shape[0]))
-		combined += t
+	combined = np.zeros(maxlen if pans is None else (maxlen, 2), dtype=dtype)
+	for i, t in enumerate(tracks):
+		t = np.asarray(t)
+		gain = 1.0 if gains is None else gains[i]
+		if pans is None:
+			_add_scaled(combined[:len(t)], t, gain)
+		else:
+			angle = (pans[i] + 1) * np.pi / 4
+			_add_scaled(combined[:len(t), 0], t, gain * np.cos(angle))
+			_add_scaled(combined[:len(t), 1], t, gain * np.sin(angle))
+
+	if normalize:
+		# Peak from max and min, which avoids allocating np.abs(combined).
+		peak = max(combined.max(), -combined.min()) if combined.size > 0 else 0.0
+		if peak > 1.0:
+			combined /= peak
 	return combined
 
 
+def _add_scaled(out: np.array, t: np.array, gain: float, chunk: int=2**16):
+	"""
+	Do out += gain*t in place. Scaled tracks are added a chunk at a time 
+	so only a small temporary is needed instead of a full scaled copy.
+	"""
+	if gain == 1.0:
+		out += t
+		return
+	tmp = np.empty(min(chunk, len(t)), dtype=np.result_type(t, out))
+	for a in range(0, len(t), chunk):
+		b = min(a + chunk, len(t))
+		np.multiply(t[a:b], gain, out=tmp[:b-a])
+		out[a:b] += tmp[:b-a]
+
+
+def mix_streams(streams: list):
+	"""
+	Takes a list of track streams, e.g. from mcc_waves.stream_waveform, that all yield 
+	blocks of the same size. Yield their elementwise sum one block at a time, so no track 
+	has to be held in memory in full. Tracks that end early are treated as silence.
+	"""
+	streams = [iter(s) for s in streams]
+	while len(streams) > 0:
+		blocks = []
+		for s in list(streams):
+			block = next(s, None)
+			if block is None:
+				streams.remove(s)
+			else:
+				blocks.append(block)
+		if len(blocks) == 0:
+			return
+
+		mixed = np.zeros(max(map(len, blocks)), dtype=np.result_type(*blocks))
+		for b in blocks:
+			mixed[:len(b)] += b
+		yield mixed
+
+
 def join(*args):
 	"""
 	Do the "+" operation on a undefined number of args of the same type.
@@ -28,10 +91,139 @@ def join(*args):
 	return args[0] + join(*args[1:]) if len(args) > 1 else args[0]
 
 
-def export_to_wav(track: list, srate: int, name):
+class WavWriter:
+	# Format tag, bytes per sample and sample dtype for each supported output format.
+	FORMATS = {"pcm16": (1, 2, "<i2"), "float32": (3, 4, "<f4")}
+
+	def __init__(self, target, srate: int, channels: int=1, fmt: str="pcm16", dither: bool=True, n_frames: int=None, seed=None):
+		"""
+		Write a WAV file incrementally from blocks of samples, so a track never has 
+		to be held in memory in full.
+
+		`target` is a file path or a binary file-like object. The header is written 
+		up front with placeholder sizes and patched on close(), which needs a seekable 
+		target. For a non-seekable one such as a socket, pass `n_frames` if the length 
+		is known; otherwise the sizes are left at their maximum, which most players 
+		read as "until the end of the stream".
+
+		`fmt` is "pcm16" (16-bit integer, with TPDF dither unless `dither` is False) 
+		or "float32". Blocks are arrays of floats in [-1.0, 1.0], shaped (samples,) 
+		for mono or (samples, channels).
+
+		>>> with WavWriter("../out/song.wav", 44100) as wav:
+		... 	for block in mix_streams(streams):
+		... 		wav.write(block)
+		"""
+		assert fmt in self.FORMATS, f"MCC: Unsupported WAV format {fmt}."
+		assert channels > 0, "MCC: A WAV file needs at least one channel."
+		self.srate = srate
+		self.channels = channels
+		self.fmt = fmt
+		self.dither = dither
+		self.n_frames = n_frames
+		self.frames = 0
+		self._rng = np.random.default_rng(seed)
+
+		self._owns_file = isinstance(target, (str, bytes, os.PathLike))
+		self._file = open(target, "wb") if self._owns_file else target
+		try:
+			self._seekable = self._file.seekable()
+		except AttributeError:
+			self._seekable = False
+		self._write_header(self.n_frames)
+
+
+	def _write_header(self, n_frames: int=None):
+		"""
+		Write the RIFF header for n_frames frames, or with maximal sizes if n_frames is None.
+		"""
+		tag, width, _ = self.FORMATS[self.fmt]
+		block_align = self.channels * width
+		data_size = 0xFFFFFFFF if n_frames is None else n_frames * block_align
+		# Float data needs the extended fmt chunk (with cbSize) and a fact chunk.
+		fmt_chunk = struct.pack("<HHIIHH", tag, self.channels, self.srate, self.srate * block_align, block_align, 8 * width)
+		fact_chunk = b""
+		if tag != 1:
+			fmt_chunk += struct.pack("<H", 0)
+			fact_chunk = b"fact" + struct.pack("<II", 4, 0xFFFFFFFF if n_frames is None else n_frames)
+		riff_size = 0xFFFFFFFF if n_frames is None else 4 + 8 + len(fmt_chunk) + len(fact_chunk) + 8 + data_size
+		self._file.write(b"RIFF" + struct.pack("<I", riff_size) + b"WAVE")
+		self._file.write(b"fmt " + struct.pack("<I", len(fmt_chunk)) + fmt_chunk + fact_chunk)
+		self._file.write(b"data" + struct.pack("<I", data_size))
+
+
+	def write(self, block: np.array):
+		"""
+		Append a block of samples to the file.
+		"""
+		block = np.asarray(block)
+		if block.ndim == 1:
+			block = block[:, None]
+		assert block.shape[1] == self.channels, f"MCC: Expected {self.channels} channel(s), got {block.shape[1]}."
+
+		if self.fmt == "pcm16":
+			scaled = block * 32767.0
+			if self.dither:
+				# TPDF dither: the difference of two uniform randoms, +/- 1 LSB.
+				scaled += self._rng.random(scaled.shape) - self._rng.random(scaled.shape)
+			np.rint(scaled, out=scaled)
+			np.clip(scaled, -32768, 32767, out=scaled)
+			data = scaled.astype("<i2")
+		else:
+			data = block.astype("<f4")
+		self._file.write(data.tobytes())
+		self.frames += len(block)
+
+
+	def close(self, check:bool=True):
+		"""
+		Patch the header with the final sizes, if possible, and close the file if we opened it.
+		Raises ValueError if n_frames was given and a different number of frames was written,
+		unless `check` is False, as when writing was cut short on purpose or by an error.
+		"""
+		if self._file is None:
+			return
+		try:
+			if self.n_frames is None and self._seekable:
+				self._file.seek(0)
+				self._write_header(self.frames)
+				self._file.seek(0, os.SEEK_END)
+			elif check and self.n_frames is not None and self.n_frames != self.frames:
+				raise ValueError(f"MCC: Promised {self.n_frames} frames but wrote {self.frames}.")
+		finally:
+			if self._owns_file:
+				self._file.close()
+			else:
+				self._file.flush()
+			self._file = None
+
+
+	def __enter__(self):
+		return self
+
+
+	def __exit__(self, exc_type, exc, tb):
+		# Leaving on an exception (GeneratorExit included) means the frames were never all going to be written.
+		self.close(check=exc_type is None)
+
+
+def export_stream(blocks, srate: int, target, channels: int=1, fmt: str="pcm16", dither: bool=True) -> int:
+	"""
+	Write an iterator of sample blocks, e.g. from mix_streams, to a WAV file path or 
+	file-like object without holding the whole track in memory. Returns the number of frames written.
+	"""
+	with WavWriter(target, srate, channels=channels, fmt=fmt, dither=dither) as wav:
+		for block in blocks:
+			wav.write(block)
+		return wav.frames
+
+
+def export_to_wav(track: list, srate: int, name, out_dir: str='../out/', fmt: str="float32"):
 	"""
 	Input a list of track (number list), sampling rate and the name of the file.
-	Save the input as .wav file.
+	Save the input as .wav file in out_dir, as float32 or 16-bit PCM ("pcm16").
 	"""
 	assert len(track) > 0
-	write('../out/' + name + '.wav', srate, track)
+	track = np.asarray(track)
+	channels = 1 if track.ndim == 1 else track.shape[1]
+	export_stream([track], srate, os.path.join(out_dir, name + '.wav'), channels=channels, fmt=fmt)
@@ -0,0 +1,89 @@
+# mcc_corpus.py
+# Training Markov models on whole corpora of MIDI files.
+# - Files are split into shards that are parsed and counted in a pool of
+# 	worker processes, each returning a KMarkov of its shard's counts.
+# - The shard models are merged into one KMarkov in file order.
+#
+
+import os
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from modules import mcc_parser, mcc_markov
+
+
+def corpus_files(directory:str) -> list:
+	"""
+	Paths of every MIDI file in a directory, sorted by name.
+	"""
+	return [os.path.join(directory, f) for f in sorted(os.listdir(directory)) if f.lower().endswith((".mid", ".midi"))]
+
+
+def fit_file(model:mcc_markov.KMarkov, path:str, cache:mcc_parser.ParseCache=None) -> int:
+	"""
+	Parse a MIDI file and add each of its tracks, as an array of notes (see mcc_parser.midi_to_notes), 
+	to a model with partial_fit(). Tracks too short to fit with the model's order are skipped. 
+	Returns the number of notes added.
+
+	The file is parsed with mcc_parser.parse_midi(), or through `cache` if one is given.
+	"""
+	song = mcc_parser.parse_midi(path) if cache is None else cache.parse(path)
+	added = 0
+	for notes in song["tracks"]:
+		if len(notes) > model.k:
+			model.partial_fit(notes)
+			added += len(notes)
+	return added
+
+
+def _fit_shard(paths:list, k:int, cache:mcc_parser.ParseCache=None) -> tuple:
+	"""
+	Worker: count the transitions of a shard of files. The model is returned before its
+	probabilities are built, so only the vocabulary and count arrays are sent back.
+	"""
+	model = mcc_markov.KMarkov(k)
+	added = sum(fit_file(model, path, cache) for path in paths)
+	return model, added
+
+
+def train_corpus(paths:list, k:int, backoff:str="reduce", workers:int=None, shard_size:int=8, progress=None, 
+		cache:mcc_parser.ParseCache=None) -> mcc_markov.KMarkov:
+	"""
+	Fit a KMarkov of order k to every track of every MIDI file in `paths`.
+
+	The files are split into shards of `shard_size` files, and each shard is parsed and counted
+	by one of `workers` processes (default: one per CPU). As shards finish, their models are
+	merged into the result in file order, so the result is the same as calling fit_file() on each
+	file in turn in one process, whatever the number of workers. With workers=1 no pool is started.
+
+	`progress`, if given, is called after each shard as progress(files_done, files_total, states_added).
+	With a mcc_parser.ParseCache as `cache`, files parsed by an earlier run are loaded from it instead.
+
+	>>> model = train_corpus(corpus_files("./data"), 3, workers=4, progress=print)
+	"""
+	assert shard_size > 0, "MCC: shard_size must be at least 1."
+	shards = [paths[i:i+shard_size] for i in range(0, len(paths), shard_size)]
+	model = mcc_markov.KMarkov(k, backoff=backoff)
+	files = states = 0
+
+	def reduce(i, shard_model, added):
+		nonlocal files, states
+		model.merge(shard_model)
+		files += len(shards[i])
+		states += added
+		if progress is not None:
+			progress(files, len(paths), states)
+
+	if workers == 1:
+		for i, shard in enumerate(shards):
+			reduce(i, *_fit_shard(shard, k, cache))
+		return model
+
+	with ProcessPoolExecutor(max_workers=workers) as pool:
+		futures = dict((pool.submit(_fit_shard, shard, k, cache), i) for i, shard in enumerate(shards))
+		# Shards can finish in any order. Hold the early ones back until every shard before them is merged.
+		done, merged = {}, 0
+		for future in as_completed(futures):
+			done[futures[future]] = future.result()
+			while merged in done:
+				reduce(merged, *done.pop(merged))
+				merged += 1
+	return model
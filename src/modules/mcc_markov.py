@@ -4,8 +4,12 @@
 # - SimpleMarkov is a more naive, first-order implementation.
 # - KMarkov can model higher-order processes and make predictions 
 # 	adaptively using a reduction algorithm.
+# - Both can be saved to a binary file and opened again with load_model().
 # 
 
+import json
+import struct
+from bisect import bisect_left, bisect_right
 import numpy as np
 
 
@@ -49,6 +53,7 @@ class SimpleMarkov:
 			self.states = list(set(states))
 			# Define transmat indices for future state-index lookups if model provided.
 			self._transmat_idxs = dict((s,i) for i,s in enumerate(states))
+			self._build_cdf()
 		else:
 			# Otherwise, we will construct this during training.
 			self._transmat_idxs = {}
@@ -56,86 +61,399 @@ class SimpleMarkov:
 		assert 0 <= epsilon <= 1.0, "MCC: epsilon must be in range [0.0, 1.0]."
 
 
-	def fit(self, event: list or str):
+	def fit(self, event: list or str, sparse:bool=False):
 		"""
 		Create a model by fitting a given event as either:
 			an ordered list of states OR 
 			a string of states separated by commas. 
 		Devise transmat based on state transitions.
+
+		With sparse=True, transmat is a scipy.sparse CSR matrix rather than a dense 
+		array, for events with too many distinct states for an SxS matrix.
 		"""
 		if type(event) is str:
 			assert "," in event, "MCC: Separate states in string representation with commas."
-			self.states = self.event.split(",")
+			event = event.split(",")
+
+		# Encode the event as row indices of the transmat, in order of first appearance.
+		self._transmat_idxs = {s: i for i, s in enumerate(dict.fromkeys(event))}
+		self.states = list(self._transmat_idxs)
+		n = len(self.states)
+		codes = np.fromiter(map(self._transmat_idxs.__getitem__, event), dtype=np.int64, count=len(event))
+
+		# Every transition s -> s' as one flat index, counted all at once.
+		if sparse:
+			from scipy.sparse import csr_matrix
+			counts = csr_matrix((np.ones(len(codes) - 1), (codes[:-1], codes[1:])), shape=(n, n))
+			counts.sum_duplicates()
+			rowsums = np.asarray(counts.sum(axis=1)).ravel()
+			# Only the last state of the event can lack outgoing transitions, so every stored entry has rowsum > 0.
+			counts.data /= np.repeat(rowsums, np.diff(counts.indptr))
+			self.transmat = counts
 		else:
-			self.states = list(set(event))
-		
-		self.transmat = np.zeros((len(self.states),len(self.states)))
-
-		# Go through the event and figure out how many 
-		# times state s goes to state s' for all s.
-		transcounts = {}
-		for i in range(1, len(event)):
-			if not (event[i-1], event[i]) in transcounts:
-				transcounts[(event[i-1], event[i])] = 1
-			else:
-				transcounts[(event[i-1], event[i])] += 1
-		
-		# For all states s, populate the transition matrix with 
-		# probabilities of s transitioning to itself or any of 
-		# the other states.
-		for row,s in enumerate(self.states):
-			# Record index of the transmat for this state, so 
-			# we can reference it later in retrieving state-rows.
-			self._transmat_idxs[s] = row
-			for col,q in enumerate(self.states):
-				if (s,q) in transcounts:
-					self.transmat[row][col] = transcounts[(s,q)]
+			counts = np.bincount(codes[:-1] * n + codes[1:], minlength=n*n).reshape(n, n).astype(np.float64)
+			rowsums = counts.sum(axis=1, keepdims=True)
+			# Rows of states with no outgoing transitions stay all zeros instead of becoming NaN.
+			self.transmat = np.divide(counts, rowsums, out=np.zeros_like(counts), where=rowsums > 0)
 
-			# Sum row, then divide each element by the sum to get probabilities.
-			rowsum = sum(self.transmat[row])
-			for i in range(len(self.transmat[row])):
-				self.transmat[row][i] /= rowsum
+		self._build_cdf()
 
 
-	def predict(self, samples:int, state=None) -> list:
+	def _build_cdf(self):
+		"""
+		Precompute what predict() samples from: the cumulative probabilities of each 
+		transmat row in CSR form, and each row's most probable next state.
+		Works on a dense transmat or a scipy.sparse one.
+		"""
+		# Row index -> state, the inverse of _transmat_idxs.
+		self._idx_states = [None] * len(self._transmat_idxs)
+		for s, i in self._transmat_idxs.items():
+			self._idx_states[i] = s
+
+		n = self.transmat.shape[0]
+		if hasattr(self.transmat, "tocoo"):
+			coo = self.transmat.tocoo()
+			rows, cols, probs = coo.row.astype(np.int64), coo.col.astype(np.int64), coo.data.astype(np.float64)
+			keep = probs > 0
+			rows, cols, probs = rows[keep], cols[keep], probs[keep]
+		else:
+			dense = np.nan_to_num(np.asarray(self.transmat, dtype=np.float64))
+			rows, cols = np.nonzero(dense > 0)
+			probs = dense[rows, cols]
+
+		# A state that never transitions anywhere gets a uniform row, so sampling can always continue.
+		empty = np.flatnonzero(np.bincount(rows, minlength=n) == 0)
+		if len(empty):
+			rows = np.concatenate((rows, np.repeat(empty, n)))
+			cols = np.concatenate((cols, np.tile(np.arange(n), len(empty))))
+			probs = np.concatenate((probs, np.ones(len(empty) * n)))
+
+		order = np.lexsort((cols, rows))
+		rows, self._next, probs = rows[order], cols[order], probs[order]
+		self._offsets = np.zeros(n + 1, dtype=np.int64)
+		np.cumsum(np.bincount(rows, minlength=n), out=self._offsets[1:])
+		self._cumprobs, self._bounds = _cumulative(probs, self._offsets)
+		# Most probable next state: the first entry of each row once sorted by descending probability.
+		self._greedy = self._next[np.lexsort((-probs, rows))][self._offsets[:-1]]
+		self._lists = None
+
+
+	def predict(self, samples:int, state=None, seed=None) -> list:
 		"""
 		Generate a given number of samples from the model. You 
 		may pass an initial state to influence the generation.
+
+		Each step is a binary search of a uniform random number in the current state's 
+		precomputed cumulative transition probabilities. The searches are done with bisect 
+		on Python lists of them, made on the first predict(), since a NumPy call on a single 
+		value costs several times more than the search itself. The random numbers are drawn 
+		up front from a numpy.random.Generator, so passing the same `seed` (an int or a 
+		Generator) gives the same predictions.
 		"""
 		assert not(self.states is None or self.transmat is None), "MCC: Cannot predict without model."
+		rng = np.random.default_rng(seed)
 		if not state:
-			# We have to convert it to a string because apparently numpy 
-			# strings are different and can't index dictionaries. Pain.
-			state = str(np.random.choice(list(self.states)))
+			code = int(rng.integers(len(self._idx_states)))
 		else:
-			assert state in self.states, "MCC: Invalid provided state."
+			assert state in self._transmat_idxs, "MCC: Invalid provided state."
+			code = self._transmat_idxs[state]
+
+		us = rng.random(samples).tolist()
+		# With epsilon chance, we choose the most probable next state.
+		# If epsilon=0.0, as by default, this never happens.
+		greedy = (rng.random(samples) < self.epsilon).tolist() if self.epsilon > 0 else [False] * samples
+
+		if self._lists is None:
+			self._lists = (self._bounds.tolist(), self._next.tolist(), self._offsets.tolist(), self._greedy.tolist())
+		bounds, nexts, offsets, greedies = self._lists
 
 		predictions = []
-		for _ in range(samples):
-			if np.random.random() < self.epsilon:
-				# With epsilon chance, we choose the most probable next state.
-				# If epsilon=0.0, as by default, this never happens.
-				state = list(self.states)[np.argmax(self.transmat[self._transmat_idxs[state]])]
+		for i in range(samples):
+			if greedy[i]:
+				code = greedies[code]
 			else:
-				# Choose one state from the set of states given the transition probabilities 
-				# to other states on the respective row of the transition matrix.
-				# We index the first element of whatever the heck np.random.choice returns 
-				# because for some reason it is an array.
-				state = np.random.choice(list(self.states), 1, p=self.transmat[self._transmat_idxs[state]])[0]
-			predictions.append(state)
+				# Row `code` spans (code, code+1] of the bounds.
+				code = nexts[bisect_right(bounds, code + us[i], offsets[code], offsets[code+1])]
+			predictions.append(self._idx_states[code])
 		
 		return predictions
 	
 
+	def save(self, path:str):
+		"""
+		Save the model to a binary file, to be opened with load_model(). The states must be strings or ints.
+
+		What is saved is what predict() samples from: the states, and the transition 
+		probabilities in CSR form as float32 cumulative probabilities per row.
+		"""
+		assert not(self.states is None or self.transmat is None), "MCC: Cannot save without model."
+		_write_model(path, {"kind": "SimpleMarkov", "epsilon": self.epsilon, "sparse": hasattr(self.transmat, "tocoo"), 
+			"states": self._idx_states}, {"offsets": self._offsets, "next": self._next, "cumprobs": self._cumprobs, "greedy": self._greedy})
+
+
+	@classmethod
+	def _from_arrays(cls, meta:dict, arrays:dict):
+		"""
+		Rebuild a saved model. transmat is rebuilt from the float32 cumulative probabilities, 
+		and states that had no transitions come back with the uniform rows that predict() uses for them.
+		"""
+		model = cls(epsilon=meta["epsilon"])
+		model._idx_states = meta["states"]
+		model.states = list(model._idx_states)
+		model._transmat_idxs = dict((s, i) for i, s in enumerate(model._idx_states))
+		model._offsets, model._next, model._cumprobs, model._greedy = (arrays[a] for a in ("offsets", "next", "cumprobs", "greedy"))
+		model._lists = None
+		n, row_lens = len(model.states), np.diff(model._offsets)
+		rows = np.repeat(np.arange(n), row_lens)
+		model._bounds = rows + model._cumprobs.astype(np.float64)
+		# Each row's probabilities are the differences of its cumulative probabilities.
+		probs = np.diff(model._cumprobs.astype(np.float64), prepend=0.0)
+		probs[model._offsets[:-1][row_lens > 0]] = model._cumprobs[model._offsets[:-1][row_lens > 0]]
+		if meta["sparse"]:
+			from scipy.sparse import csr_matrix
+			model.transmat = csr_matrix((probs, model._next, model._offsets), shape=(n, n))
+		else:
+			model.transmat = np.zeros((n, n))
+			model.transmat[rows, model._next] = probs
+		return model
+
+
 	def __repr__(self) -> str:
 		return "States:\n" + str(self.states) + \
 		"\nTransition matrix:\n" + str(self.transmat)
 
 
+def _cumulative(counts:np.array, offsets:np.array) -> tuple:
+	"""
+	Per-row cumulative probabilities of a CSR table of counts, given its row offsets. 
+	Returns them as float32, and as float64 "bounds" where row r is shifted up by r, 
+	which makes one sorted array covering every row: row r spans (r, r+1], so searching 
+	for r+u with u in [0, 1) lands inside it. The last entry of each row is set to exactly 
+	1.0 (r+1.0) so that a draw never falls past the end of its row. Rows must not be empty.
+	"""
+	cum = np.cumsum(counts, dtype=np.float64)
+	row_lens = np.diff(offsets)
+	starts = offsets[:-1]
+	before = np.repeat(cum[starts] - counts[starts], row_lens)
+	totals = np.repeat(np.add.reduceat(counts, starts), row_lens)
+	cumprobs = ((cum - before) / totals).astype(np.float32)
+	cumprobs[offsets[1:] - 1] = 1.0
+	bounds = np.repeat(np.arange(len(row_lens), dtype=np.float64), row_lens) + cumprobs
+	return cumprobs, bounds
+
+
+def _unique_windows(windows:np.array, n_states:int, weights:np.array=None) -> tuple:
+	"""
+	The distinct rows of an array of windows of state codes, sorted, and how often each 
+	occurs (or the sum of their weights, if given).
+
+	Sorting and counting plain integers is far faster than np.unique over rows, so 
+	the codes of each window are packed into as few int64 "digits" in base n_states 
+	as will hold them. Usually that is one, otherwise the digits are sorted with np.lexsort.
+	"""
+	n_states = max(n_states, 2)
+	per_digit = max(1, int(62 // np.log2(n_states)))
+	width = windows.shape[1]
+	bounds = list(range(0, width, per_digit)) + [width]
+
+	digits = []
+	for a, b in zip(bounds[:-1], bounds[1:]):
+		keys = np.zeros(len(windows), dtype=np.int64)
+		for j in range(a, b):
+			keys *= n_states
+			keys += windows[:, j]
+		digits.append(keys)
+
+	if len(digits) == 1:
+		order = np.argsort(digits[0], kind="stable")
+	else:
+		order = np.lexsort(digits[::-1])
+	digits = [d[order] for d in digits]
+	first = np.ones(len(order), dtype=bool)
+	if len(order) > 1:
+		first[1:] = np.any([d[1:] != d[:-1] for d in digits], axis=0)
+	starts = np.flatnonzero(first)
+	if weights is None:
+		counts = np.diff(np.append(starts, len(order)))
+	else:
+		counts = np.add.reduceat(weights[order], starts) if len(order) > 0 else weights[:0]
+	digits = [d[starts] for d in digits]
+
+	unique = np.empty((len(starts), width), dtype=np.int32)
+	for (a, b), keys in zip(zip(bounds[:-1], bounds[1:]), digits):
+		for j in range(b - 1, a - 1, -1):
+			keys, unique[:, j] = np.divmod(keys, n_states)
+	return unique, counts
+
+
+class _TransitionTable:
+	def __init__(self, transitions:np.array, counts:np.array):
+		"""
+		A transition table of one order m in CSR form, built from sorted, distinct 
+		(m+1)-state windows of codes and their counts. The first m columns of a window 
+		are the priors and the last is the next state.
+
+		Row r has priors self.priors[r], and its next states are 
+		self.next[self.offsets[r]:self.offsets[r+1]]. Their counts are kept as a running 
+		total through the whole table, self.cum, which is all sampling needs: row r covers 
+		the totals after its first to after its last next state, so a uniform draw scaled 
+		to that range is found with one searchsorted, without storing probabilities next 
+		to the counts. The totals are whole numbers, so float64 holds them exactly.
+		"""
+		self.order = transitions.shape[1] - 1
+		priors = transitions[:, :self.order]
+		new_row = np.ones(len(transitions), dtype=bool)
+		new_row[1:] = np.any(priors[1:] != priors[:-1], axis=1)
+		starts = np.flatnonzero(new_row)
+
+		self.priors = np.ascontiguousarray(priors[starts], dtype=np.int32)
+		self.offsets = np.append(starts, len(transitions)).astype(np.int64)
+		self.next = transitions[:, self.order].astype(np.int32)
+		self.cum = np.cumsum(counts, dtype=np.float64)
+		self.weights = None
+		self._rows = None
+		self._keys = None
+		self._lists = None
+		self._spans = None
+
+
+	@classmethod
+	def from_arrays(cls, priors:np.array, offsets:np.array, next:np.array, cum:np.array):
+		"""
+		A table from its CSR arrays as they are stored on a table, e.g. memory-mapped from a saved model.
+		"""
+		table = cls.__new__(cls)
+		table.order = priors.shape[1]
+		table.priors, table.offsets, table.next, table.cum = priors, offsets, next, cum
+		table.weights = None
+		table._rows = None
+		table._keys = None
+		table._lists = None
+		table._spans = None
+		return table
+
+
+	@property
+	def counts(self) -> np.array:
+		"""
+		How often each window was seen, in the same order as self.next.
+		"""
+		return np.diff(self.cum, prepend=0.0).astype(np.int64)
+
+
+	@property
+	def rows(self) -> dict:
+		"""
+		A dict from tuples of prior codes to rows, built the first time it is asked for.
+		"""
+		if self._rows is None:
+			self._rows = dict((p, r) for r, p in enumerate(map(tuple, self.priors.tolist())))
+		return self._rows
+
+
+	def build_weights(self):
+		"""
+		Witten-Bell weight of each row, for interpolated back-off: times seen / (times seen + distinct next states).
+		"""
+		ends = self.cum[self.offsets[1:] - 1]
+		totals = np.diff(ends, prepend=0.0)
+		self.weights = (totals / (totals + np.diff(self.offsets))).astype(np.float32)
+
+
+	def transitions(self) -> np.array:
+		"""
+		The (m+1)-state windows of codes that the table was built from, in the same order as its counts.
+		"""
+		return np.column_stack((np.repeat(self.priors, np.diff(self.offsets), axis=0), self.next))
+
+
+	def find(self, priors:np.array, keys:np.array, n_states:int) -> np.array:
+		"""
+		The rows of many sets of priors at once, or -1 for those without a row. `priors` is 
+		an array of sets of m prior codes, and `keys` the same sets packed into one int64 
+		each as digits in base n_states, the first prior being the most significant.
+
+		The rows are sorted by their priors, so their packed keys are sorted too, and finding 
+		them is one searchsorted. Priors too long to pack into an int64 (keys=None) use self.rows instead.
+		"""
+		if self.order == 0:
+			return np.zeros(len(priors), dtype=np.int64)
+		if keys is None:
+			return np.array([self.rows.get(p, -1) for p in map(tuple, priors.tolist())], dtype=np.int64)
+		packed = self.packed_keys(n_states)
+		rows = np.minimum(packed.searchsorted(keys), len(packed) - 1)
+		return np.where(packed[rows] == keys, rows, -1)
+
+
+	def packed_keys(self, n_states:int) -> np.array:
+		"""
+		The priors of every row packed into one int64 each, as digits in base n_states, the 
+		first prior being the most significant. Sorted, like the rows. n_states**order must fit in an int64.
+		"""
+		if self._keys is None or self._keys[0] != n_states:
+			packed = np.zeros(len(self.priors), dtype=np.int64)
+			for j in range(self.order):
+				packed *= n_states
+				packed += self.priors[:, j]
+			self._keys = (n_states, packed)
+		return self._keys[1]
+
+
+	def spans(self, n_states:int) -> tuple:
+		"""
+		What sampling many rows at once needs, for KMarkov.predict_batch(): the packed keys of the 
+		rows (see packed_keys()) followed by a key larger than any, then the running total before 
+		each row, the range of totals it covers, and the index of its last next state. The last 
+		three have one more (meaningless) row for the extra key, so looking a key up and taking 
+		those of the row found needs no bounds check. Made the first time they are asked for.
+		"""
+		if self._spans is None or self._spans[0] != n_states:
+			starts, ends = self.offsets[:-1], self.offsets[1:] - 1
+			lo = np.where(starts > 0, self.cum[starts - 1], 0.0)
+			self._spans = (n_states, np.append(self.packed_keys(n_states), np.iinfo(np.int64).max), 
+				np.append(lo, 0.0), np.append(self.cum[ends] - lo, 0.0), np.append(ends, 0))
+		return self._spans[1:]
+
+
+	def lists(self, n_states:int) -> tuple:
+		"""
+		The table as Python lists, for sampling one step at a time with bisect, which is 
+		several times faster than a NumPy call on a single value: the packed keys of the rows 
+		(as in packed_keys(), but Python ints, so any order fits), the offsets, the running 
+		totals, the next states, and the weights or None. Made the first time they are asked for.
+		"""
+		if self._lists is None or self._lists[0] != n_states:
+			if n_states ** self.order < 2**63:
+				keys = self.packed_keys(n_states).tolist()
+			else:
+				keys = []
+				for priors in self.priors.tolist():
+					key = 0
+					for c in priors:
+						key = key * n_states + c
+					keys.append(key)
+			weights = None if self.weights is None else self.weights.tolist()
+			self._lists = (n_states, keys, self.offsets.tolist(), self.cum.tolist(), self.next.tolist(), weights)
+		return self._lists[1:]
+
+
+	def sample_many(self, rows:np.array, us:np.array) -> np.array:
+		"""
+		sample() for an array of rows and uniform random numbers.
+		"""
+		a, b = self.offsets[rows], self.offsets[rows+1]
+		lo = np.where(a > 0, self.cum[a-1], 0.0)
+		i = self.cum.searchsorted(lo + us * (self.cum[b-1] - lo), side="right")
+		return self.next[np.minimum(i, b - 1)]
 
 
 class KMarkov():
-	def __init__(self, k:int):
+	BACKOFFS = ("reduce", "interpolated")
+	# Fewest sequences for which predict_batch() steps them all together with NumPy rather than 
+	# sampling them one by one like predict(). Measured with scripts/bench_markov.py.
+	MIN_BATCH = 24
+
+	def __init__(self, k:int, backoff:str="reduce"):
 		"""
 		A class for fitting and sampling k-order Markov models where k is the 
 		number of previous states that the next state is dependent on. For example, 
@@ -146,11 +464,35 @@ class KMarkov():
 		probabilities. 
 		
 		The set of previous states (of size k) are called priors. The transition probabilities 
-		(TP) table creates keys out of these priors, and under these priors we store another 
-		table that maps the possible next states (given the priors) to their associated 
-		probabilities. This makes TP prior and then next state probability lookups efficient 
-		and flexibility as opposed to a multi-dimensional array structure. 
+		(TP) table maps each sequence of priors to the possible next states and their associated 
+		probabilities. 
+
+		Internally, states are interned to small integer codes (their index in `self.states`), 
+		and the table is stored in compressed sparse row (CSR) form in contiguous NumPy arrays: 
+		one row per distinct sequence of priors, holding the codes of its next states and a 
+		running total of their counts, from which they are sampled. This keeps fitting and 
+		sampling free of string joins and splits, and the model small in memory. 
+		The `TP` property rebuilds the old dictionary view of the table for inspection.
+
+		Alongside the order-k table, there is one table per shorter order k-1 down to 0. 
+		The order-m table maps m priors to the states that followed them, which is the 
+		next-state counts aggregated over every set of k priors ending in them (order 0 is just 
+		how often each state occurs). So the model only keeps the order-k table, and the 
+		first few windows of each event that no order-k window ends in ("heads"), and the 
+		shorter tables are built from them the first time a back-off needs them (all at once 
+		for interpolated back-off, which uses them at every step).
+		When a set of priors was never seen, prediction backs off through these tables with a 
+		constant-time lookup per order. The `backoff` parameter picks how:
+			"reduce" (default): sample from the longest suffix of the priors that was seen.
+			"interpolated": Witten-Bell style interpolation. At each order that has the priors, 
+				sample from it with probability c/(c+t), where c is how often the priors were seen 
+				and t how many distinct states followed them, and otherwise back off to the next 
+				shorter order. This mixes in shorter contexts even when the full priors were seen.
 		
+		The model keeps the raw transition counts, and only turns them into probabilities on the 
+		first predict() after they change. So it can be trained incrementally with partial_fit(), 
+		one song at a time, and models trained on different songs can be combined with merge().
+
 		More details on the fitment and prediction algorithms can be found in the descriptions 
 		of their associated methods.
 		
@@ -161,6 +503,7 @@ class KMarkov():
 
 		Use fit() to build the model for k-order processes. We can fit() an event to 
 		a KMarkov object if the size of the event is greater than k. 
+		Use partial_fit() to add more events to a model, and merge() to add another model to it.
 		Use predict() to generate a given number of samples, once the model is fitted. 
 
 		The following example shows how this class works to generate musical notes in RTTTL format:
@@ -178,61 +521,352 @@ class KMarkov():
 		A good heuristic is to provide as much data to fit() as possible. For this reason, SimpleMarkov 
 		is current a safer model to use, but is far less configurable and also less accurate.
 		"""
+		assert backoff in self.BACKOFFS, f"MCC: backoff must be one of {self.BACKOFFS}."
 		self.k = k
-		# Transition probabilities are stored in a dictionary for more efficient and flexible storage.
-		# The format is: 
-		# TP[`string of prior states`] = 
-		# 	{`next state` : `probability to do this transition to next state`}
-		self.TP = {}
+		self.backoff = backoff
+		# Vocabulary of states. A state's code is its index in this list.
+		self.states = None
+		self._state_idxs = {}
+		# The dtype of the arrays the model was fitted to, if it was. See _to_states().
+		self.dtype = None
+		# Transition tables of every order 0..k, indexed by order. Orders below k are None until needed. See _table().
+		self._tables = []
+		# For each order m < k, the (m+1)-state windows at the start of every event and their counts. See _count().
+		self._heads = []
+
+
+	def _to_states(self, event) -> list:
+		"""
+		An event as a list of states. A string is split on its commas. An array of records, like 
+		the notes of mcc_parser.midi_to_notes(), has each record's bytes read as one unsigned int, 
+		so the states are plain ints that _from_states() turns back into records.
+		"""
+		if type(event) is str:
+			assert "," in event, "MCC: Separate states in string representation with commas."
+			return event.split(",")
+		if isinstance(event, np.ndarray):
+			if event.dtype.names is not None:
+				assert event.dtype.itemsize in (1, 2, 4, 8), "MCC: Records must be 1, 2, 4 or 8 bytes long."
+				event = np.ascontiguousarray(event).view(f"u{event.dtype.itemsize}")
+			return event.tolist()
+		return list(event)
+
+
+	def _from_states(self, states:list):
+		"""
+		States in the form the model was fitted to: a comma-separated string, or an array 
+		of self.dtype. States can also be a nested list, e.g. one list per sequence.
+		"""
+		if self.dtype is None:
+			return ",".join(states)
+		if self.dtype.names is not None:
+			return np.array(states, dtype=f"u{self.dtype.itemsize}").view(self.dtype)
+		return np.array(states, dtype=self.dtype)
+
+
+	def _set_dtype(self, dtype):
+		"""
+		Record the dtype of the events the model is fitted to, which must not change.
+		"""
+		assert len(self.states) == 0 or dtype == self.dtype, f"MCC: Cannot fit events of {dtype} to a model of {self.dtype}."
+		self.dtype = dtype
+
+
+	def _encode(self, states) -> np.array:
+		"""
+		Intern states to integer codes, growing the vocabulary with any new ones.
+		"""
+		for s in dict.fromkeys(states):
+			if s not in self._state_idxs:
+				self._state_idxs[s] = len(self.states)
+				self.states.append(s)
+		return np.fromiter(map(self._state_idxs.__getitem__, states), dtype=np.int32, count=len(states))
+
+
+	def _count(self, codes:np.array) -> list:
+		"""
+		Count the transitions of an encoded event. Entry k of the result is a pair of sorted, 
+		distinct (k+1)-state windows of codes and their counts, and entry m < k the same for the 
+		(m+1)-state windows within the first k states of the event: its heads.
+
+		Every shorter window is the suffix of an order-k window, except for the heads, so the 
+		order-m counts are the order-k counts summed over their last m+1 states plus the heads 
+		(see _table()). Only the order-k windows need a sort over the whole event.
+		"""
+		windows = np.lib.stride_tricks.sliding_window_view(codes, self.k + 1)
+		tallies = [None] * (self.k + 1)
+		tallies[self.k] = _unique_windows(windows, len(self.states))
+		for m in range(self.k - 1, -1, -1):
+			tallies[m] = _unique_windows(np.lib.stride_tricks.sliding_window_view(codes[:self.k], m + 1), len(self.states))
+		return tallies
+
+
+	def _merge(self, tallies:list):
+		"""
+		Add counts as returned by _count() (in this model's codes) to the order-k table and the 
+		heads. The shorter tables are dropped, to be built again from them when needed.
+
+		Both are sorted, so the merged windows are two sorted runs, which the stable sort in 
+		_unique_windows merges in one linear pass when they pack into a single digit.
+		"""
+		n = len(self.states)
+		if len(self._tables) == 0:
+			top = _TransitionTable(*tallies[self.k])
+			self._heads = tallies[:self.k]
+		else:
+			t, c = tallies[self.k]
+			top = self._tables[self.k]
+			top = _TransitionTable(*_unique_windows(np.concatenate((top.transitions(), t)), n, np.concatenate((top.counts, c))))
+			self._heads = [_unique_windows(np.concatenate((hw, t)), n, np.concatenate((hc, c))) 
+				for (hw, hc), (t, c) in zip(self._heads, tallies)]
+		self._tables = [None] * self.k + [top]
 
 
 	def fit(self, event:list or str):
 		"""
 		Do fitment. You can pass a command-separated string of states, like in RTTTL format, or as a list. 
+		It can also be an array, such as the structured array of notes from mcc_parser.midi_to_notes(). 
+		predict() then returns an array of the same dtype rather than a string.
 
 		Walk through the event, creating keys for TP with k consecutive states ("priors") followed by its 
-		subsequent state ("next"). After combing through the event, return to the lookup table of priors 
-		and replace the occurrence counts with probabilities.
+		subsequent state ("next"). The states are first encoded to integer codes, so this walk is a 
+		sliding window over one integer array, and counting the distinct windows is a single sort. 
+		The tables of every shorter order, used for back-off, are summed from it when first needed.
 
-		The fit() method is linear in the order of `len(event) - k`.
+		The fit() method is linear in the order of `len(event) - k`, plus sorting the windows.
+		Any previous fitment is discarded; use partial_fit() to add to it instead.
 		"""
-		if type(event) is str:
-			assert "," in event, "MCC: Separate states in string representation with commas."
-			event = event.split(",")
+		self.states = []
+		self._state_idxs = {}
+		self._tables = []
+		self._heads = []
+		self.dtype = None
+		self.partial_fit(event)
+
+
+	def partial_fit(self, event:list or str):
+		"""
+		Add the transitions of another event to the model, as if it had been passed to fit() along 
+		with every event before it (each event separately, so no transitions span two events). 
+		New states are added to the vocabulary.
+
+		Only the new event is walked and counted. Its counts are then merged into the model's, 
+		which is one vectorized pass over the counts, so adding a song to a large model costs 
+		about as much as fitting the song alone.
+		"""
+		if self.states is None:
+			self.states = []
+		self._set_dtype(event.dtype if isinstance(event, np.ndarray) else None)
+		event = self._to_states(event)
 		
 		assert len(event) > self.k, f"MCC: Cannot fit with order {self.k} to event of size {len(event)}."
-		self.states = list(set(event))
+		codes = self._encode(event)
+		self._merge(self._count(codes))
 
-		# Create counts of how many times a sequence of o states results in a new state s.
-		for i in range(len(event)-self.k):
 
-			priors = ",".join(event[i:i+self.k])
-			next = event[i+self.k]
+	def merge(self, other):
+		"""
+		Add the counts of another KMarkov of the same order to this one, as if this model had also 
+		been fitted to every event the other was fitted to. States are matched by value, and the 
+		other model's new states are added to the vocabulary. Returns this model.
+		"""
+		assert isinstance(other, KMarkov) and other.k == self.k, f"MCC: Can only merge with another KMarkov of order {self.k}."
+		if other.states is None:
+			return self
+		if self.states is None:
+			self.states = []
+		self._set_dtype(other.dtype)
+		# Map the other model's codes to this model's, then re-sort its windows in the new codes.
+		remap = self._encode(other.states)
+		top = other._tables[self.k]
+		heads = [_unique_windows(remap[w], len(self.states), c) for w, c in other._heads]
+		self._merge(heads + [_unique_windows(remap[top.transitions()], len(self.states), top.counts)])
+		return self
 
-			# Case 1: prior states already recorded and next state is indexable and incrementable.
-			if priors in self.TP and next in self.TP[priors]:
-				self.TP[priors][next] += 1.0
 
-			# Case 2: prior states already recorded BUT next state is not yet included as possible outcome.
-			elif priors in self.TP:
-				self.TP[priors][next] = 1.0
+	def _table(self, m:int) -> _TransitionTable:
+		"""
+		The transition table of order m, built from the order-k table and the heads if it 
+		isn't yet: every order-k window counts towards its last m+1 states.
+		"""
+		if self._tables[m] is None:
+			top = self._tables[self.k]
+			windows, counts = self._heads[m]
+			table = _TransitionTable(*_unique_windows(np.concatenate((top.transitions()[:, self.k-m:], windows)), 
+				len(self.states), np.concatenate((top.counts, counts))))
+			if self.backoff == "interpolated":
+				table.build_weights()
+			self._tables[m] = table
+		return self._tables[m]
 
-			# Case 3: prior states not recorded. Initialize them with next state as only possible outcome (so far).
-			else:
-				self.TP[priors] = {next: 1.0}
 
-		# Replace counts with probabilities of that selection 
-		# of prior states switching to the next state.
-		for priors in self.TP:
-			csum = sum(self.TP[priors].values())
-			for next in self.TP[priors]:
-				self.TP[priors][next] /= csum
+	def _materialize(self) -> list:
+		"""
+		The transition tables, with everything sampling needs built: the Witten-Bell weights 
+		of the order-k table, and every shorter table, for interpolated back-off. With "reduce" 
+		back-off, shorter tables are left to be built by _table() if a back-off reaches them.
+		"""
+		top = self._tables[self.k]
+		if self.backoff == "interpolated":
+			if top.weights is None:
+				top.build_weights()
+			for m in range(self.k):
+				self._table(m)
+		return self._tables
+
+
+	def _next_state(self, key:int, known:int, u:float, v:float=0.0) -> tuple:
+		"""
+		Sample the code of the next state given the last k prior codes packed into one int 
+		`key` as digits in base len(self.states) (see _TransitionTable.lists()), of which the 
+		last `known` are states seen in fit(), and two uniform random numbers in [0, 1): u picks 
+		the next state, and v the order to back off to with interpolated back-off. Returns the 
+		code and the order it was sampled from.
+
+		If the priors are in the order-k table, great. If not, drop priors from the front 
+		and look the remaining suffix (key mod n**m) up in the table of that order, down to 
+		order 0, which always has a row. With interpolated back-off, a row that is found may 
+		still pass the draw on to the next shorter order, with probability 1 - its Witten-Bell weight.
+		"""
+		n = len(self.states)
+		for m in range(min(known, self.k), -1, -1):
+			keys, offsets, cum, nexts, weights = self._table(m).lists(n)
+			suffix = key % n**m
+			row = bisect_left(keys, suffix)
+			if row == len(keys) or keys[row] != suffix:
+				continue
+			if weights is not None and m > 0:
+				w = weights[row]
+				if v >= w:
+					# Passed on. What is left of v above w is again uniform once rescaled.
+					v = (v - w) / (1.0 - w)
+					continue
+			a, b = offsets[row], offsets[row+1]
+			lo = cum[a-1] if a > 0 else 0.0
+			# Searching up to b-1 keeps the last state for u*total rounding up to the total itself.
+			return nexts[bisect_right(cum, lo + u * (cum[b-1] - lo), a, b - 1)], m
 
 
-	def predict(self, samples:int, priors:str=None, DEBUG_LVL:int=0) -> str:
+	def predict_batch(self, n_sequences:int, samples:int, priors:str=None, seed=None, decode:bool=False):
 		"""
-		Generate a given number of samples from the model. Returns a comma-separated string of states.
-		OPTIONAL: provide a sequence of priors as a comma-separated string. Prediction will start 
+		Generate n_sequences independent sequences of a given number of samples at once. 
+		Returns an array of shape (n_sequences, samples) of state codes (indexes into self.states). 
+		With decode=True, returns the states themselves in the form predict() returns them: a list 
+		of comma-separated strings (RTTTL, for a model fitted to RTTTL), or for a model fitted to 
+		arrays, an array of that dtype with one row per sequence. Unlike predict(), the result 
+		does not include the starting priors.
+
+		Priors work as in predict(), and every sequence starts from them. Without priors, each 
+		sequence starts from its own random set of k consecutive states. Back-off is the same as 
+		in predict(), but each step is done for all the sequences together: every sequence's 
+		priors are looked up in the tables of every order with one searchsorted per order (see 
+		_TransitionTable.find()), and the next states of all the sequences sampled from each order 
+		are drawn with one more. The cost of a step is then spread over all the sequences. With 
+		"reduce" back-off, a step where every sequence's priors are in the order-k table, as they 
+		are for most steps, skips the back-off bookkeeping and is a handful of NumPy calls in all.
+
+		Each step still costs a dozen or more NumPy calls, which only pays off for enough 
+		sequences: below MIN_BATCH of them, they are sampled one after the other as predict() 
+		does, each with its own generator drawn from `seed`.
+
+		Passing the same `seed` gives the same sequences, though not the same as predict() gives.
+		"""
+		assert not self.states is None, "MCC: Cannot predict without model. Remember to fit() first."
+		top = self._materialize()[self.k]
+		rng = np.random.default_rng(seed)
+		k, n = self.k, len(self.states)
+
+		if n_sequences < self.MIN_BATCH:
+			start = None if priors is None else self._start(priors, rng)[1]
+			out = np.empty((n_sequences, samples), dtype=np.int32)
+			for j, s in enumerate(rng.integers(2**63, size=n_sequences).tolist()):
+				own = np.random.default_rng(s)
+				codes = self._start(None, own)[1] if start is None else list(start)
+				out[j] = self._sample(codes, samples, own)[-samples:] if samples > 0 else []
+			return self._decode_batch(out) if decode else out
+
+		# Each row holds the k priors, followed by the samples as they are generated.
+		out = np.full((n_sequences, k + samples), -1, dtype=np.int32)
+		if priors is None:
+			out[:, :k] = top.priors[rng.integers(len(top.priors), size=n_sequences)]
+			known = k
+		else:
+			# Same priors as predict(). With fewer than k of them, the missing ones stay -1.
+			codes = [self._state_idxs.get(s, -1) for s in self._to_states(priors)[-k-1:-1]]
+			if len(codes) > 0:
+				out[:, k-len(codes):k] = codes
+			# How many of the last priors are states seen in fit(). Orders above that have no rows.
+			known = next((j for j, c in enumerate(reversed(codes)) if c < 0), len(codes))
+
+		# The last K priors of every sequence packed into one int64 as digits in base n (unknown ones 
+		# as 0), for the largest K <= k that fits. It is rolled forward each step by dropping the first 
+		# digit and adding the new state as the last. The key of the last m <= K priors is this key 
+		# mod n**m. Orders above K look their priors up in dicts instead.
+		K = max(m for m in range(k + 1) if n ** m < 2**63)
+		key = np.zeros(n_sequences, dtype=np.int64)
+		for j in range(k - K, k):
+			key = key * n + np.maximum(out[:, j], 0)
+
+		us = rng.random((samples, n_sequences))
+		vs = rng.random((samples, n_sequences)) if self.backoff == "interpolated" else None
+		fast = self.backoff == "reduce" and K == k
+		if fast:
+			packed, lo, span, last = top.spans(n)
+		for i in range(samples):
+			top_m = min(k, known + i)
+			todo = np.arange(n_sequences)
+			if fast and top_m == k:
+				# The order-k lookup and draw of every sequence at once, the same as top.find() and 
+				# top.sample_many() give. Only the sequences whose priors aren't there back off.
+				rows = packed.searchsorted(key)
+				hit = packed[rows] == key
+				if hit.all():
+					out[:, k+i] = top.next[np.minimum(top.cum.searchsorted(lo[rows] + us[i] * span[rows], side="right"), last[rows])]
+					todo = todo[:0]
+				else:
+					rows = rows[hit]
+					out[hit, k+i] = top.next[np.minimum(top.cum.searchsorted(lo[rows] + us[i, hit] * span[rows], side="right"), last[rows])]
+					todo, top_m = np.flatnonzero(~hit), k - 1
+			window = out[:, i:i+k]
+			v = None if vs is None else vs[i].copy()
+			for m in range(top_m, -1, -1):
+				if len(todo) == 0:
+					break
+				table = self._table(m)
+				keys = (key[todo] % n**m if m < K else key[todo]) if m <= K else None
+				rows = table.find(window[todo, k-m:], keys, n)
+				pos = np.flatnonzero(rows >= 0)
+				rows = rows[pos]
+				if v is not None and m > 0:
+					# Interpolated back-off: pass a draw on with probability 1 - the row's weight.
+					w = table.weights[rows]
+					stay = v[todo[pos]] < w
+					passed = todo[pos[~stay]]
+					v[passed] = (v[passed] - w[~stay]) / (1.0 - w[~stay])
+					pos, rows = pos[stay], rows[stay]
+				cand = todo[pos]
+				out[cand, k+i] = table.sample_many(rows, us[i, cand])
+				todo = np.delete(todo, pos)
+			if K > 0:
+				key = (key % n**(K-1)) * n + out[:, k+i]
+
+		out = out[:, k:]
+		return self._decode_batch(out) if decode else out
+
+
+	def _decode_batch(self, out:np.array):
+		"""
+		predict_batch()'s array of codes as the states themselves: see decode there.
+		"""
+		seqs = [[self.states[c] for c in seq] for seq in out.tolist()]
+		return [self._from_states(seq) for seq in seqs] if self.dtype is None else self._from_states(seqs)
+
+
+	def predict(self, samples:int, priors:str=None, DEBUG_LVL:int=0, seed=None) -> str:
+		"""
+		Generate a given number of samples from the model. Returns a comma-separated string of states, 
+		or an array of states if the model was fitted to arrays.
+		OPTIONAL: provide a sequence of priors as a comma-separated string (or an array). Prediction will start 
 		from the last k states in the priors. Use this to extend the track trained on by just passing 
 		the string you used as a training event to the priors parameter.
 		
@@ -241,69 +875,198 @@ class KMarkov():
 		
 		If yes, great. Probabilistically choose one of the prior's possible next states.
 		
-		If not, reduce the priors by removing one prior state from the front. Check again, but instead of 
-		checking for an exact match, check if the reduced priors are a suffix of another key. If we find 
-		one such inexact match, set the priors to the full priors that were matched by the reduced priors. 
-		They will be returned on the next run of the loop.
-		
-		If reduction goes to the last prior, randomly chose a sequence of priors that end in the remaining state. 
+		If not, reduce the priors by removing one prior state from the front, and look up the 
+		next-state distribution aggregated over every set of priors ending in the reduced priors. 
+		Keep reducing until one is found; the last resort is how often each state occurs.
+		See `backoff` in the class description for the interpolated alternative.
+
+		Sampling a next state is a binary search of a uniform random number, scaled to the row's 
+		total count, in the row's running total of counts, after a binary search for the row of 
+		the priors. Both are done with bisect on Python lists of the tables (see 
+		_TransitionTable.lists()), which is several times faster than NumPy on single values. 
+		All the uniform random numbers are drawn up front from a numpy.random.Generator, so 
+		passing the same `seed` (an int or a Generator) gives the same predictions.
 		"""
 		assert not self.states is None, "MCC: Cannot predict without model. Remember to fit() first."
+		self._materialize()
+		rng = np.random.default_rng(seed)
+		preds, codes = self._start(priors, rng)
+		codes = self._sample(codes, samples, rng, DEBUG_LVL)
+		return self._from_states(preds + [self.states[c] for c in codes[len(preds):]])
+
 
+	def _start(self, priors, rng:np.random.Generator) -> tuple:
+		"""
+		The states predict() starts from, and their codes.
+		"""
 		if priors is None:
 			# Grab a random set of k consecutive states that will definitely have a next state.
-			preds = str(np.random.choice(list(self.TP.keys()))).split(",")
-		else:
-			assert "," in priors, "MCC: Separate priors in string representation with commas."
-			# Consider k states from the last state so that we can make sure to have a key for 
-			# this sequence in the TP.
-			preds = priors.split(",")[-self.k-1:-1]
+			codes = [int(c) for c in self._tables[self.k].priors[rng.integers(len(self._tables[self.k].priors))]]
+			return [self.states[c] for c in codes], codes
+		# Consider k states from the last state so that we can make sure to have a key for 
+		# this sequence in the TP. States never seen in fit() get code -1, which matches no row.
+		preds = self._to_states(priors)[-self.k-1:-1]
+		return preds, [self._state_idxs.get(s, -1) for s in preds]
 
-		for i in range(samples):
-			# Only consider the k most recent states visited.
-			priors = ",".join(preds[-self.k:])
-			if DEBUG_LVL > 0:
-				print(i, " init priors:", priors, self.TP.keys())
 
-			while not priors in self.TP:
-				priors_list = priors.split(",")
-				
-				# Reduce from beginning.
-				if len(priors_list[1:]) > 0:
-					priors = ",".join(priors_list[1:])
-					for ps in self.TP:
-						if ps[-len(priors):] == priors:
-							priors = ps[-len(priors):]
-							break
-				
-				# No more states left to reduce? Then take that last state 
-				# and randomly choose a set of priors that ends in that state
-				# of all the priors that end in this state. 
-				else:
-					last_state = ",".join(priors_list)
-					possible_priors = [k for k in self.TP if k[-len(last_state):] == last_state]
-					# Some songs just can't even. Seems to only be an issue with certain tracks 
-					# in Zgbreve.mid and zeldaund.mid. This is insurance.
-					if len(possible_priors) == 0:
-						priors = str(np.random.choice(list(self.TP.keys())))
-					else:
-						priors = str(np.random.choice(possible_priors))
-
-				if DEBUG_LVL > 0:
-					print("  reduced priors:", priors)
-
-			if DEBUG_LVL > 1:
-				print(" end priors:", priors)
-				print(" keys: ", list(self.TP[priors].keys()))
-				print(" vals: ", list(self.TP[priors].values()))
-
-			# Now TP is safe to access. Probabilistically decided which next state to return.
-			next = str(np.random.choice(list(self.TP[priors].keys()), p=list(self.TP[priors].values())))
+	def _sample(self, codes:list, samples:int, rng:np.random.Generator, DEBUG_LVL:int=0) -> list:
+		"""
+		The body of predict(): append the codes of `samples` sampled states to a list of prior codes, and return it.
+		"""
+		table = self._tables[self.k]
+		# The k most recent codes packed into one int, and how many of the last ones are known states.
+		n = len(self.states)
+		key = known = 0
+		for c in codes[-self.k:]:
+			key, known = (key * n + c, known + 1) if c >= 0 else (key * n, 0)
+
+		us = rng.random(samples).tolist()
+		vs = rng.random(samples).tolist() if self.backoff == "interpolated" else [0.0] * samples
+		keys, offsets, cum, nexts, _ = table.lists(n)
+		reduce, mod = self.backoff == "reduce", n**self.k
+		for i in range(samples):
+			row = bisect_left(keys, key) if reduce and known >= self.k else len(keys)
+			if row < len(keys) and keys[row] == key:
+				# The priors are in the order-k table, as they are for most steps: _next_state() inlined.
+				a, b = offsets[row], offsets[row+1]
+				lo = cum[a-1] if a > 0 else 0.0
+				next, order = nexts[bisect_right(cum, lo + us[i] * (cum[b-1] - lo), a, b - 1)], self.k
+			else:
+				next, order = self._next_state(key, known, us[i], vs[i])
+			key = (key * n + next) % mod
+			known += 1
 
 			if DEBUG_LVL > 0:
-				print(" next:", next)
+				print(i, " priors:", [self.states[c] if c >= 0 else None for c in codes[-self.k:]])
+				print(" next:", self.states[next], "from order", order)
 				print("-"*20)
 
-			preds.append(next)
-		
-		return ",".join(preds)
+			codes.append(next)
+		return codes
+
+
+	def save(self, path:str):
+		"""
+		Save the model to a binary file, to be opened with load_model(). The states must be strings or ints.
+
+		The order-k table is saved as its CSR arrays: the packed priors of each row (an array of 
+		rows x k codes), the row offsets, and the next states with the running total of their 
+		counts, which is what predict() samples from. The heads of every shorter order are saved 
+		with their counts, so a loaded model can build its back-off tables and still be trained 
+		with partial_fit() and merge().
+		"""
+		assert not self.states is None, "MCC: Cannot save without model. Remember to fit() first."
+		top = self._tables[self.k]
+		arrays = dict((name, getattr(top, name)) for name in ("priors", "offsets", "next", "cum"))
+		for m, (windows, counts) in enumerate(self._heads):
+			arrays[f"heads{m}"], arrays[f"headcounts{m}"] = windows, counts
+		dtype = None if self.dtype is None else (self.dtype.descr if self.dtype.names is not None else self.dtype.str)
+		_write_model(path, {"kind": "KMarkov", "k": self.k, "backoff": self.backoff, "dtype": dtype, "states": self.states}, arrays)
+
+
+	@classmethod
+	def _from_arrays(cls, meta:dict, arrays:dict):
+		model = cls(meta["k"], backoff=meta["backoff"])
+		if meta.get("dtype") is not None:
+			model.dtype = np.dtype([tuple(f) for f in meta["dtype"]] if isinstance(meta["dtype"], list) else meta["dtype"])
+		model.states = meta["states"]
+		model._state_idxs = dict((s, i) for i, s in enumerate(model.states))
+		model._tables = [None] * model.k + [_TransitionTable.from_arrays(*(arrays[name] for name in ("priors", "offsets", "next", "cum")))]
+		model._heads = [(arrays[f"heads{m}"], arrays[f"headcounts{m}"]) for m in range(model.k)]
+		return model
+
+
+	@property
+	def TP(self) -> dict:
+		"""
+		The transition table as a dictionary, in the format:
+		TP[`string of prior states`] = {`next state` : `probability to do this transition to next state`}
+		Built on demand from the arrays, so use it for inspection rather than in loops.
+		"""
+		table = self._materialize()[self.k]
+		counts = table.counts
+		TP = {}
+		for r, priors in enumerate(table.priors.tolist()):
+			lo, hi = table.offsets[r], table.offsets[r+1]
+			probs = counts[lo:hi] / counts[lo:hi].sum()
+			TP[",".join(str(self.states[c]) for c in priors)] = dict((self.states[c], p) for c, p in zip(table.next[lo:hi].tolist(), probs.tolist()))
+		return TP
+
+
+# Saved models start with this magic and a format version, then the length of a JSON header 
+# holding the model's parameters, vocabulary and where each of its arrays lies in the file.
+def fit_tracks(tracks:list, k:int, backoff:str="reduce") -> list:
+	"""
+	One KMarkov of order k fitted to each of a song's tracks, or None for tracks too short 
+	to have a single transition, which are best kept as they are.
+	"""
+	models = []
+	for track in tracks:
+		model = None
+		if len(track) > k:
+			model = KMarkov(k, backoff=backoff)
+			model.fit(track)
+		models.append(model)
+	return models
+
+
+MODEL_MAGIC = b"MCCMODEL"
+# Version 2 saves KMarkov models as their order-k table and heads. SimpleMarkov models are the same in both.
+MODEL_VERSION = 2
+_MODEL_PREFIX = struct.Struct("<8sII")
+# Arrays start on multiples of this many bytes, so they can be viewed in place from a memory map.
+_MODEL_ALIGN = 64
+
+
+def _write_model(path:str, meta:dict, arrays:dict):
+	"""
+	Write a model's header and arrays in the saved model format.
+	"""
+	assert all(type(s) in (str, int) for s in meta["states"]), "MCC: Only models with str or int states can be saved."
+	layout, offset = {}, 0
+	arrays = dict((name, np.ascontiguousarray(a, dtype=np.asarray(a).dtype.newbyteorder("<"))) for name, a in arrays.items())
+	for name, a in arrays.items():
+		layout[name] = [offset, a.dtype.str, list(a.shape)]
+		offset += -(-a.nbytes // _MODEL_ALIGN) * _MODEL_ALIGN
+	header = json.dumps(dict(meta, arrays=layout)).encode("utf-8")
+	start = -(-(_MODEL_PREFIX.size + len(header)) // _MODEL_ALIGN) * _MODEL_ALIGN
+
+	with open(path, "wb") as f:
+		f.write(_MODEL_PREFIX.pack(MODEL_MAGIC, MODEL_VERSION, len(header)))
+		f.write(header)
+		for name, a in arrays.items():
+			f.seek(start + layout[name][0])
+			f.write(a.tobytes())
+		f.truncate(start + offset)
+
+
+def load_model(path:str, mmap:bool=True):
+	"""
+	Open a model saved with save(), as the SimpleMarkov or KMarkov it was.
+
+	With mmap=True (default), the arrays are read-only views of a np.memmap of the file rather 
+	than copies, so opening a model takes about as long as reading its vocabulary, pages are 
+	only read as predict() touches them, and processes that open the same file share its 
+	memory through the page cache. What predict() builds on top (the lookup of rows of priors, 
+	and a KMarkov's back-off tables) is still per process, and is built when first needed.
+	"""
+	with open(path, "rb") as f:
+		magic, version, size = _MODEL_PREFIX.unpack(f.read(_MODEL_PREFIX.size))
+		assert magic == MODEL_MAGIC, f"MCC: {path} is not a saved model."
+		meta = json.loads(f.read(size).decode("utf-8"))
+		assert version == MODEL_VERSION or (version == 1 and meta["kind"] == "SimpleMarkov"), \
+			f"MCC: {path} has model format version {version}, expected {MODEL_VERSION}. Fit and save the model again."
+	start = -(-(_MODEL_PREFIX.size + size) // _MODEL_ALIGN) * _MODEL_ALIGN
+
+	if mmap:
+		data = np.memmap(path, dtype=np.uint8, mode="r")
+	else:
+		data = np.fromfile(path, dtype=np.uint8)
+	arrays = {}
+	for name, (offset, dtype, shape) in meta.pop("arrays").items():
+		dtype = np.dtype(dtype)
+		n = int(np.prod(shape)) * dtype.itemsize
+		arrays[name] = data[start+offset:start+offset+n].view(dtype).reshape(shape)
+
+	cls = {"SimpleMarkov": SimpleMarkov, "KMarkov": KMarkov}[meta["kind"]]
+	return cls._from_arrays(meta, arrays)
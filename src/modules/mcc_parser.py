@@ -1,7 +1,15 @@
 # mcc_parser.py
 # Functions to parse Midi files.
 
-from mido import MidiFile, tempo2bpm
+import hashlib
+import json
+import os
+import struct
+import tempfile
+import zipfile
+from operator import itemgetter
+import numpy as np
+from mido import MidiFile, MetaMessage, tempo2bpm
 
 
 # Mapping of MIDI numeric notes to RTTTL key+octave notes.
@@ -37,6 +45,20 @@ INSTRUMENTS = [
 ]
 
 
+# A note as a record in a NumPy structured array: its MIDI pitch (REST for a rest), its RTTTL 
+# duration code (1 for a whole note, 2 for a half note, ..., 32), and whether it is dotted. 
+# Tracks of these are what the rest of MCC works on; RTTTL strings are just an export format.
+NOTE_DTYPE = np.dtype([("pitch", np.int16), ("duration", np.uint8), ("dotted", np.bool_)])
+REST = -1
+
+# A note on a track's timeline: when it starts and how long it lasts, in ticks from the start of 
+# the file, its MIDI pitch and velocity, and the channel (0-15, so percussion is 9) and program 
+# (0-127, an index into INSTRUMENTS) it was played with. Unlike NOTE_DTYPE, nothing is quantized, 
+# notes can overlap, and rests are just the gaps between notes. See MidiStream.timelines().
+TIMELINE_DTYPE = np.dtype([("onset", np.int64), ("length", np.int64), ("pitch", np.int16), ("velocity", np.uint8), 
+	("channel", np.uint8), ("program", np.uint8)])
+
+
 def program_to_instrument(program:int) ->  str:
 	"""
 	Maps a program number to a specific instrument under 
@@ -56,32 +78,49 @@ def open_midi(filepath:str) -> MidiFile:
 	return MidiFile(filepath, clip=True)
 
 
-def get_note_lengths(file_info: list) -> dict:
-	bpm = file_info[2][1]
+def start_bpm(file_info:dict) -> float:
+	"""
+	The tempo in bpm a song starts at, given the extract_midi_info() of a file. Songs without 
+	a set_tempo play at MIDI's default of 120 bpm.
+	"""
+	return file_info.get("tempo", (120,))[0]
+
+
+def get_note_lengths(file_info:dict, tick:int=0) -> dict:
+	"""
+	Length in seconds of each kind of note at the tempo in effect at `tick` (by default the 
+	start of the song), given the extract_midi_info() of a file.
+	"""
+	tempos = [tempo for t, tempo in file_info.get("tempo_map", []) if t <= tick]
+	bpm = tempo2bpm(tempos[-1]) if len(tempos) > 0 else start_bpm(file_info)
 	notes = {"whole note": 240 / bpm, "half note": 120 / bpm, "quarter note": 60 / bpm, "eighth note": 30 / bpm,
 			 "sixteenth note": 15 / bpm}
 	return notes
 
-"""
-currently, this implementation only works assuming the format of the midi files we've seen so far is the usual, ie. the 
-time signature is first, then the key signature, then the tempo is set. This is why if you pass it the list of extracted info
-from the midi file, the tempo should always be the 2nd entry of the 3rd list in the input
-"""
 
 def extract_midi_info(meta_messages:list) -> dict:
 	"""
 	Input the first track of a MIDI file containing meta messages
 	with key info such as timestamps for tempo change.
-	Return a dictionary of relevant information for a MIDI file.
+	Return a dictionary of relevant information for a MIDI file:
+		"time_signature": (numerator, denominator),
+		"key_signature": the key,
+		"tempo": (bpm, delta time) of the tempo the song starts at,
+		"tempo_map": a list of (absolute time in ticks, microseconds per beat) for every tempo 
+			change in order, from which a TempoMap can be built.
 	"""
-	info = {}
+	info = {"tempo_map": []}
+	ticks = 0
 	for msg in meta_messages:
+		ticks += msg.time
 		if msg.type == "time_signature":
 			info["time_signature"] = (msg.numerator, msg.denominator)
 		elif msg.type == "key_signature":
 			info["key_signature"] = msg.key
 		elif msg.type == 'set_tempo':
-			info["tempo"] = (tempo2bpm(msg.tempo), msg.time)
+			if "tempo" not in info:
+				info["tempo"] = (tempo2bpm(msg.tempo), msg.time)
+			info["tempo_map"].append((ticks, msg.tempo))
 	return info
 
 
@@ -116,6 +155,316 @@ def extract_midi_tracks(mid_tracks:list) -> list:
 	return notes_tracks
 
 
+class MidiStream:
+	def __init__(self, filepath:str, block_size:int=2**16):
+		"""
+		A standard MIDI file read lazily, one track at a time, instead of all at once like open_midi().
+
+		Opening the stream reads only the file header (format, number of tracks and ticks per beat). 
+		tracks() then yields one iterator per track, which decodes that track's note messages from 
+		the file as they are asked for, `block_size` bytes at a time. The note messages come out as 
+		the same 5-tuples as extract_midi_tracks(), so e.g. midi_to_notes() takes a list of them. 
+		Memory use is one block plus whatever the caller keeps, however large the file, and reading 
+		can stop at any point: after a number of ticks (see tracks()), or by just not reading further.
+
+		>>> with MidiStream("./data/Smbtheme.mid") as stream:
+		>>> 	for track in stream.tracks(max_ticks=16*4*stream.ticks_per_beat):	# The first 16 bars of 4/4.
+		>>> 		notes = midi_to_notes(list(track), stream.ticks_per_beat)
+		"""
+		assert ".mid" in filepath, "MCC: Cannot open non-MIDI file."
+		assert block_size > 0, "MCC: block_size must be positive."
+		self.block_size = block_size
+		self._file = open(filepath, "rb")
+		chunk, size = struct.unpack(">4sI", self._file.read(8))
+		assert chunk == b"MThd" and size >= 6, f"MCC: {filepath} is not a standard MIDI file."
+		self.format, self.n_tracks, self.ticks_per_beat = struct.unpack(">HHH", self._file.read(6))
+		assert self.ticks_per_beat < 0x8000, "MCC: SMPTE time division is not supported."
+		self._start = 8 + size
+
+
+	def _chunks(self):
+		"""
+		Yield the size of each track chunk from the first, with the file positioned at its start. 
+		Whatever of a chunk the caller does not read is skipped.
+		"""
+		self._file.seek(self._start)
+		while True:
+			start = self._file.tell()
+			head = self._file.read(8)
+			if len(head) < 8:
+				return
+			chunk, size = struct.unpack(">4sI", head)
+			if chunk == b"MTrk":
+				yield size
+			self._file.seek(start + 8 + size)
+
+
+	def _events(self, size:int, max_ticks:int=None):
+		"""
+		Decode the events of a track chunk of `size` bytes starting at the current position. 
+		Yields (absolute time, delta time, status, data) for channel messages, and 
+		(absolute time, delta time, 0xFF, (type, data)) for meta messages, with times in ticks. 
+		Stops at the end of the track, or at the first event past max_ticks.
+		"""
+		f, left = self._file, size
+		buf, pos = b"", 0
+		running, ticks = None, 0
+
+		def need(n):
+			# Make sure at least n unread bytes are buffered, reading the next blocks of the chunk.
+			nonlocal buf, pos, left
+			if len(buf) - pos < n:
+				more = f.read(min(left, max(self.block_size, n)))
+				left -= len(more)
+				buf, pos = buf[pos:] + more, 0
+				assert len(buf) >= n, "MCC: Track chunk ended in the middle of an event."
+
+		def varlen():
+			nonlocal pos
+			value = 0
+			while True:
+				need(1)
+				byte = buf[pos]
+				pos += 1
+				value = (value << 7) | (byte & 0x7F)
+				if byte < 0x80:
+					return value
+
+		while left > 0 or pos < len(buf):
+			delta = varlen()
+			ticks += delta
+			if max_ticks is not None and ticks > max_ticks:
+				return
+			need(1)
+			status = buf[pos]
+			if status < 0x80:
+				# Running status: the status byte of the previous channel message carries over.
+				assert running is not None, "MCC: Data byte without a status byte."
+				status = running
+			else:
+				pos += 1
+
+			if status == 0xFF:
+				need(1)
+				kind = buf[pos]
+				pos += 1
+				n = varlen()
+				need(n)
+				data, pos = buf[pos:pos+n], pos + n
+				yield ticks, delta, status, (kind, data)
+				if kind == 0x2F:
+					return
+			elif status in (0xF0, 0xF7):
+				n = varlen()
+				need(n)
+				pos += n
+			else:
+				running = status
+				n = 1 if 0xC0 <= status < 0xE0 else 2
+				need(n)
+				# Clip data bytes to 7 bits, like open_midi() does.
+				data, pos = tuple(min(b, 127) for b in buf[pos:pos+n]), pos + n
+				yield ticks, delta, status, data
+
+
+	def _note_events(self, size:int, max_ticks:int=None):
+		"""
+		The note messages of a track chunk, as (absolute time, delta time, note on or off status, 
+		pitch, velocity, instrument, channel, program). Program changes set self._instrument, 
+		which carries over from one track to the next, and the program of their channel in 
+		self._programs.
+		"""
+		for ticks, delta, status, data in self._events(size, max_ticks):
+			kind = status & 0xF0
+			if kind == 0xC0:
+				self._instrument = program_to_instrument(data[0])
+				self._programs[status & 0x0F] = data[0]
+			elif kind == 0x90 or kind == 0x80:
+				channel = status & 0x0F
+				yield ticks, delta, kind, data[0], data[1], self._instrument, channel, self._programs[channel]
+
+
+	def _reset_programs(self):
+		"""
+		Back to the state at the start of a file: the first instrument, and program 0 on every channel.
+		"""
+		self._instrument = INSTRUMENTS[0]
+		self._programs = [0] * 16
+
+
+	def tracks(self, max_ticks:int=None):
+		"""
+		Yield an iterator over the note messages of each track in turn, as extract_midi_tracks() 
+		5-tuples. A track's iterator has to be used before asking for the next track. Tracks 
+		without notes still get an (empty) iterator, so the i-th iterator is always track i.
+
+		Every track stops after `max_ticks` ticks if given. For the first N bars of a song in 
+		n/d time, that is N * n * 4/d * ticks_per_beat.
+
+		The instrument is the one set by the last program change, as in extract_midi_tracks(), 
+		and the first instrument in INSTRUMENTS until there is one.
+		"""
+		self._reset_programs()
+		for size in self._chunks():
+			yield _note_tuples(self._note_events(size, max_ticks))
+
+
+	def timelines(self, max_ticks:int=None):
+		"""
+		Yield the notes of each track in turn as a TIMELINE_DTYPE array sorted by onset, with the 
+		onset and length of each note in ticks from the start of the file. Each note on is paired 
+		with the next note off of the same pitch (a note off, or a note on with velocity 0). 
+		Notes still on at the end of the track last until the last note message, or max_ticks.
+
+		Times are summed over every message of the track, not just the notes, and not 
+		quantized, so notes of different tracks starting at the same time line up exactly. 
+		Use tempo_map() to turn the ticks into seconds.
+
+		Each note also keeps its channel and the program last set on that channel, which 
+		mcc_waves.timeline_to_voices() uses to pick how it sounds. Notes on different channels 
+		are paired separately.
+		"""
+		self._reset_programs()
+		for size in self._chunks():
+			yield _pair_notes(self._note_events(size, max_ticks), max_ticks)
+
+
+	def tempo_map(self):
+		"""
+		The TempoMap of the file, from the tempo changes in its first track (see info()).
+		"""
+		return TempoMap(self.info().get("tempo_map", []), self.ticks_per_beat)
+
+
+	def info(self) -> dict:
+		"""
+		extract_midi_info() of the first track, reading only its meta messages.
+		"""
+		for size in self._chunks():
+			meta = []
+			for _, delta, status, data in self._events(size):
+				if status == 0xFF:
+					kind, data = data
+					meta.append(MetaMessage.from_bytes(bytes([0xFF, kind]) + _varlen_bytes(len(data)) + data).copy(time=delta))
+			return extract_midi_info(meta)
+		return {}
+
+
+	def close(self):
+		self._file.close()
+
+
+	def __enter__(self):
+		return self
+
+
+	def __exit__(self, *exc):
+		self.close()
+
+
+def _note_tuples(events):
+	"""
+	MidiStream._note_events() as extract_midi_tracks() 5-tuples.
+	"""
+	for _, delta, _, pitch, velocity, instrument, _, _ in events:
+		# On/off is velocity > 0, the same test extract_midi_tracks() makes.
+		yield (pitch, velocity, delta, velocity > 0, instrument)
+
+
+def _pair_notes(events, end:int=None) -> np.array:
+	"""
+	Pair up note ons and offs from MidiStream._note_events() into a TIMELINE_DTYPE array sorted 
+	by onset. Notes never turned off end at `end`, or the last event. Notes of no length are dropped.
+	"""
+	held, notes, last = {}, [], 0
+	for ticks, _, kind, pitch, velocity, _, channel, program in events:
+		last = ticks
+		if kind == 0x90 and velocity > 0:
+			held.setdefault((channel, pitch), []).append((ticks, velocity, program))
+		elif held.get((channel, pitch)):
+			# The earliest note of this pitch still held on the channel is the one that ends.
+			onset, on_velocity, on_program = held[(channel, pitch)].pop(0)
+			notes.append((onset, ticks - onset, pitch, on_velocity, channel, on_program))
+	end = last if end is None else end
+	notes += [(onset, end - onset, pitch, velocity, channel, program) 
+		for (channel, pitch), ons in held.items() for onset, velocity, program in ons]
+
+	timeline = np.array(notes, dtype=TIMELINE_DTYPE)
+	timeline = timeline[timeline["length"] > 0]
+	return timeline[np.argsort(timeline["onset"], kind="stable")]
+
+
+class TempoMap:
+	def __init__(self, changes:list, ticks_per_beat:int):
+		"""
+		Converts times in ticks to seconds in a file with tempo changes. `changes` is a list of 
+		(tick, tempo) pairs, where the tempo is in microseconds per beat, as in set_tempo messages 
+		and extract_midi_info()["tempo_map"]. Until the first change, the tempo is the MIDI 
+		default of 120 bpm. If several changes share a tick, the last one wins.
+
+		The time in seconds at which each tempo starts is added up once, so converting a tick 
+		only needs to find the tempo it falls in, which is one binary search for a whole array 
+		of ticks (see seconds()). Build it once per file, e.g. with MidiStream.tempo_map() or 
+		parse_midi(), and pass it to the renderers in mcc_waves.
+
+		>>> tempo_map = TempoMap([(0, 500000), (960, 250000)], ticks_per_beat=480)
+		>>> tempo_map.seconds([480, 960, 1440])
+		array([0.5 , 1.  , 1.25])
+		"""
+		changes = sorted(changes, key=lambda c: c[0])
+		if len(changes) == 0 or changes[0][0] > 0:
+			changes.insert(0, (0, 500000))
+		self.ticks_per_beat = ticks_per_beat
+		self.ticks = np.array([t for t, _ in changes], dtype=np.int64)
+		# Seconds per tick under each tempo, and the time in seconds at which it starts.
+		self.rates = np.array([tempo for _, tempo in changes], dtype=np.float64) / (1e6 * ticks_per_beat)
+		self.starts = np.zeros(len(changes))
+		np.cumsum(np.diff(self.ticks) * self.rates[:-1], out=self.starts[1:])
+
+
+	def seconds(self, ticks):
+		"""
+		The time in seconds of a tick, or of an array of ticks.
+		"""
+		i = np.searchsorted(self.ticks, ticks, side="right") - 1
+		return self.starts[i] + (np.asarray(ticks) - self.ticks[i]) * self.rates[i]
+
+
+	def durations(self, start, length):
+		"""
+		The length in seconds of spans of `length` ticks starting at ticks `start` (numbers or arrays). 
+		A span within one tempo is worked out from its length in ticks alone, so equally long spans 
+		under the same tempo always last the same number of seconds, exactly. Subtracting their times 
+		in the song would be off by rounding errors that grow with how far into the song they are.
+		"""
+		start, length = np.asarray(start), np.asarray(length)
+		i = np.searchsorted(self.ticks, start, side="right") - 1
+		# The tempo the span's last moment is in: a span ending on a change doesn't reach it.
+		j = np.searchsorted(self.ticks, start + length, side="left") - 1
+		return np.where(j <= i, length * self.rates[i], self.seconds(start + length) - self.seconds(start))
+
+
+	def bpm(self, ticks):
+		"""
+		The tempo in beats per minute at a tick, or at an array of ticks.
+		"""
+		i = np.searchsorted(self.ticks, ticks, side="right") - 1
+		return 60 / (self.rates[i] * self.ticks_per_beat)
+
+
+def _varlen_bytes(value:int) -> bytes:
+	"""
+	A MIDI variable-length quantity: 7 bits per byte, most significant first, 
+	with the top bit set on every byte but the last.
+	"""
+	out = [value & 0x7F]
+	value >>= 7
+	while value:
+		out.append(0x80 | (value & 0x7F))
+		value >>= 7
+	return bytes(reversed(out))
+
+
 def assign_note(beat:int, ticks_per_beat:int) -> str:
 	"""
 	Input the time (in ticks) that can be found in midi tracks, and 
@@ -138,41 +487,278 @@ def assign_note(beat:int, ticks_per_beat:int) -> str:
 		return "32"
 
 
+# The shortest length in beats of each RTTTL duration code from 16 up, as in assign_note().
+_DURATION_BEATS = np.array([0.1875, 0.375, 0.75, 1.5, 3])
+_DURATION_CODES = np.array([32, 16, 8, 4, 2, 1], dtype=np.uint8)
+
+
+def _duration_codes(ticks:np.array, ticks_per_beat:int) -> np.array:
+	"""
+	assign_note() for an array of times in ticks, as integer RTTTL duration codes (0 for no time).
+	"""
+	codes = _DURATION_CODES[np.searchsorted(_DURATION_BEATS, ticks / ticks_per_beat, side="right")]
+	codes[ticks == 0] = 0
+	return codes
+
+
+def midi_to_notes(midi_tuple_list:list, ticks_per_beat:int) -> np.array:
+	"""
+	Input ONE element of the output of extract_midi_tracks function, and the ticks_per_beat 
+	of its MidiFile. Returns its notes as a structured array of NOTE_DTYPE, the same notes 
+	midi_to_rtttl() writes out as RTTTL:
+
+	Each note lasts until the next message, so its duration is the time of the next message. 
+	Note-on messages become notes and note-off messages rests, and messages followed by no 
+	time at all are dropped. If the first message comes after some time, the track starts with 
+	a rest of that length.
+
+	All the durations are worked out in one pass over arrays of the messages' fields.
+	"""
+	if len(midi_tuple_list) == 0:
+		return np.empty(0, dtype=NOTE_DTYPE)
+	# Tuple: (note:int, velocity:int, time:int, on/off:bool, current_instrument:str)
+	n = len(midi_tuple_list)
+	pitches, times, on = (np.fromiter(map(itemgetter(i), midi_tuple_list), dtype=dtype, count=n) 
+		for i, dtype in [(0, np.int16), (2, np.int64), (3, np.bool_)])
+
+	codes = _duration_codes(times[1:], ticks_per_beat)
+	keep = np.flatnonzero(codes > 0)
+	lead = int(times[0] > 0)
+
+	notes = np.zeros(lead + len(keep), dtype=NOTE_DTYPE)
+	if lead:
+		notes[0] = (REST, _duration_codes(times[:1], ticks_per_beat)[0], False)
+	notes["pitch"][lead:] = np.where(on[keep], pitches[keep], REST)
+	notes["duration"][lead:] = codes[keep]
+	return notes
+
+
+def notes_to_rtttl(notes:np.array) -> str:
+	"""
+	Write a structured array of NOTE_DTYPE notes as a comma-separated RTTTL string. 
+	Every note gets its octave written out.
+	"""
+	if len(notes) == 0:
+		return ""
+	# Tracks use a few dozen distinct notes, so write each of those once and look the rest up.
+	names = {**MIDI2RTTTL, REST: "p"}
+	unique, inverse = np.unique(np.ascontiguousarray(notes).view(np.uint32), return_inverse=True)
+	tokens = np.array([f"{d}{names[p]}{'.' if dot else ''}" for p, d, dot in unique.view(notes.dtype).tolist()], dtype=object)
+	return ",".join(tokens[inverse])
+
+
+def rtttl_to_notes(rtttl:str, octave:int=5) -> np.array:
+	"""
+	Parse a comma-separated RTTTL string into a structured array of NOTE_DTYPE notes. 
+	Notes without a duration are quarter notes, and notes without an octave are in `octave`. 
+	The dot of a dotted note may come before or after the octave (e.g. both "4a.5" and "4a5.").
+	"""
+	pitches = dict((name, p) for p, name in MIDI2RTTTL.items())
+	notes = np.zeros(rtttl.count(",") + 1, dtype=NOTE_DTYPE)
+	for i, note in enumerate(rtttl.split(",")):
+		j = 0
+		while j < len(note) and note[j].isdigit():
+			j += 1
+		pitch = note[j:]
+		dotted = "." in pitch
+		if dotted:
+			pitch = pitch.replace(".", "")
+		assert len(pitch) > 0, f"MCC: {note} was a bad note."
+		if pitch == "p":
+			midi = REST
+		else:
+			midi = pitches[pitch if pitch[-1].isdigit() else f"{pitch}{octave}"]
+		notes[i] = (midi, int(note[:j]) if j > 0 else 4, dotted)
+	return notes
+
+
 def midi_to_rtttl(midi_tuple_list:list, ticks_per_beat:int) -> str:
 	"""
 	Input ONE element of the output of extract_midi_tracks function. i.e. just one list should be the input.
 	Specify ticks_per_beat of a MidiFile object `mid` as `mid.ticks_per_beat`.
 
-	Returns RTTTL string of the midi note list.
+	Returns RTTTL string of the midi note list. This is midi_to_notes() written out with notes_to_rtttl().
 	"""
+	return notes_to_rtttl(midi_to_notes(midi_tuple_list, ticks_per_beat))
 
-	rtttlList = ""
 
-	# Tuple: (note:int, velocity:int, time:int, on/off:bool, current_instrument:str)
-	for i, tuple in enumerate(midi_tuple_list):
-		# Check first MIDI note for offset time from the start. Only add a "rest" if the time value > 0.
-		if i == 0 and tuple[2] > 0:
-			# Insert RTTTL rest with duration based on initial time.
-			rtttlList += "," + assign_note(tuple[2], ticks_per_beat) + "p"
-
-		# skipping the last element, since there's no next tuple's time
-		if i == len(midi_tuple_list) - 1:
-			break
-		
-		# note on
-		next_tuple = midi_tuple_list[i + 1]
-		beat_in_note = assign_note(next_tuple[2], ticks_per_beat)
-		if beat_in_note == "0":
+# Version of what parse_midi() returns. Bump it whenever a change to the parser changes 
+# its output, so that results cached by an older parser are no longer used.
+def extend_timelines(timelines:list, generated:list, ticks_per_beat:int, time_signature:int=4) -> list:
+	"""
+	Each of a song's timelines (see MidiStream.timelines()) followed by the notes generated for 
+	its track, a NOTE_DTYPE array (see midi_to_notes()) or None for none. So the tracks stay in 
+	step, every track's generated notes start together when the song ends, and are laid end to 
+	end from there, with rests as gaps. Each note starts on the tick nearest its exact position, 
+	rather than after the rounded lengths of the notes before it, so rounding can't build up. 
+	Generated notes are played like the last note of their track (velocity, channel and program).
+	"""
+	end = max((int((t["onset"] + t["length"]).max()) for t in timelines if len(t) > 0), default=0)
+	extended = []
+	for timeline, notes in zip(timelines, generated):
+		if notes is None or len(notes) == 0:
+			extended.append(timeline)
 			continue
-
-		if tuple[3] == True:
-			newNote = beat_in_note + MIDI2RTTTL.get(tuple[0]) # time of next tuple + note
-			rtttlList += "," + newNote
-		
-		# note off
+		ticks = time_signature * ticks_per_beat / notes["duration"].astype(np.float64) * np.where(notes["dotted"], 1.5, 1.0)
+		bounds = np.rint(end + np.concatenate(([0.0], np.cumsum(ticks)))).astype(np.int64)
+		added = np.zeros(len(notes), dtype=TIMELINE_DTYPE)
+		added["onset"], added["length"], added["pitch"] = bounds[:-1], np.diff(bounds), notes["pitch"]
+		if len(timeline) > 0:
+			added[["velocity", "channel", "program"]] = timeline[-1][["velocity", "channel", "program"]]
 		else:
-			newNote = beat_in_note + "p"
-			if beat_in_note != "0":
-				rtttlList += "," + newNote
-	
-	return rtttlList[1:]	# removing the first comma
+			added["velocity"] = 64
+		added = added[(notes["pitch"] != REST) & (added["length"] > 0)]
+		extended.append(np.concatenate((timeline, added)))
+	return extended
+
+
+PARSER_VERSION = 4
+
+
+def parse_midi(filepath:str) -> dict:
+	"""
+	Everything MCC needs from a MIDI file, read with MidiStream: 
+		"ticks_per_beat": the file's ticks per beat,
+		"info": extract_midi_info() of its first track,
+		"tempo_map": its TempoMap, built from info["tempo_map"],
+		"tracks": a list of midi_to_notes() arrays, one per track that has notes,
+		"timelines": the same tracks as TIMELINE_DTYPE arrays (see MidiStream.timelines()).
+	Each track is only read once for both.
+	"""
+	with MidiStream(filepath) as stream:
+		info = stream.info()
+		parsed = {"ticks_per_beat": stream.ticks_per_beat, "info": info, 
+			"tempo_map": TempoMap(info.get("tempo_map", []), stream.ticks_per_beat), "tracks": [], "timelines": []}
+		stream._reset_programs()
+		for size in stream._chunks():
+			events = list(stream._note_events(size))
+			if len(events) > 0:
+				parsed["tracks"].append(midi_to_notes(list(_note_tuples(events)), stream.ticks_per_beat))
+				parsed["timelines"].append(_pair_notes(events))
+		return parsed
+
+
+class ParseCache:
+	def __init__(self, directory:str="../out/.midi_cache/", max_bytes:int=256*2**20):
+		"""
+		An on-disk cache of parse_midi() results, so files that were parsed before are not parsed 
+		again, by this process or any other using the same directory.
+
+		Entries are keyed by the SHA-256 of the file's contents and PARSER_VERSION, so a renamed 
+		or copied file still hits, an edited file misses, and everything cached by another version 
+		of the parser is ignored (and deleted when the cache is next trimmed). Each entry is one 
+		uncompressed .npz file holding the note and timeline arrays of every track and the rest as JSON, and 
+		is written to a temporary file first, so readers never see half an entry.
+
+		When the entries take up more than `max_bytes`, the least recently used are deleted. 
+		Use counts as a file's modification time, which a hit updates.
+
+		>>> cache = ParseCache()
+		>>> song = cache.parse("./data/Smbtheme.mid")	# Parsed, then stored.
+		>>> song = cache.parse("./data/Smbtheme.mid")	# Loaded, without parsing.
+		"""
+		assert max_bytes > 0, "MCC: Cache limit must be positive."
+		self.directory = directory
+		self.max_bytes = max_bytes
+		self.hits = 0
+		self.misses = 0
+		self.evictions = 0
+
+
+	def key(self, filepath:str) -> str:
+		"""
+		The name of a file's entry: the hash of its contents and the parser version.
+		"""
+		digest = hashlib.sha256()
+		with open(filepath, "rb") as f:
+			for block in iter(lambda: f.read(2**20), b""):
+				digest.update(block)
+		return f"{digest.hexdigest()}-v{PARSER_VERSION}.npz"
+
+
+	def parse(self, filepath:str) -> dict:
+		"""
+		parse_midi() of a file, loaded from the cache if it is there, otherwise parsed and stored.
+		"""
+		path = os.path.join(self.directory, self.key(filepath))
+		try:
+			with np.load(path) as entry:
+				parsed = json.loads(entry["meta"].tobytes().decode("utf-8"))
+				n = parsed.pop("n_tracks")
+				parsed["tracks"] = [entry[f"track{i}"] for i in range(n)]
+				parsed["timelines"] = [entry[f"timeline{i}"] for i in range(n)]
+			# Tuples came back from JSON as lists.
+			info = dict((k, tuple(v) if isinstance(v, list) else v) for k, v in parsed["info"].items())
+			info["tempo_map"] = [tuple(change) for change in info.get("tempo_map", ())]
+			parsed["info"] = info
+			parsed["tempo_map"] = TempoMap(info["tempo_map"], parsed["ticks_per_beat"])
+			os.utime(path)
+			self.hits += 1
+			return parsed
+		except (OSError, KeyError, ValueError, EOFError, zipfile.BadZipFile):
+			# Not cached, or cut short or damaged somehow: parse it again.
+			pass
+
+		self.misses += 1
+		parsed = parse_midi(filepath)
+		meta = {"ticks_per_beat": parsed["ticks_per_beat"], "info": parsed["info"], "n_tracks": len(parsed["tracks"])}
+		arrays = dict((f"track{i}", notes) for i, notes in enumerate(parsed["tracks"]))
+		arrays.update((f"timeline{i}", timeline) for i, timeline in enumerate(parsed["timelines"]))
+		arrays["meta"] = np.frombuffer(json.dumps(meta).encode("utf-8"), dtype=np.uint8)
+
+		os.makedirs(self.directory, exist_ok=True)
+		# A temporary file of its own, since other threads and processes may be storing the same entry.
+		fd, tmp = tempfile.mkstemp(dir=self.directory, suffix=".tmp")
+		try:
+			with os.fdopen(fd, "wb") as f:
+				np.savez(f, **arrays)
+			os.replace(tmp, path)
+		except OSError:
+			# Losing a race to store the entry is fine: whoever won stored the same thing.
+			if os.path.exists(tmp):
+				os.remove(tmp)
+		self.trim()
+		return parsed
+
+
+	def trim(self):
+		"""
+		Delete entries of other parser versions, then the least recently used entries 
+		until the rest fit in max_bytes.
+		"""
+		entries = []
+		for name in os.listdir(self.directory):
+			path = os.path.join(self.directory, name)
+			if not name.endswith(".npz"):
+				continue
+			try:
+				if not name.endswith(f"-v{PARSER_VERSION}.npz"):
+					os.remove(path)
+					continue
+				stat = os.stat(path)
+			except OSError:
+				# Another process got there first.
+				continue
+			entries.append((stat.st_mtime, stat.st_size, path))
+
+		total = sum(size for _, size, _ in entries)
+		for _, size, path in sorted(entries):
+			if total <= self.max_bytes:
+				break
+			try:
+				os.remove(path)
+				self.evictions += 1
+			except OSError:
+				pass
+			total -= size
+
+
+	def stats(self) -> dict:
+		"""
+		Hit, miss and eviction counts of this cache object.
+		"""
+		return {"hits": self.hits, "misses": self.misses, "evictions": self.evictions}
+
+
+# Cache used by the interface, relative to where it runs like the rest of its output.
+PARSE_CACHE = ParseCache()
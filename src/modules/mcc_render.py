@@ -0,0 +1,140 @@
+# mcc_render.py
+# Rendering songs on several cores at once.
+# - A song's timelines are cut into segments of time, and each segment of each
+# 	track (or of every track at once, when mixing) is rendered by one worker.
+# - Workers add their samples straight into one output buffer, each into its own
+# 	slice, so no two workers ever write the same samples and nothing is sent back.
+# 	Process workers share the buffer through multiprocessing.shared_memory.
+# - Tracks of notes (rather than timelines) are rendered one per thread.
+#
+
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from multiprocessing import shared_memory
+import numpy as np
+from modules import mcc_waves
+
+
+def segments(total:int, segment_size:int) -> list:
+	"""
+	(start, stop) sample ranges of consecutive segments of at most segment_size samples covering total samples.
+	"""
+	return [(a, min(a + segment_size, total)) for a in range(0, total, segment_size)]
+
+
+def _segment_tracks(tracks:list, reaches:list, start:int, stop:int) -> list:
+	"""
+	The (timeline, envelope, offsets) tracks cut down to the notes that can sound between samples 
+	start and stop. Timelines are sorted by onset, so the notes starting before stop come first, 
+	and each track's `reaches` (the furthest any note up to each one ends) only rise, so the 
+	notes over by start come first too. Both ends are found with searchsorted.
+	"""
+	cut = []
+	for (timeline, envelope, (starts, lengths)), reach in zip(tracks, reaches):
+		a, b = reach.searchsorted(start, side="right"), starts.searchsorted(stop)
+		cut.append((timeline[a:b], envelope, (starts[a:b], lengths[a:b])))
+	return cut
+
+
+def _render_segment(out:np.array, start:int, tracks:list, tempo_map, kwargs:dict):
+	"""
+	Worker: add samples start, start+1, ... of each (timeline, envelope, offsets) track into out,
+	where offsets are the timeline_offsets() of the track.
+	"""
+	for timeline, envelope, offsets in tracks:
+		mcc_waves.add_timeline(out, timeline, tempo_map, start, envelope=envelope, offsets=offsets, **kwargs)
+
+
+def _render_shared(name:str, shape:tuple, dtype:str, row:int, start:int, stop:int, tracks:list, tempo_map, kwargs:dict):
+	"""
+	Process worker: _render_segment() into a slice of the output buffer in shared memory `name`.
+	"""
+	shm = shared_memory.SharedMemory(name=name)
+	try:
+		out = np.ndarray(shape, dtype=dtype, buffer=shm.buf)
+		_render_segment((out if row is None else out[row])[start:stop], start, tracks, tempo_map, kwargs)
+		del out
+	finally:
+		shm.close()
+
+
+def render_parallel(timelines:list, tempo_map, wave_function=mcc_waves.square_wave, do_envl:bool=True, sr:int=44100,
+		dtype=np.float64, envelope=mcc_waves.DEFAULT_ENVELOPE, mix:bool=True, workers:int=None, executor:str="thread",
+		segment_seconds:float=10.0):
+	"""
+	Render tracks of timed notes like mcc_waves.timeline_to_waveform(), split across `workers`
+	threads or processes (default: one per CPU). The result has the same samples.
+
+	:param: executor, "thread" or "process". NumPy lets go of the GIL while it works on
+		arrays, so threads are enough when notes are long. Processes also run the Python
+		that glues notes together in parallel, at the cost of starting them up and each
+		having its own note cache. With processes, the wave function has to be picklable
+		(a module-level function or a Wavetable, not a lambda).
+	:param: segment_seconds, the length of the segments the song is cut into. Shorter
+		segments balance the work better, but notes crossing a segment boundary are
+		rendered once for each segment they are in.
+	:param: mix, if True, return every track added into one buffer, with each task rendering
+		one segment of all tracks. If False, return a list of one buffer per track, with each
+		task rendering one segment of one track.
+
+	The other params are as for timeline_to_waveform(). Oscillators carry their phase from
+	note to note, so they can't be split up and aren't accepted.
+
+	>>> song = mcc_parser.parse_midi("./data/zeldaund.mid")
+	>>> res = render_parallel(song["timelines"], song["tempo_map"], workers=4)
+	"""
+	assert executor in ("thread", "process"), "MCC: executor must be 'thread' or 'process'."
+	assert not isinstance(wave_function, mcc_waves.Oscillator), "MCC: Oscillators can't be rendered in parallel."
+	assert segment_seconds > 0, "MCC: segment_seconds must be positive."
+	# Converting ticks to samples is done once per track here, not again for every segment.
+	offsets = [mcc_waves.timeline_offsets(timeline, tempo_map, sr) for timeline in timelines]
+	total = mcc_waves.timeline_length(timelines, tempo_map, sr, offsets=offsets)
+	shape = (total,) if mix else (len(timelines), total)
+	envelopes = envelope if isinstance(envelope, (list, tuple)) else [envelope] * len(timelines)
+	tracks = list(zip(timelines, envelopes, offsets))
+	reaches = [np.maximum.accumulate(starts + lengths) for starts, lengths in offsets]
+	kwargs = dict(wave_function=wave_function, do_envl=do_envl, sr=sr)
+
+	# Each task is (row of the output or None, start, stop, the (timeline, envelope, offsets) tracks to render), 
+	# with only the notes of the segment, so process workers aren't sent the whole song every time.
+	spans = segments(total, max(1, int(segment_seconds * sr)))
+	if mix:
+		tasks = [(None, a, b, _segment_tracks(tracks, reaches, a, b)) for a, b in spans]
+	else:
+		tasks = [(i, a, b, _segment_tracks([track], [reaches[i]], a, b)) for i, track in enumerate(tracks) for a, b in spans]
+
+	if executor == "thread":
+		out = np.zeros(shape, dtype=dtype)
+		with ThreadPoolExecutor(max_workers=workers) as pool:
+			futures = [pool.submit(_render_segment, (out if row is None else out[row])[a:b], a, task_tracks, tempo_map, kwargs)
+				for row, a, b, task_tracks in tasks]
+			for future in futures:
+				future.result()
+	else:
+		shm = shared_memory.SharedMemory(create=True, size=max(1, int(np.prod(shape)) * np.dtype(dtype).itemsize))
+		try:
+			view = np.ndarray(shape, dtype=dtype, buffer=shm.buf)
+			view[...] = 0
+			with ProcessPoolExecutor(max_workers=workers) as pool:
+				futures = [pool.submit(_render_shared, shm.name, shape, np.dtype(dtype).str, row, a, b, task_tracks, tempo_map, kwargs)
+					for row, a, b, task_tracks in tasks]
+				for future in futures:
+					future.result()
+			out = view.copy()
+			del view
+		finally:
+			shm.close()
+			shm.unlink()
+	return out if mix else list(out)
+
+
+def notes_to_waveforms(tracks:list, bpm:float, workers:int=None, **kwargs) -> list:
+	"""
+	mcc_waves.notes_to_waveform() of each track of notes, rendered on a pool of `workers` 
+	threads (default: one per track), in the same order as `tracks`. The other keyword 
+	arguments are passed on to notes_to_waveform(). The tracks share the note cache, 
+	which is safe across threads.
+	"""
+	if len(tracks) == 0:
+		return []
+	with ThreadPoolExecutor(max_workers=workers or len(tracks)) as pool:
+		return list(pool.map(lambda track: mcc_waves.notes_to_waveform(track, bpm, **kwargs), tracks))
@@ -1,6 +1,9 @@
 # mcc_waves.py
 # Functions to create and manipulate waves, envelopes, and frequencies.
 
+import math
+import threading
+from collections import OrderedDict
 import numpy as np
 from scipy import signal
 
@@ -58,6 +61,266 @@ def sawtooth_wave(freq:float, dur:float=1.0, sr:float=44100) -> np.array:
 	return signal.sawtooth(2 * freq * np.pi * t)
 
 
+# The wave functions above by name, for choosing one from the command line or a request.
+WAVES = {"triangle": triangle_wave, "square": square_wave, "sawtooth": sawtooth_wave}
+
+
+def square_shape(phase:np.array) -> np.array:
+	"""
+	One cycle of square_wave as a function of phase in [0, 1).
+	"""
+	return np.where(phase < 0.5, 1.0, -1.0)
+
+
+def pulse_shape(phase:np.array, duty:float=0.5) -> np.array:
+	"""
+	One cycle of a pulse wave that is high for the first `duty` of the cycle, as a function 
+	of phase in [0, 1). A duty of 0.5 is square_shape. The NES pulse channels also have 
+	0.125 and 0.25, which sound thinner and more nasal.
+	"""
+	return np.where(phase < duty, 1.0, -1.0)
+
+
+# Coefficients of x, x^3, x^5, x^7 in (8/pi^2)(x - sin3/9 + sin5/25 - sin7/49) with x = sin(phase), 
+# from sin3 = 3x - 4x^3, sin5 = 5x - 20x^3 + 16x^5 and sin7 = 7x - 56x^3 + 112x^5 - 64x^7.
+_TRIANGLE_POLY = tuple(np.float32((8/(np.pi**2))*c) for c in (1 - 3/9 + 5/25 - 7/49, 4/9 - 20/25 + 56/49, 16/25 - 112/49, 64/49))
+
+
+def triangle_shape(phase:np.array) -> np.array:
+	"""
+	One cycle of the 4-harmonic triangle_wave as a function of phase in [0, 1).
+	"""
+	# sin(3x), sin(5x) and sin(7x) are odd polynomials in sin(x), so the harmonic sum 
+	# collapses to one np.sin pass and a Horner evaluation, all done in place. The wrapped 
+	# phase needs no more than float32 precision, which is several times faster for np.sin.
+	x = np.multiply(phase, 2*np.pi, dtype=np.float32)
+	np.sin(x, out=x)
+	a1, a3, a5, a7 = _TRIANGLE_POLY
+	x2 = x * x
+	y = x2 * a7
+	y += a5
+	y *= x2
+	y += a3
+	y *= x2
+	y += a1
+	y *= x
+	return y
+
+
+def sawtooth_shape(phase:np.array) -> np.array:
+	"""
+	One cycle of sawtooth_wave as a function of phase in [0, 1).
+	"""
+	return 2*phase - 1
+
+
+class Oscillator:
+	def __init__(self, shape=square_shape, block_size:int=2**16):
+		"""
+		A phase-accumulating oscillator for rendering a whole voice (track) at a time.
+
+		The wave functions above build a fresh np.arange time vector for every note and 
+		start each note at phase zero. An Oscillator instead keeps a running phase between 
+		notes, so consecutive notes join without a jump, and computes the phase of each 
+		sample directly from the note's start phase. This avoids per-note allocations and 
+		the drift that comes from stepping time by 1/sr.
+
+		`shape` maps an array of phases in [0, 1) to samples, e.g. square_shape. Samples 
+		are generated `block_size` at a time for all notes in the block at once. Rests 
+		(frequency 0) are silent and hold the phase.
+
+		Use one Oscillator per voice. It can be passed anywhere a wave function is accepted:
+
+		>>> res = notes_to_waveform(track, bpm=120, wave_function=Oscillator(triangle_shape))
+		"""
+		assert block_size > 0, "MCC: block_size must be positive."
+		self.shape = shape
+		self.block_size = block_size
+		self.phase = 0.0
+
+
+	def reset(self):
+		"""
+		Restart the voice at phase zero.
+		"""
+		self.phase = 0.0
+
+
+	def render(self, freqs:np.array, lengths:np.array, sr:int=44100, dtype=np.float64) -> np.array:
+		"""
+		Render consecutive notes, given their frequencies and lengths in samples, 
+		into one array. The running phase carries over from the previous call.
+		"""
+		freqs = np.asarray(freqs, dtype=np.float64)
+		lengths = np.asarray(lengths, dtype=np.int64)
+		out = np.empty(int(lengths.sum()), dtype=dtype)
+		if len(lengths) == 0:
+			return out
+
+		# Phase increment per sample of each note, and the phase each note starts at.
+		# Phases are kept in cycles and wrapped, so they never grow large enough to lose precision.
+		incs = freqs / sr
+		advance = np.mod(incs * lengths, 1.0)
+		starts_phase = np.mod(self.phase + np.concatenate(([0.0], np.cumsum(advance))), 1.0)
+		self.phase = float(starts_phase[-1])
+		ends = np.cumsum(lengths)
+
+		if self.shape is square_shape:
+			return _square_runs(incs, lengths, starts_phase[:-1], dtype)
+
+		# Group consecutive notes into blocks of roughly block_size samples. 
+		# A note longer than a block gets a block to itself.
+		first = 0
+		while first < len(lengths):
+			base = ends[first] - lengths[first]
+			last = max(first + 1, int(np.searchsorted(ends, base + self.block_size, side="right")))
+			lens = lengths[first:last]
+			n = int(ends[last-1] - base)
+
+			# Sample j of a note has phase start + j*inc, computed directly rather than accumulated. 
+			# Written relative to the block, that is i*inc + (start - offset*inc) for block sample i.
+			offsets = ends[first:last] - lens - base
+			phase = np.arange(n, dtype=np.float64)
+			phase *= np.repeat(incs[first:last], lens)
+			phase += np.repeat(starts_phase[first:last] - offsets*incs[first:last], lens)
+			phase -= np.floor(phase)
+			block = self.shape(phase)
+
+			for r in np.flatnonzero(incs[first:last] == 0):
+				block[offsets[r]:offsets[r]+lens[r]] = 0.0
+			out[base:base+n] = block
+			first = last
+		return out
+
+
+	def __call__(self, freq:float, dur:float=1.0, sr:float=44100) -> np.array:
+		"""
+		Render a single note with the same number of samples as the wave functions above.
+		"""
+		return self.render([freq], [math.ceil(dur / (1.0/sr))], sr)
+
+
+def _square_runs(incs:np.array, lengths:np.array, starts:np.array, dtype=np.float64) -> np.array:
+	"""
+	Square wave samples of consecutive notes, given each note's phase increment per sample, length 
+	in samples and start phase. Same samples as Oscillator(square_shape), short of samples that 
+	fall right on an edge, where rounding can go either way.
+
+	A square wave is runs of 1.0 and -1.0, flipping every half cycle, so rather than working 
+	out the phase of every sample, only the samples where it flips are found (one per half 
+	cycle, far fewer than the samples), and the runs between them are written with one np.repeat.
+	"""
+	n = len(lengths)
+	# In half cycles, a note's phase goes from u0 at its first sample to u1 at its last. The 
+	# wave is high while floor(u) is even, and flips at each integer in between.
+	u0 = 2.0 * starts
+	du = 2.0 * incs
+	u1 = u0 + np.maximum(lengths - 1, 0) * du
+	sounding = (incs > 0) & (lengths > 0)
+	flips = np.where(sounding, np.floor(u1) - np.floor(u0), 0).astype(np.int64)
+
+	# Flip f of note r is at the first sample j with u0 + j*du >= floor(u0) + f.
+	note = np.repeat(np.arange(n), flips)
+	f = np.arange(int(flips.sum())) - np.repeat(np.cumsum(flips) - flips, flips) + 1
+	at = np.ceil((np.floor(u0[note]) + f - u0[note]) / du[note])
+	at = np.clip(at, 0, lengths[note]).astype(np.int64)
+
+	# Each note is flips + 1 runs: they end at its flips, then at its last sample.
+	runs = flips + 1
+	last = np.cumsum(runs) - 1
+	ends = np.empty(int(runs.sum()), dtype=np.int64)
+	is_flip = np.ones(len(ends), dtype=bool)
+	is_flip[last] = False
+	ends[is_flip] = at
+	ends[last] = lengths
+	begins = np.concatenate(([0], ends[:-1]))
+	begins[last[:-1] + 1] = 0
+
+	# Runs alternate, starting high if the note starts in the first half of a cycle. Rests are one silent run.
+	q = np.arange(len(ends)) - np.repeat(last - flips, runs)
+	level = 1.0 - 2.0 * ((np.repeat(np.floor(u0), runs) + q) % 2)
+	level[~np.repeat(sounding, runs)] = 0.0
+	return np.repeat(level.astype(dtype), ends - begins)
+
+
+class Wavetable:
+	# Harmonic amplitudes of each band-limited waveform, given the harmonic numbers n.
+	HARMONICS = {
+		"square": lambda n: np.where(n % 2 == 1, 4/(np.pi*n), 0.0),
+		"triangle": lambda n: np.where(n % 2 == 1, (8/(np.pi**2)) * (-1.0)**((n-1)//2) / n**2, 0.0),
+		"sawtooth": lambda n: -2/(np.pi*n),
+	}
+
+	def __init__(self, kind:str="square", size:int=2048, base_freq:float=16.0, octaves:int=11):
+		"""
+		Band-limited wavetable synthesis for square, triangle and sawtooth waves.
+
+		square_wave and sawtooth_wave jump instantly, so their harmonics run past the 
+		Nyquist frequency and fold back as aliasing, while triangle_wave pays for four 
+		np.sin passes per note. A Wavetable precomputes one cycle of the waveform per 
+		octave, summing only the harmonics that stay below Nyquist for the top of that 
+		octave, and reads notes out of it with linear interpolation. Each note costs a 
+		single lookup pass.
+
+		Octave i covers [base_freq*2^i, base_freq*2^(i+1)). Tables are built lazily for 
+		each sampling rate they are asked to render at. Like the other wave functions, a 
+		Wavetable can be passed as `wave_function`:
+
+		>>> res = notes_to_waveform(track, bpm=120, wave_function=Wavetable("triangle"))
+		"""
+		assert kind in self.HARMONICS, f"MCC: No wavetable for {kind} waves."
+		assert size > 2 and size & (size - 1) == 0, "MCC: Wavetable size must be a power of two."
+		assert octaves > 0, "MCC: Wavetable octave count must be positive."
+		self.kind = kind
+		self.size = size
+		self.base_freq = base_freq
+		self.octaves = octaves
+		self._tables = {}
+
+
+	def tables(self, sr:int=44100) -> np.array:
+		"""
+		The (octaves, size+1) array of single-cycle tables for a sampling rate. 
+		The extra sample repeats the first so interpolation never wraps around.
+		"""
+		if sr not in self._tables:
+			tables = np.empty((self.octaves, self.size + 1))
+			for o in range(self.octaves):
+				top = self.base_freq * 2**(o+1)
+				n = np.arange(1, max(1, min(int((sr/2) // top), self.size//2 - 1)) + 1)
+				# One cycle from the harmonic series: a sine component of amplitude a at 
+				# bin n is -i*a*size/2 in the spectrum that irfft turns back into samples.
+				spectrum = np.zeros(self.size//2 + 1, dtype=complex)
+				spectrum[n] = -0.5j * self.size * self.HARMONICS[self.kind](n)
+				tables[o, :-1] = np.fft.irfft(spectrum, self.size)
+				tables[o, -1] = tables[o, 0]
+			self._tables[sr] = tables
+		return self._tables[sr]
+
+
+	def __call__(self, freq:float, dur:float=1.0, sr:float=44100) -> np.array:
+		"""
+		Render a note with the same number of samples as the other wave functions.
+		"""
+		n = math.ceil(dur / (1.0/sr))
+		octave = 0 if freq <= self.base_freq else min(int(math.log2(freq / self.base_freq)), self.octaves - 1)
+		table = self.tables(sr)[octave]
+
+		# Table position of each sample, split into an index and an interpolation weight. 
+		# The size is a power of two, so wrapping the index around the cycle is a bitmask.
+		pos = np.arange(n, dtype=np.float64)
+		pos *= freq * self.size / sr
+		i = pos.astype(np.int64)
+		pos -= i
+		i &= self.size - 1
+		lo = table.take(i)
+		wave = table.take(i + 1)
+		wave -= lo
+		wave *= pos
+		wave += lo
+		return wave
+
+
 def adsr_envelope(duration:float, props:list=[0.1,0.3,0.5], sr:int=44100) -> np.array:
 	"""
 	Creates an ASDR (attack-decay-sustain-release) envelope for a given duration 
@@ -73,30 +336,11 @@ def adsr_envelope(duration:float, props:list=[0.1,0.3,0.5], sr:int=44100) -> np.
 	props[0] : proportion of time for attack stage
 	props[1] : proportion of time for decay stage
 	props[2] : proportion of time for sustain stage
-	"""
-	assert sum(props) <= 1.0 and all(p > 0 for p in props), "MCC: Each time proportion must be non-negative and sum not over 1.0."
 
-	n_attack = 0
-	t_decay = props[0] * duration
-	t_sustain = t_decay + (props[1]*duration)
-	t_release = t_sustain + (props[2]*duration)
-	
-	n_decay = int(t_decay * sr)
-	n_sustain = int(t_sustain * sr)
-	n_release = int(t_release * sr)
-	n_end = int(duration*sr)
-	
-	ampl_attack = 1.0
-	ampl_sustain = 0.3
-	ampl_end = 0.01
-	ampl = np.zeros(n_end)
-	
-	ampl[n_attack:n_decay] = np.geomspace(0.1, ampl_attack, n_decay-n_attack)
-	ampl[n_decay:n_sustain] = np.geomspace(ampl_attack, ampl_sustain, n_sustain-n_decay)
-	ampl[n_sustain:n_release] = ampl_sustain
-	ampl[n_release:] = np.geomspace(ampl_sustain, ampl_end, n_end-n_release)
-	
-	return ampl
+	The amplitude rises from 0.1 to 1.0, decays to 0.3, holds, then fades to 0.01. 
+	See Envelope for other levels, and for reusing envelopes across notes.
+	"""
+	return Envelope(props).render(duration, sr)
 
 
 def _split_note(note_st:str) -> tuple:
@@ -111,23 +355,243 @@ def _split_note(note_st:str) -> tuple:
 	raise Exception(f"MCC: {note_st} was a bad note.")
 
 
-def notes_to_waveform(notes:list, bpm:float, time_signature:int=4, octave:int=5, wave_function=square_wave, do_envl:bool=True) -> np.array:
+
+class NoteCache:
+	def __init__(self, max_bytes:int=64*2**20, max_entries:int=4096):
+		"""
+		A bounded LRU cache of rendered note buffers. Chiptune tracks repeat the same 
+		few dozen notes, so rendering each distinct note once and copying it out of 
+		the cache afterwards saves most of the work in notes_to_waveform.
+
+		Entries are keyed by whatever the caller passes in, typically 
+		(wave function, frequency, duration, sample rate, envelope). Cached buffers 
+		are read-only so they can be handed out without copying. When either 
+		`max_bytes` or `max_entries` would be exceeded, the least recently used 
+		buffers are evicted first. A single lock guards the table, so one cache 
+		can be shared by tracks rendered on several threads.
+
+		>>> cache = NoteCache(max_bytes=2**20)
+		>>> key = (square_wave, 440.0, 0.25, 44100, False)
+		>>> wave = cache.get_or_render(key, lambda: square_wave(440.0, 0.25))
+		>>> cache.stats()
+		{'hits': 0, 'misses': 1, 'evictions': 0, 'entries': 1, 'bytes': 88200}
+		"""
+		assert max_bytes > 0 and max_entries > 0, "MCC: Cache limits must be positive."
+		self.max_bytes = max_bytes
+		self.max_entries = max_entries
+		self._entries = OrderedDict()
+		self._lock = threading.Lock()
+		self._nbytes = 0
+		self.hits = 0
+		self.misses = 0
+		self.evictions = 0
+
+
+	def get(self, key) -> np.array:
+		"""
+		Return the read-only buffer stored under key, or None if it is not cached.
+		"""
+		with self._lock:
+			wave = self._entries.get(key)
+			if wave is None:
+				self.misses += 1
+			else:
+				self.hits += 1
+				self._entries.move_to_end(key)
+			return wave
+
+
+	def put(self, key, wave:np.array) -> np.array:
+		"""
+		Store a buffer under key and return the read-only version that was cached. 
+		Buffers bigger than the whole cache are returned as they are, without being stored.
+		"""
+		wave = np.asarray(wave)
+		if wave.nbytes > self.max_bytes:
+			return wave
+		wave.setflags(write=False)
+
+		with self._lock:
+			if key in self._entries:
+				self._nbytes -= self._entries.pop(key).nbytes
+			self._entries[key] = wave
+			self._nbytes += wave.nbytes
+			while self._nbytes > self.max_bytes or len(self._entries) > self.max_entries:
+				_, old = self._entries.popitem(last=False)
+				self._nbytes -= old.nbytes
+				self.evictions += 1
+		return wave
+
+
+	def get_or_render(self, key, render) -> np.array:
+		"""
+		Return the buffer stored under key, calling render() to create it on a miss.
+		Rendering happens outside the lock, so other threads are not held up by it.
+		"""
+		wave = self.get(key)
+		if wave is None:
+			wave = self.put(key, render())
+		return wave
+
+
+	def stats(self) -> dict:
+		"""
+		Hit, miss and eviction counts, as well as the current size of the cache.
+		"""
+		with self._lock:
+			return {"hits": self.hits, "misses": self.misses, "evictions": self.evictions, 
+				"entries": len(self._entries), "bytes": self._nbytes}
+
+
+	def clear(self):
+		"""
+		Drop every cached buffer and reset the statistics.
+		"""
+		with self._lock:
+			self._entries.clear()
+			self._nbytes = 0
+			self.hits = self.misses = self.evictions = 0
+
+
+# Cache shared by every call to notes_to_waveform unless another one is passed in.
+NOTE_CACHE = NoteCache()
+
+# Envelope templates, shared by every Envelope unless another cache is passed in.
+ENVELOPE_CACHE = NoteCache(max_bytes=32*2**20)
+
+
+class Envelope:
+	def __init__(self, props:tuple=(0.1, 0.3, 0.5), levels:tuple=(0.1, 1.0, 0.3, 0.01)):
+		"""
+		An ADSR (attack-decay-sustain-release) envelope, stretched to the length of each note.
+
+		`props` are the proportions of the note spent in attack, decay and sustain, as for 
+		adsr_envelope(); release takes the rest. `levels` are the amplitudes at the start of 
+		the attack, at its peak, while sustaining, and at the end of the release. Attack, 
+		decay and release are geometric, so every level must be positive. The defaults 
+		are the same as adsr_envelope().
+
+		An envelope only depends on the note's duration, and songs repeat the same few 
+		durations, so the envelope for each (duration, sampling rate) is rendered once as a 
+		read-only template and kept in a NoteCache. apply() then multiplies a note's samples 
+		by the template in place, with no temporary arrays:
+
+		>>> pluck = Envelope(props=(0.02, 0.2, 0.5), levels=(0.1, 1.0, 0.2, 0.01))
+		>>> res = notes_to_waveform(track, bpm=120, envelope=pluck)
+		"""
+		assert len(props) == 3 and sum(props) <= 1.0 and all(p > 0 for p in props), \
+			"MCC: Each time proportion must be non-negative and sum not over 1.0."
+		assert len(levels) == 4 and all(l > 0 for l in levels), "MCC: Envelope levels must be positive."
+		self.props = tuple(props)
+		self.levels = tuple(levels)
+
+
+	def __eq__(self, other) -> bool:
+		return isinstance(other, Envelope) and (self.props, self.levels) == (other.props, other.levels)
+
+
+	def __hash__(self) -> int:
+		return hash((self.props, self.levels))
+
+
+	def render(self, duration:float, sr:int=44100) -> np.array:
+		"""
+		The envelope of a note of the given duration, int(duration*sr) samples long.
+		"""
+		t_decay = self.props[0] * duration
+		t_sustain = t_decay + (self.props[1]*duration)
+		t_release = t_sustain + (self.props[2]*duration)
+
+		n_decay = int(t_decay * sr)
+		n_sustain = int(t_sustain * sr)
+		n_release = int(t_release * sr)
+		n_end = int(duration*sr)
+
+		# Every sample is written by one of the segments below.
+		start, peak, sustain, end = self.levels
+		ampl = np.empty(n_end)
+		ampl[:n_decay] = np.geomspace(start, peak, n_decay)
+		ampl[n_decay:n_sustain] = np.geomspace(peak, sustain, n_sustain-n_decay)
+		ampl[n_sustain:n_release] = sustain
+		ampl[n_release:] = np.geomspace(sustain, end, n_end-n_release)
+		return ampl
+
+
+	def template(self, duration:float, sr:int=44100, cache:NoteCache=ENVELOPE_CACHE) -> np.array:
+		"""
+		The read-only envelope of a note of the given duration, rendered on the first call 
+		and looked up from `cache` afterwards. Pass cache=None to always render it.
+		"""
+		if cache is None:
+			return self.render(duration, sr)
+		return cache.get_or_render((Envelope, self, duration, sr), lambda: self.render(duration, sr))
+
+
+	def apply(self, out:np.array, duration:float, sr:int=44100, offset:int=0, cache:NoteCache=ENVELOPE_CACHE) -> np.array:
+		"""
+		Multiply `out`, samples offset, offset+1, ... of a note of the given duration, by the 
+		envelope in place, and return it. Samples past the end of the envelope are silenced.
+		"""
+		template = self.template(duration, sr, cache)[offset:offset+len(out)]
+		n = len(template)
+		np.multiply(out[:n], template, out=out[:n])
+		out[n:] = 0.0
+		return out
+
+
+DEFAULT_ENVELOPE = Envelope()
+
+# Envelopes for instruments (by their mcc_parser.INSTRUMENTS name) that don't suit the default. 
+# Add to or change this to shape other instruments; see envelope_for().
+_PLUCKED = Envelope(props=(0.02, 0.2, 0.5), levels=(0.1, 1.0, 0.2, 0.01))
+_BOWED = Envelope(props=(0.3, 0.2, 0.4), levels=(0.05, 1.0, 0.7, 0.01))
+INSTRUMENT_ENVELOPES = dict(
+	[(name, _PLUCKED) for name in ("Acoustic Grand Piano", "Bright Acoustic Piano", "Electric Grand Piano", "Honky-tonk Piano", 
+		"Harpsichord", "Clavi", "Music Box", "Marimba", "Xylophone", "Acoustic Guitar (nylon)", "Acoustic Guitar (steel)", 
+		"Pizzicato Strings", "Orchestral Harp", "Banjo", "Kalimba")] + 
+	[(name, _BOWED) for name in ("Violin", "Viola", "Cello", "String Ensemble 1", "String Ensemble 2", "SynthStrings 1", 
+		"SynthStrings 2", "Choir Aahs", "Voice Oohs", "Pad 1 (new age)", "Pad 2 (warm)", "Pad 4 (choir)", "Pad 5 (bowed)")])
+
+
+def envelope_for(instrument:str) -> Envelope:
 	"""
-	A function for turning a string of RTTTL notes (based on this spec http://merwin.bespin.org/t4a/specs/nokia_rtttl.txt) 
-	into a playable waveform melody. 
-	
-	:param: notes, a list of notes in RTTTL.
-	:param: bpm, defines the tempo of the melody. 
-	:param: time_signature, the time signature defaults to 4/4 time. Set as 3 for 3/4, 5 for 5/4, etc.
-	:param: octave, the octave to default to if no octave is specfied on a note.
-	:param: wave_function, the type of waves to generate for these notes.
-	:param: do_envl, flag to make the note sound smoother with ADSR envelope.
+	The Envelope to render an instrument with: its entry in INSTRUMENT_ENVELOPES, or DEFAULT_ENVELOPE.
+	"""
+	return INSTRUMENT_ENVELOPES.get(instrument, DEFAULT_ENVELOPE)
 
-	This function was writte based on this:
-	https://flothesof.github.io/gameboy-sounds-in-python.html#A-function-that-parses-the-melody-and-generates-a-sound
+
+def _note_samples(duration:float, sr:int=44100, do_envl:bool=True) -> int:
+	"""
+	Number of samples the built-in wave functions produce for a note of the given 
+	duration, i.e. len(np.arange(0, duration, 1.0/sr)), trimmed to the envelope length.
+	"""
+	n = math.ceil(duration / (1.0/sr))
+	return min(n, int(duration*sr)) if do_envl else n
+
+
+def parse_notes(notes:str, bpm:float, time_signature:int=4, octave:int=5, tempo_map=None) -> list:
+	"""
+	First pass of rendering. Parse a string of RTTTL notes into a list 
+	of (duration in seconds, frequency) pairs. Rests have frequency 0.
+
+	The notes can also be a structured array of notes with "pitch" (MIDI pitch, negative 
+	for a rest), "duration" (RTTTL duration code) and "dotted" fields, like the ones 
+	mcc_parser.midi_to_notes() returns. Then there is nothing to parse, and `octave` is unused.
+
+	With a mcc_parser.TempoMap, `bpm` is ignored: the notes are laid out in beats from 
+	the start of the song and each one lasts as long as the tempo map says its beats do.
 	"""
+	if tempo_map is not None:
+		return _follow_tempo(parse_notes(notes, 60, time_signature, octave), tempo_map)
+
 	measure_len = time_signature * 60 / bpm
-	waveform = np.zeros((0,))
+	if isinstance(notes, np.ndarray):
+		durations = 1 / notes["duration"].astype(np.float64) * np.where(notes["dotted"], 1.5, 1.0) * measure_len
+		pitches = notes["pitch"].tolist()
+		freqs = dict((p, 0. if p < 0 else _midi_to_freq(p)) for p in set(pitches))
+		return list(zip(durations.tolist(), map(freqs.__getitem__, pitches)))
+
+	parsed = []
 	for note in notes.split(","):
 		duration, pitch = _split_note(note)
 
@@ -145,17 +609,422 @@ def notes_to_waveform(notes:list, bpm:float, time_signature:int=4, octave:int=5,
 				frequency = _midi_to_freq(RTTTL2MIDI[pitch])
 			else:
 				frequency = _midi_to_freq(RTTTL2MIDI[f"{pitch}{octave}"])
-		
-		# TODO (opt): cache or record waveforms of RTTTL notes already converted 
-		# to waveforms so that we don't need to run this expensive function 
-		# a lot - the result should make overall computation faster.
-		wave = wave_function(frequency, duration)
+		parsed.append((duration, frequency))
+	return parsed
+
+
+def _follow_tempo(parsed:list, tempo_map) -> list:
+	"""
+	Turn parsed notes timed in beats (parsed at 60 bpm) into seconds with a TempoMap. 
+	Each note is placed at its position in the song, so a note that spans a tempo change 
+	gets the right length on both sides of it, and the same note under the same tempo 
+	always gets the same duration, so it is one entry in the note and envelope caches.
+	"""
+	ticks = np.array([duration for duration, _ in parsed], dtype=np.float64) * tempo_map.ticks_per_beat
+	starts = np.cumsum(ticks) - ticks
+	return list(zip(tempo_map.durations(starts, ticks).tolist(), [frequency for _, frequency in parsed]))
+
+
+def _note_waves(parsed:list, lengths:list, wave_function, sr:int, cache:NoteCache):
+	"""
+	Generate the samples of each parsed note in turn, before any envelope, as (duration, samples). 
+	Rests give None instead of samples: they are silent, so there is nothing to render.
+	"""
+	for (duration, frequency), n in zip(parsed, lengths):
+		if frequency == 0:
+			yield duration, None
+			continue
+		if isinstance(wave_function, Oscillator):
+			# Oscillators carry phase from note to note, so their output can't be cached.
+			wave = wave_function.render([frequency], [n], sr)
+		else:
+			render = lambda: wave_function(frequency, duration, sr)[:n]
+			if cache is None:
+				wave = render()
+			else:
+				# Repeated notes render to the same samples, so look them up by everything that shapes them.
+				wave = cache.get_or_render((wave_function, frequency, duration, sr, n), render)
+
+		assert len(wave) == n, "MCC: wave_function returned an unexpected number of samples."
+		yield duration, wave
+
+
+def notes_to_waveform(notes:list, bpm:float, time_signature:int=4, octave:int=5, wave_function=square_wave, 
+		do_envl:bool=True, sr:int=44100, dtype=np.float64, cache:NoteCache=NOTE_CACHE, tempo_map=None, 
+		envelope:Envelope=DEFAULT_ENVELOPE) -> np.array:
+	"""
+	A function for turning a string of RTTTL notes (based on this spec http://merwin.bespin.org/t4a/specs/nokia_rtttl.txt) 
+	into a playable waveform melody. 
+	
+	:param: notes, a list of notes in RTTTL, or a structured array of notes (see parse_notes).
+	:param: bpm, defines the tempo of the melody. 
+	:param: time_signature, the time signature defaults to 4/4 time. Set as 3 for 3/4, 5 for 5/4, etc.
+	:param: octave, the octave to default to if no octave is specfied on a note.
+	:param: wave_function, the type of waves to generate for these notes.
+	:param: do_envl, flag to make the note sound smoother with ADSR envelope.
+	:param: sr, the sampling rate.
+	:param: dtype, the dtype of the output buffer, e.g. np.float32 to halve memory.
+	:param: cache, a NoteCache to reuse rendered notes from. Pass None to render every note.
+	:param: tempo_map, the mcc_parser.TempoMap of the song the notes start from. If given, bpm 
+		is ignored and the notes follow every tempo change of the song (see parse_notes).
+	:param: envelope, the Envelope to shape notes with when do_envl is set, e.g. envelope_for(instrument).
+
+	Rendering is done in two passes. The first parses the notes and works out where each 
+	note starts in the output, so the whole waveform can be allocated once. The second 
+	renders each note straight into its slice of that buffer. This keeps rendering linear 
+	in the number of notes, where growing the waveform note by note is quadratic. The 
+	envelope is then applied to the slice in place, and rests are left silent.
+
+	This function was writte based on this:
+	https://flothesof.github.io/gameboy-sounds-in-python.html#A-function-that-parses-the-melody-and-generates-a-sound
+	"""
+	parsed = parse_notes(notes, bpm, time_signature, octave, tempo_map)
+	lengths = [_note_samples(duration, sr, do_envl) for duration, _ in parsed]
 
+	if isinstance(wave_function, Oscillator):
+		# Oscillators render the whole voice in one go, rests already silent, then each note gets its envelope.
+		waveform = wave_function.render([f for _, f in parsed], lengths, sr, dtype)
 		if do_envl:
-			envl = adsr_envelope(duration)
-			wavelen = min(len(wave), len(envl))
-			wave = wave[:wavelen] * envl[:wavelen]
-		
-		waveform = np.hstack((waveform, wave))
+			offset = 0
+			for (duration, frequency), n in zip(parsed, lengths):
+				if frequency > 0:
+					envelope.apply(waveform[offset:offset+n], duration, sr)
+				offset += n
+		return waveform
+
+	waveform = np.empty(sum(lengths), dtype=dtype)
+	offset = 0
+	for (duration, wave), n in zip(_note_waves(parsed, lengths, wave_function, sr, cache), lengths):
+		note = waveform[offset:offset+n]
+		if wave is None:
+			note[:] = 0.0
+		else:
+			note[:] = wave
+			if do_envl:
+				envelope.apply(note, duration, sr)
+		offset += n
 
 	return waveform
+
+
+def timeline_offsets(timeline:np.array, tempo_map, sr:int=44100) -> tuple:
+	"""
+	The first sample and the number of samples of each note of a timeline (see 
+	mcc_parser.MidiStream.timelines()), with its ticks converted to seconds by `tempo_map`.
+
+	Both ends of a note are rounded to the nearest sample from the exact time of that tick, 
+	never by adding up rounded note lengths, so rounding errors can't build up along a track 
+	and a note starting at the same tick in two tracks starts at the same sample in both.
+	"""
+	start = np.rint(tempo_map.seconds(timeline["onset"]) * sr).astype(np.int64)
+	end = np.rint(tempo_map.seconds(timeline["onset"] + timeline["length"]) * sr).astype(np.int64)
+	return start, end - start
+
+
+def timeline_length(timelines:list, tempo_map, sr:int=44100, offsets:list=None) -> int:
+	"""
+	The number of samples it takes to render tracks of timed notes: up to the end of the last note. 
+	`offsets` can pass the timeline_offsets() of each track if they are already known.
+	"""
+	offsets = [timeline_offsets(timeline, tempo_map, sr) for timeline in timelines] if offsets is None else offsets
+	return max((int((start + n).max()) for start, n in offsets if len(n) > 0), default=0)
+
+
+def _fit_length(wave:np.array, n:int) -> np.array:
+	"""
+	Trim a wave to n samples, or pad it with zeros up to n samples.
+	"""
+	return wave[:n] if len(wave) >= n else np.concatenate((wave, np.zeros(n - len(wave), dtype=wave.dtype)))
+
+
+def _timeline_note(wave_function, frequency:float, n:int, sr:int, envelope:Envelope) -> np.array:
+	"""
+	Render a note of exactly n samples, shaped by `envelope` unless it is None.
+	"""
+	duration = n / sr
+	wave = _fit_length(wave_function(frequency, duration, sr), n)
+	if envelope is not None:
+		envelope.apply(wave, duration, sr)
+	return wave
+
+
+def timeline_to_waveform(timelines:list, tempo_map, wave_function=square_wave, do_envl:bool=True, sr:int=44100, 
+		dtype=np.float64, cache:NoteCache=NOTE_CACHE, mix:bool=True, envelope=DEFAULT_ENVELOPE):
+	"""
+	Render tracks of timed notes, as returned by mcc_parser.MidiStream.timelines() or 
+	mcc_parser.parse_midi()["timelines"], into a waveform.
+
+	:param: timelines, a list of TIMELINE_DTYPE arrays, one per track.
+	:param: tempo_map, the mcc_parser.TempoMap of the file the tracks come from.
+	:param: wave_function, the type of waves to generate for these notes.
+	:param: do_envl, flag to make the note sound smoother with ADSR envelope.
+	:param: sr, the sampling rate.
+	:param: dtype, the dtype of the output buffer, e.g. np.float32 to halve memory.
+	:param: cache, a NoteCache to reuse rendered notes from. Pass None to render every note.
+	:param: mix, if True, return every track added into one buffer; if False, return a list 
+		of one buffer per track, all the same length, e.g. for mcc_builder.combine_tracks().
+	:param: envelope, the Envelope to shape notes with when do_envl is set, or a list of one 
+		Envelope per track, e.g. from envelope_for().
+
+	notes_to_waveform() lays a track's notes end to end, each as long as its quantized RTTTL 
+	duration, so tracks drift apart as rounding errors add up. Here every note is placed at 
+	the sample its onset tick falls on (see timeline_offsets()) and lasts until the sample 
+	its end falls on, so the tracks stay sample-aligned for the whole song, chords and 
+	overlapping notes are kept, and tempo changes are followed. The gaps between notes are 
+	silent. Overlapping notes add up, so the result can peak above 1.0. For the same reason 
+	notes are enveloped before they are added rather than in the output buffer, and cached 
+	with their envelope.
+	"""
+	offsets = [timeline_offsets(timeline, tempo_map, sr) for timeline in timelines]
+	total = timeline_length(timelines, tempo_map, sr, offsets)
+	out = np.zeros(total, dtype=dtype) if mix else [np.zeros(total, dtype=dtype) for _ in timelines]
+
+	envelopes = envelope if isinstance(envelope, (list, tuple)) else [envelope] * len(timelines)
+	for i, timeline in enumerate(timelines):
+		add_timeline(out if mix else out[i], timeline, tempo_map, 0, wave_function, do_envl, sr, cache, envelopes[i], offsets[i])
+	return out
+
+
+def add_timeline(out:np.array, timeline:np.array, tempo_map, first:int=0, wave_function=square_wave, do_envl:bool=True, 
+		sr:int=44100, cache:NoteCache=NOTE_CACHE, envelope:Envelope=DEFAULT_ENVELOPE, offsets:tuple=None) -> np.array:
+	"""
+	Add the notes of one track of timed notes into `out`, which holds samples first, first+1, ... 
+	of the song, and return it. The other params are as for timeline_to_waveform(), and `offsets` 
+	can pass the timeline_offsets() of the track if they are already known.
+
+	Notes that start before `out` or run past its end are rendered whole and cut to fit, so 
+	rendering a song segment by segment gives the same samples as rendering it at once, as 
+	long as the wave function doesn't carry anything from one note to the next (an Oscillator does).
+	"""
+	starts, lengths = timeline_offsets(timeline, tempo_map, sr) if offsets is None else offsets
+	last = first + len(out)
+	hit = np.flatnonzero((starts < last) & (starts + lengths > first) & (lengths > 0))
+	envelope = envelope if do_envl else None
+
+	pitches = timeline["pitch"][hit].tolist()
+	freqs = dict((p, _midi_to_freq(p)) for p in set(pitches))
+	for pitch, start, n in zip(pitches, starts[hit].tolist(), lengths[hit].tolist()):
+		frequency = freqs[pitch]
+		render = lambda: _timeline_note(wave_function, frequency, n, sr, envelope)
+		# Notes are keyed by their length in samples rather than seconds, so the same note 
+		# at the same tempo is one entry however far into the song it is.
+		if cache is None or isinstance(wave_function, Oscillator):
+			wave = render()
+		else:
+			wave = cache.get_or_render((_timeline_note, wave_function, frequency, n, sr, envelope), render)
+		a, b = max(start, first), min(start + n, last)
+		out[a-first:b-first] += wave[a-start:b-start]
+	return out
+
+
+class Voice:
+	KINDS = ("pulse", "triangle", "sawtooth", "noise")
+
+	def __init__(self, kind:str="pulse", duty:float=0.5, envelope:Envelope=DEFAULT_ENVELOPE, gain:float=1.0):
+		"""
+		How a group of notes sounds: a kind of waveform, its duty cycle for pulse waves 
+		(see pulse_shape), the Envelope each note gets (None for none), and a gain.
+
+		"noise" is sample-and-hold white noise, like the NES noise channel: a note holds a 
+		random value for a while, then jumps to another, and the higher its pitch the more 
+		often it jumps. It is meant for drums, where the pitch picks the drum, not a tone.
+
+		render() renders a whole batch of notes in one vectorized pass, so voices are meant 
+		to be shared by every note that should sound the same (see timeline_to_voices()).
+		"""
+		assert kind in self.KINDS, f"MCC: No voice for {kind} waves."
+		assert 0 < duty < 1, "MCC: Duty cycle must be between 0 and 1."
+		self.kind = kind
+		self.duty = duty
+		self.envelope = envelope
+		self.gain = gain
+
+
+	def render(self, freqs:np.array, lengths:np.array, sr:int=44100, rng:np.random.Generator=None, dtype=np.float64) -> np.array:
+		"""
+		Render notes, given their frequencies and lengths in samples, back to back into one 
+		array. Each note starts at phase zero, like the wave functions, and gets its envelope 
+		in place. `rng` draws the noise of "noise" voices (default: a fresh unseeded one).
+		"""
+		freqs = np.asarray(freqs, dtype=np.float64)
+		lengths = np.asarray(lengths, dtype=np.int64)
+		starts = np.cumsum(lengths) - lengths
+
+		if self.kind == "noise":
+			# Hold a new random value every sr / (32*freq) samples: draw as many as each note 
+			# needs and repeat each one, cutting the last value of a note short to fit.
+			holds = np.rint(sr / np.minimum(32 * freqs, sr)).astype(np.int64)
+			counts = -(-lengths // holds)
+			repeats = np.repeat(holds, counts)
+			played = counts > 0
+			repeats[(np.cumsum(counts) - 1)[played]] = (lengths - (counts - 1) * holds)[played]
+			values = (rng or np.random.default_rng()).uniform(-1.0, 1.0, int(counts.sum()))
+			out = np.repeat(values, repeats)
+		else:
+			# Phase in cycles of each sample, counted from the start of its note.
+			phase = np.arange(int(lengths.sum()), dtype=np.float64)
+			phase -= np.repeat(starts, lengths)
+			phase *= np.repeat(freqs / sr, lengths)
+			phase -= np.floor(phase)
+			if self.kind == "pulse":
+				out = pulse_shape(phase, self.duty)
+			elif self.kind == "triangle":
+				out = triangle_shape(phase)
+			else:
+				out = sawtooth_shape(phase)
+		out = out.astype(dtype, copy=False)
+
+		if self.envelope is not None:
+			# Notes of the same length share an envelope, so fetch each template once and 
+			# apply all of them with one multiplication.
+			templates = dict((n, _fit_length(self.envelope.template(n / sr, sr), n)) for n in set(lengths.tolist()))
+			out *= np.concatenate([templates[n] for n in lengths.tolist()]) if len(lengths) > 0 else 1.0
+		if self.gain != 1.0:
+			out *= self.gain
+		return out
+
+
+# General MIDI groups its 128 programs (INSTRUMENTS in mcc_parser) into 16 families of 8.
+INSTRUMENT_FAMILIES = ("Piano", "Chromatic Percussion", "Organ", "Guitar", "Bass", "Strings", "Ensemble", "Brass", 
+	"Reed", "Pipe", "Synth Lead", "Synth Pad", "Synth Effects", "Ethnic", "Percussive", "Sound Effects")
+
+# The voice each family is rendered with. Change these to re-orchestrate every song.
+FAMILY_VOICES = {
+	"Piano": Voice("pulse", 0.5, _PLUCKED),
+	"Chromatic Percussion": Voice("triangle", envelope=_PLUCKED),
+	"Organ": Voice("pulse", 0.5),
+	"Guitar": Voice("pulse", 0.25, _PLUCKED),
+	"Bass": Voice("triangle"),
+	"Strings": Voice("sawtooth", envelope=_BOWED, gain=0.8),
+	"Ensemble": Voice("sawtooth", envelope=_BOWED, gain=0.8),
+	"Brass": Voice("pulse", 0.25),
+	"Reed": Voice("pulse", 0.125),
+	"Pipe": Voice("triangle", envelope=_BOWED),
+	"Synth Lead": Voice("pulse", 0.5),
+	"Synth Pad": Voice("sawtooth", envelope=_BOWED, gain=0.8),
+	"Synth Effects": Voice("sawtooth"),
+	"Ethnic": Voice("pulse", 0.25, _PLUCKED),
+	"Percussive": Voice("noise", envelope=Envelope(props=(0.01, 0.1, 0.2), levels=(0.5, 1.0, 0.1, 0.001)), gain=0.5),
+	"Sound Effects": Voice("noise", gain=0.5),
+}
+
+# Channel 10 (9 counting from 0) is for percussion in General MIDI, whatever its program.
+PERCUSSION_CHANNEL = 9
+DRUM_VOICE = Voice("noise", envelope=Envelope(props=(0.01, 0.1, 0.1), levels=(0.5, 1.0, 0.1, 0.001)), gain=0.5)
+
+
+def voice_for(program:int, channel:int) -> Voice:
+	"""
+	The Voice for notes played with a program (0-127) on a channel (0-15): DRUM_VOICE on the 
+	percussion channel, otherwise the FAMILY_VOICES entry of the program's family.
+	"""
+	if channel == PERCUSSION_CHANNEL:
+		return DRUM_VOICE
+	return FAMILY_VOICES[INSTRUMENT_FAMILIES[program // 8]]
+
+
+def timeline_to_voices(timelines:list, tempo_map, route=voice_for, sr:int=44100, dtype=np.float64, mix:bool=True, 
+		seed:int=None, block_size:int=2**16):
+	"""
+	Render tracks of timed notes like timeline_to_waveform(), but with each note sounding 
+	like its instrument: `route(program, channel)` picks the Voice for each note from the 
+	program and channel it was played with (see MidiStream.timelines()), by default 
+	voice_for(), which maps General MIDI instrument families to pulse, triangle and 
+	sawtooth voices and the percussion channel to noise.
+
+	:param: timelines, a list of TIMELINE_DTYPE arrays, one per track.
+	:param: tempo_map, the mcc_parser.TempoMap of the file the tracks come from.
+	:param: route, a function from (program, channel) to a Voice.
+	:param: sr, the sampling rate.
+	:param: dtype, the dtype of the output buffer.
+	:param: mix, if True, return every track added into one buffer; if False, return a list 
+		of one buffer per track, all the same length.
+	:param: seed, the seed for the noise of noise voices, to render the same song the same way.
+	:param: block_size, roughly how many samples of notes are rendered per batch.
+
+	Notes are grouped by voice (and track, with mix=False) across the whole song, and each 
+	group is rendered in batches of about block_size samples with a single Voice.render() call, 
+	small enough for the batch to stay in the CPU cache while it is worked on. Each note of 
+	the batch is then added into its slice of the output, so overlapping notes sum.
+	"""
+	rng = np.random.default_rng(seed)
+	offsets = [timeline_offsets(timeline, tempo_map, sr) for timeline in timelines]
+	total = timeline_length(timelines, tempo_map, sr, offsets)
+	out = np.zeros(total, dtype=dtype) if mix else [np.zeros(total, dtype=dtype) for _ in timelines]
+
+	# The notes of each (voice, output buffer) pair, as (starts, lengths, pitches) per track.
+	groups, voices = {}, {}
+	for i, (timeline, (starts, lengths)) in enumerate(zip(timelines, offsets)):
+		routes = timeline["channel"].astype(np.int64) * 128 + timeline["program"]
+		for code in np.unique(routes).tolist():
+			voice = route(code % 128, code // 128)
+			owned = (routes == code) & (lengths > 0)
+			key = (id(voice), None if mix else i)
+			voices[id(voice)] = voice
+			groups.setdefault(key, []).append((starts[owned], lengths[owned], timeline["pitch"][owned]))
+
+	for (voice_id, i), parts in groups.items():
+		voice, buffer = voices[voice_id], out if mix else out[i]
+		starts, lengths, pitches = (np.concatenate(part) for part in zip(*parts))
+		order = np.argsort(starts, kind="stable")
+		starts, lengths, freqs = starts[order], lengths[order], _midi_to_freq(pitches[order].astype(np.float64))
+
+		ends = np.cumsum(lengths)
+		first = 0
+		while first < len(lengths):
+			last = max(first + 1, int(np.searchsorted(ends, ends[first] - lengths[first] + block_size, side="right")))
+			samples = voice.render(freqs[first:last], lengths[first:last], sr, rng, dtype)
+			offset = 0
+			for start, n in zip(starts[first:last].tolist(), lengths[first:last].tolist()):
+				buffer[start:start+n] += samples[offset:offset+n]
+				offset += n
+			first = last
+	return out
+
+
+def waveform_length(notes:list, bpm:float, time_signature:int=4, octave:int=5, do_envl:bool=True, sr:int=44100, 
+		tempo_map=None) -> int:
+	"""
+	The number of samples notes_to_waveform() or stream_waveform() render for the same notes 
+	and params, worked out without rendering them, e.g. to write a WAV header before streaming.
+	"""
+	return sum(_note_samples(duration, sr, do_envl) for duration, _ in parse_notes(notes, bpm, time_signature, octave, tempo_map))
+
+
+def stream_waveform(notes:list, bpm:float, time_signature:int=4, octave:int=5, wave_function=square_wave, 
+		do_envl:bool=True, sr:int=44100, block_size:int=4096, dtype=np.float64, cache:NoteCache=NOTE_CACHE, tempo_map=None, 
+		envelope:Envelope=DEFAULT_ENVELOPE):
+	"""
+	Generator version of notes_to_waveform. Renders the same samples, but yields them 
+	in blocks of `block_size` (the last block may be shorter) instead of one array, so 
+	memory use is bounded by the block size and the longest note rather than the song length.
+
+	The other params are the same as for notes_to_waveform.
+	"""
+	assert block_size > 0, "MCC: block_size must be positive."
+	parsed = parse_notes(notes, bpm, time_signature, octave, tempo_map)
+	lengths = [_note_samples(duration, sr, do_envl) for duration, _ in parsed]
+
+	block = np.empty(block_size, dtype=dtype)
+	filled = 0
+	for (duration, wave), n in zip(_note_waves(parsed, lengths, wave_function, sr, cache), lengths):
+		# A note may fill the rest of the current block and spill over several more.
+		start = 0
+		while start < n:
+			take = min(block_size - filled, n - start)
+			part = block[filled:filled+take]
+			if wave is None:
+				part[:] = 0.0
+			else:
+				part[:] = wave[start:start+take]
+				if do_envl:
+					envelope.apply(part, duration, sr, offset=start)
+			filled += take
+			start += take
+			if filled == block_size:
+				yield block
+				block = np.empty(block_size, dtype=dtype)
+				filled = 0
+
+	if filled > 0:
+		yield block[:filled]
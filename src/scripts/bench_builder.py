@@ -0,0 +1,61 @@
+# Micro-benchmarks for mixing tracks in mcc_builder.
+# Run from the /src directory: python scripts/bench_builder.py
+
+import sys
+import time
+import tracemalloc
+import numpy as np
+sys.path.insert(0, '.')
+from modules import mcc_builder
+
+
+def _old_combine_tracks(tracks: list) -> np.array:
+	"""
+	The original mixer, which pads a copy of every track to the longest one.
+	"""
+	maxlen = max(list(map(len, tracks)))
+	combined = np.zeros(maxlen)
+	for t in tracks:
+		if type(t) is list:
+			t = np.array(t)
+		t = np.pad(t, (0,maxlen-t.shape[0]))
+		combined += t
+	return combined
+
+
+def measure(fn, *args, **kwargs) -> tuple:
+	"""
+	Wall time and peak memory allocated during one call.
+	"""
+	tracemalloc.start()
+	t0 = time.perf_counter()
+	fn(*args, **kwargs)
+	elapsed = time.perf_counter() - t0
+	peak = tracemalloc.get_traced_memory()[1]
+	tracemalloc.stop()
+	return elapsed, peak
+
+
+def bench_mixing(seconds: int=120, sr: int=44100):
+	rng = np.random.default_rng(0)
+	print("channels\tmixer\t\t\ttime (s)\tpeak (MB)")
+	for channels in [4, 8, 16]:
+		tracks = [rng.uniform(-1, 1, int(sr*seconds*rng.uniform(0.5, 1.0))) for _ in range(channels)]
+		gains = [0.5]*channels
+		pans = list(np.linspace(-1, 1, channels))
+		runs = [
+			("pad (old)", _old_combine_tracks, {}),
+			("in place", mcc_builder.combine_tracks, {}),
+			("in place float32", mcc_builder.combine_tracks, {"dtype": np.float32}),
+			("gain+pan+normalize", mcc_builder.combine_tracks, {"gains": gains, "pans": pans, "normalize": True}),
+		]
+		for name, fn, kwargs in runs:
+			elapsed, peak = measure(fn, tracks, **kwargs)
+			print(f"{channels}\t\t{name:<20}\t{elapsed:.3f}\t\t{peak/2**20:.1f}")
+
+	tracks = [rng.uniform(-1, 1, n) for n in [1000, 2500, 1700]]
+	assert np.array_equal(_old_combine_tracks(tracks), mcc_builder.combine_tracks(tracks))
+
+
+if __name__ == "__main__":
+	bench_mixing()
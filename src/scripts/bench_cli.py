@@ -0,0 +1,44 @@
+# Benchmarks for the headless batch CLI in mcc_cli, on the bundled MIDI files.
+# Run from the /src directory: python scripts/bench_cli.py
+
+import os
+import sys
+import tempfile
+import time
+import wave
+sys.path.insert(0, '.')
+import mcc_cli
+
+
+def bench_workers(data:str="./data"):
+	"""
+	Time the whole pipeline over every bundled song with one render thread, and with one per CPU.
+	"""
+	counts = sorted(set([1, os.cpu_count() or 1]))
+	for workers in counts:
+		with tempfile.TemporaryDirectory() as out:
+			t0 = time.perf_counter()
+			assert mcc_cli.main([data, "-o", out, "--seed", "0", "--workers", str(workers), "--no-cache", "-q"]) == 0
+			print(f"{workers} render thread(s): {time.perf_counter() - t0:.2f}s for {len(os.listdir(out))} files")
+
+
+def check_sample_rate(song:str="./data/zeldaund.mid", rates:list=[44100, 22050]):
+	"""
+	The same song written at different --sr lasts as long at each of them: the audio is
+	synthesized at that rate, not only labelled with it.
+	"""
+	seconds = []
+	for sr in rates:
+		with tempfile.TemporaryDirectory() as out:
+			assert mcc_cli.main([song, "-o", out, "--seed", "0", "--sr", str(sr), "--format", "pcm16", "--no-cache", "-q"]) == 0
+			with wave.open(os.path.join(out, os.listdir(out)[0])) as w:
+				assert w.getframerate() == sr
+				seconds.append(w.getnframes() / sr)
+	# Each note is rounded to whole samples, so the lengths can differ by a little.
+	assert max(seconds) - min(seconds) < 0.01 * max(seconds), f"MCC: durations {seconds} differ between sample rates."
+	print("sample rates " + ", ".join(f"{sr}: {s:.2f}s" for sr, s in zip(rates, seconds)))
+
+
+if __name__ == "__main__":
+	bench_workers()
+	check_sample_rate()
@@ -0,0 +1,33 @@
+# Benchmarks for parallel corpus training in mcc_corpus.
+# Run from the /src directory: python scripts/bench_corpus.py [copies]
+
+import os
+import sys
+import time
+sys.path.insert(0, '.')
+from modules import mcc_corpus
+
+
+def bench_workers(copies:int=20, k:int=3):
+	"""
+	Train on the bundled songs replicated `copies` times with 1, 2, 4, ... workers up to
+	the number of CPUs, and check every worker count gives the same model.
+	"""
+	paths = mcc_corpus.corpus_files("./data") * copies
+	cpus = os.cpu_count() or 1
+	counts = sorted(set([1] + [2**i for i in range(1, cpus.bit_length()) if 2**i <= cpus] + [cpus]))
+	print(f"{len(paths)} files, {cpus} CPUs")
+	print("workers\ttime (s)\tfiles/s\tspeedup")
+	base, ref = None, None
+	for workers in counts:
+		t0 = time.perf_counter()
+		model = mcc_corpus.train_corpus(paths, k, workers=workers)
+		t = time.perf_counter() - t0
+		base = base or t
+		ref = ref or model.TP
+		assert model.TP == ref
+		print(f"{workers}\t{t:.2f}\t\t{len(paths)/t:.1f}\t{base/t:.2f}x")
+
+
+if __name__ == "__main__":
+	bench_workers(int(sys.argv[1]) if len(sys.argv) > 1 else 20)
@@ -0,0 +1,284 @@
+# Benchmarks for fitting and sampling the Markov models in mcc_markov.
+# Run from the /src directory: python scripts/bench_markov.py
+
+import os
+import sys
+import time
+import tracemalloc
+import numpy as np
+sys.path.insert(0, '.')
+from modules import mcc_parser, mcc_markov
+
+
+class _OldKMarkov():
+	"""
+	The original dictionary-of-dictionaries KMarkov, keyed by comma-joined priors.
+	"""
+	def __init__(self, k:int):
+		self.k = k
+		self.TP = {}
+
+	def fit(self, event:str):
+		event = event.split(",")
+		for i in range(len(event)-self.k):
+			priors = ",".join(event[i:i+self.k])
+			next = event[i+self.k]
+			if priors in self.TP and next in self.TP[priors]:
+				self.TP[priors][next] += 1.0
+			elif priors in self.TP:
+				self.TP[priors][next] = 1.0
+			else:
+				self.TP[priors] = {next: 1.0}
+		for priors in self.TP:
+			csum = sum(self.TP[priors].values())
+			for next in self.TP[priors]:
+				self.TP[priors][next] /= csum
+
+	def predict(self, samples:int) -> str:
+		preds = str(np.random.choice(list(self.TP.keys()))).split(",")
+		for i in range(samples):
+			priors = ",".join(preds[-self.k:])
+			while not priors in self.TP:
+				priors_list = priors.split(",")
+				if len(priors_list[1:]) > 0:
+					priors = ",".join(priors_list[1:])
+					for ps in self.TP:
+						if ps[-len(priors):] == priors:
+							priors = ps[-len(priors):]
+							break
+				else:
+					last_state = ",".join(priors_list)
+					possible_priors = [k for k in self.TP if k[-len(last_state):] == last_state]
+					if len(possible_priors) == 0:
+						priors = str(np.random.choice(list(self.TP.keys())))
+					else:
+						priors = str(np.random.choice(possible_priors))
+			preds.append(str(np.random.choice(list(self.TP[priors].keys()), p=list(self.TP[priors].values()))))
+		return ",".join(preds)
+
+
+def load_corpus(copies:int=1) -> str:
+	"""
+	Every track of every bundled MIDI file as one RTTTL string, repeated `copies` times.
+	"""
+	tracks = []
+	for song in sorted(os.listdir("./data")):
+		mid = mcc_parser.open_midi(f"./data/{song}")
+		for track in mcc_parser.extract_midi_tracks(mid.tracks):
+			rtttl = mcc_parser.midi_to_rtttl(track, mid.ticks_per_beat)
+			if len(rtttl) > 0:
+				tracks.append(rtttl)
+	return ",".join(tracks * copies)
+
+
+def timed(fn, *args, repeat:int=3, **kwargs) -> float:
+	best = float("inf")
+	for _ in range(repeat):
+		t0 = time.perf_counter()
+		fn(*args, **kwargs)
+		best = min(best, time.perf_counter() - t0)
+	return best
+
+
+def retained(fn, *args, **kwargs) -> int:
+	"""
+	Bytes still allocated after the call, e.g. the size of a fitted model.
+	"""
+	tracemalloc.start()
+	before = tracemalloc.get_traced_memory()[0]
+	fn(*args, **kwargs)
+	after = tracemalloc.get_traced_memory()[0]
+	tracemalloc.stop()
+	return after - before
+
+
+def _build(model, corpus):
+	"""
+	Fit a model, including building the tables that KMarkov only builds on the first predict().
+	"""
+	model.fit(corpus)
+	if hasattr(model, "_materialize"):
+		model._materialize()
+
+
+def bench_kmarkov(copies:int=20, samples:int=2000):
+	corpus = load_corpus(copies)
+	print(f"corpus: {len(corpus.split(','))} states")
+	print("k\tmodel\tfit (s)\tmodel (MB)\tpredict (s)")
+	for k in [1, 3, 5, 10]:
+		for name, cls in [("old", _OldKMarkov), ("new", mcc_markov.KMarkov)]:
+			model = cls(k)
+			size = retained(_build, model, corpus)
+			t_fit = timed(lambda: _build(cls(k), corpus))
+			t_pred = timed(model.predict, samples)
+			print(f"{k}\t{name}\t{t_fit:.3f}\t{size/2**20:.2f}\t\t{t_pred:.3f}")
+
+
+def bench_backoff(k:int=8, samples:int=500):
+	"""
+	Time steps whose priors were never seen, so that each one has to back off all the way 
+	to the last prior state.
+	"""
+	corpus = load_corpus(5)
+	states = corpus.split(",")
+	old = _OldKMarkov(k)
+	old.fit(corpus)
+	print(f"back-off, k={k}, {len(old.TP)} rows")
+
+	def old_step():
+		# The reduction loop from the old predict(), starting from unseen priors.
+		for _ in range(samples):
+			p = ",".join(["64zz"] * (k - 1) + [states[0]])
+			while not p in old.TP:
+				pl = p.split(",")
+				if len(pl[1:]) > 0:
+					p = ",".join(pl[1:])
+					for ps in old.TP:
+						if ps[-len(p):] == p:
+							p = ps[-len(p):]
+							break
+				else:
+					possible = [q for q in old.TP if q[-len(p):] == p]
+					p = str(np.random.choice(possible if len(possible) > 0 else list(old.TP.keys())))
+			np.random.choice(list(old.TP[p].keys()), p=list(old.TP[p].values()))
+
+	print(f"old: {1e3*timed(old_step, repeat=1)/samples:.3f}ms per step")
+	for backoff in mcc_markov.KMarkov.BACKOFFS:
+		new = mcc_markov.KMarkov(k, backoff=backoff)
+		new.fit(corpus)
+		new._materialize()
+		# Only the last prior is a known state.
+		key = new._state_idxs[states[0]]
+		t = timed(lambda: [new._next_state(key, 1, 0.5, 0.5) for _ in range(samples)], repeat=1)
+		print(f"new ({backoff}): {1e3*t/samples:.3f}ms per step")
+
+
+def bench_incremental(k:int=5, copies:int=40):
+	"""
+	Add one song to a large model by refitting everything, and with partial_fit(); 
+	then train two halves of the corpus separately and merge them.
+	"""
+	corpus = load_corpus(copies).split(",")
+	song = corpus[:3000]
+	model = mcc_markov.KMarkov(k)
+	model.fit(corpus)
+	t_refit = timed(lambda: mcc_markov.KMarkov(k).fit(corpus + song), repeat=1)
+	t_partial = timed(model.partial_fit, song, repeat=1)
+	t_first = timed(model.predict, 1, repeat=1)
+	print(f"add {len(song)} states to a {len(corpus)} state model: refit {t_refit:.3f}s  "
+		f"partial_fit {t_partial:.4f}s  (+{t_first:.4f}s on the next predict)")
+
+	half = len(corpus) // 2
+	a, b = mcc_markov.KMarkov(k), mcc_markov.KMarkov(k)
+	a.fit(corpus[:half])
+	b.fit(corpus[half:])
+	print(f"merge two halves: {timed(lambda: mcc_markov.KMarkov(k).merge(a).merge(b), repeat=1):.3f}s")
+
+
+def bench_save_load(k:int=5, copies:int=40, path:str="/tmp/bench_markov.mcc"):
+	"""
+	Retraining from the corpus against loading a saved model, with and without a memory map, 
+	and check that the loaded model predicts the same.
+	"""
+	corpus = load_corpus(copies)
+	model = mcc_markov.KMarkov(k)
+	t_fit = timed(_build, model, corpus, repeat=1)
+	model.save(path)
+	print(f"k={k}, {len(corpus.split(','))} states: retrain {t_fit:.3f}s, saved {os.path.getsize(path)/2**20:.2f}MB")
+	for mmap in [False, True]:
+		t_load = timed(mcc_markov.load_model, path, mmap=mmap)
+		loaded = mcc_markov.load_model(path, mmap=mmap)
+		t_first = timed(loaded.predict, 1, repeat=1)
+		assert loaded.predict(1000, seed=0) == model.predict(1000, seed=0)
+		print(f"load (mmap={mmap}): {1e3*t_load:.2f}ms, first predict {1e3*t_first:.1f}ms")
+	os.remove(path)
+
+
+def bench_batch(k:int=5, samples:int=500):
+	"""
+	Time per sequence of generating many sequences with predict_batch(), against a loop over predict(). 
+	Below KMarkov.MIN_BATCH sequences, predict_batch() samples them one by one too.
+	"""
+	model = mcc_markov.KMarkov(k)
+	model.fit(load_corpus(10))
+	t_loop = timed(lambda: [model.predict(samples, seed=s) for s in range(20)], repeat=1) / 20
+	print(f"k={k}, {samples} samples: predict() {1e3*t_loop:.2f}ms per sequence")
+	for n in [1, 10, mcc_markov.KMarkov.MIN_BATCH, 100, 1000]:
+		t = timed(model.predict_batch, n, samples, seed=0, repeat=1)
+		print(f"predict_batch({n}): {1e3*t/n:.2f}ms per sequence ({t_loop*n/t:.1f}x)")
+
+
+def _old_simple_fit(event:list) -> np.array:
+	"""
+	The original SimpleMarkov.fit: a dict of transition counts, then a loop over every pair of states.
+	"""
+	states = list(set(event))
+	transmat = np.zeros((len(states), len(states)))
+	transcounts = {}
+	for i in range(1, len(event)):
+		transcounts[(event[i-1], event[i])] = transcounts.get((event[i-1], event[i]), 0) + 1
+	for row, s in enumerate(states):
+		for col, q in enumerate(states):
+			if (s,q) in transcounts:
+				transmat[row][col] = transcounts[(s,q)]
+		rowsum = sum(transmat[row])
+		for i in range(len(transmat[row])):
+			transmat[row][i] /= rowsum
+	return transmat
+
+
+def bench_simple_fit():
+	"""
+	Fit SimpleMarkov on the corpus with the old loops and the dense and sparse 
+	counting paths, then on a large synthetic event with many states.
+	"""
+	print("states\tevent\told (s)\tdense (s)\tsparse (s)")
+	for copies in [1, 10, 50]:
+		event = load_corpus(copies).split(",")
+		t_old = timed(_old_simple_fit, event, repeat=1) if copies <= 10 else float("nan")
+		t_dense = timed(lambda: mcc_markov.SimpleMarkov().fit(event))
+		t_sparse = timed(lambda: mcc_markov.SimpleMarkov().fit(event, sparse=True))
+		print(f"{len(set(event))}\t{len(event)}\t{t_old:.3f}\t{t_dense:.3f}\t\t{t_sparse:.3f}")
+
+	# 50k states would need a 20GB dense transmat.
+	event = np.random.default_rng(0).integers(0, 50000, 5000000).tolist()
+	model = mcc_markov.SimpleMarkov()
+	t_sparse = timed(model.fit, event, sparse=True, repeat=1)
+	print(f"50000 states, {len(event)} events: sparse {t_sparse:.2f}s, transmat {model.transmat.data.nbytes/2**20:.1f}MB")
+
+
+def bench_sampling(samples:int=100000):
+	"""
+	Time generating many samples, against the old np.random.choice per step 
+	(timed on a tenth of the samples), and check that a seed reproduces them.
+	"""
+	corpus = load_corpus(5)
+	simple = mcc_markov.SimpleMarkov()
+	simple.fit(corpus.split(","))
+
+	def old_simple(n):
+		state = str(np.random.choice(list(simple.states)))
+		for _ in range(n):
+			state = np.random.choice(list(simple.states), 1, p=simple.transmat[simple._transmat_idxs[state]])[0]
+
+	t_old = 10 * timed(old_simple, samples // 10, repeat=1)
+	t_new = timed(simple.predict, samples, seed=0)
+	assert simple.predict(samples, seed=0) == simple.predict(samples, seed=0)
+	print(f"SimpleMarkov {samples} samples: old ~{t_old:.2f}s  new {t_new:.3f}s")
+
+	for k in [3, 8]:
+		model = mcc_markov.KMarkov(k)
+		model.fit(corpus)
+		t_new = timed(model.predict, samples, seed=0)
+		assert model.predict(samples, seed=0) == model.predict(samples, seed=0)
+		print(f"KMarkov({k}) {samples} samples: {t_new:.3f}s")
+
+
+if __name__ == "__main__":
+	bench_kmarkov()
+	bench_backoff()
+	bench_incremental()
+	bench_save_load()
+	bench_batch()
+	bench_simple_fit()
+	bench_sampling()
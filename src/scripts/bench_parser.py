@@ -0,0 +1,197 @@
+# Benchmarks for parsing MIDI files in mcc_parser.
+# Run from the /src directory: python scripts/bench_parser.py
+
+import os
+import shutil
+import sys
+import time
+import tracemalloc
+import numpy as np
+from mido import MidiFile, MidiTrack, tick2second
+sys.path.insert(0, '.')
+from modules import mcc_parser
+from modules.mcc_parser import assign_note, MIDI2RTTTL
+
+
+def _old_midi_to_rtttl(midi_tuple_list:list, ticks_per_beat:int) -> str:
+	"""
+	The original midi_to_rtttl, which builds the RTTTL string note by note.
+	"""
+
+
+	rtttlList = ""
+
+	# Tuple: (note:int, velocity:int, time:int, on/off:bool, current_instrument:str)
+	for i, tuple in enumerate(midi_tuple_list):
+		# Check first MIDI note for offset time from the start. Only add a "rest" if the time value > 0.
+		if i == 0 and tuple[2] > 0:
+			# Insert RTTTL rest with duration based on initial time.
+			rtttlList += "," + assign_note(tuple[2], ticks_per_beat) + "p"
+
+		# skipping the last element, since there's no next tuple's time
+		if i == len(midi_tuple_list) - 1:
+			break
+		
+		# note on
+		next_tuple = midi_tuple_list[i + 1]
+		beat_in_note = assign_note(next_tuple[2], ticks_per_beat)
+		if beat_in_note == "0":
+			continue
+
+		if tuple[3] == True:
+			newNote = beat_in_note + MIDI2RTTTL.get(tuple[0]) # time of next tuple + note
+			rtttlList += "," + newNote
+		
+		# note off
+		else:
+			newNote = beat_in_note + "p"
+			if beat_in_note != "0":
+				rtttlList += "," + newNote
+	
+	return rtttlList[1:]	# removing the first comma
+
+
+def timed(fn, *args, repeat:int=3, **kwargs) -> float:
+	best = float("inf")
+	for _ in range(repeat):
+		t0 = time.perf_counter()
+		fn(*args, **kwargs)
+		best = min(best, time.perf_counter() - t0)
+	return best
+
+
+def _load_tracks() -> list:
+	"""
+	Every track of every bundled MIDI file, with its file's ticks per beat.
+	"""
+	tracks = []
+	for song in sorted(os.listdir("./data")):
+		mid = mcc_parser.open_midi(f"./data/{song}")
+		tracks += [(track, mid.ticks_per_beat) for track in mcc_parser.extract_midi_tracks(mid.tracks)]
+	return tracks
+
+
+def bench_notes(copies:int=20):
+	"""
+	Convert every bundled track to RTTTL the old way, to a note array, and to RTTTL through the 
+	note array, and check the new conversions write the same RTTTL as the old one.
+	"""
+	tracks = _load_tracks()
+	for track, tpb in tracks:
+		rtttl = _old_midi_to_rtttl(track, tpb)
+		assert mcc_parser.midi_to_rtttl(track, tpb) == rtttl
+		if rtttl:
+			assert mcc_parser.notes_to_rtttl(mcc_parser.rtttl_to_notes(rtttl)) == rtttl
+
+	tracks = tracks * copies
+	n = sum(len(t) for t, _ in tracks)
+	t_old = timed(lambda: [_old_midi_to_rtttl(t, tpb) for t, tpb in tracks])
+	t_notes = timed(lambda: [mcc_parser.midi_to_notes(t, tpb) for t, tpb in tracks])
+	t_rtttl = timed(lambda: [mcc_parser.midi_to_rtttl(t, tpb) for t, tpb in tracks])
+	print(f"{n} messages: old RTTTL {t_old:.3f}s  note arrays {t_notes:.3f}s  RTTTL via note arrays {t_rtttl:.3f}s")
+
+
+def peak(fn, *args, **kwargs) -> tuple:
+	"""
+	Time of a call, and its peak traced memory on a second call (tracing slows it down).
+	"""
+	t = timed(fn, *args, repeat=1, **kwargs)
+	tracemalloc.start()
+	fn(*args, **kwargs)
+	_, top = tracemalloc.get_traced_memory()
+	tracemalloc.stop()
+	return t, top
+
+
+def _big_midi(path:str, copies:int):
+	"""
+	Write a multi-track MIDI file made of every bundled song's tracks, each repeated `copies` times over.
+	"""
+	big = MidiFile(ticks_per_beat=192)
+	for song in sorted(os.listdir("./data")):
+		for track in mcc_parser.open_midi(f"./data/{song}").tracks:
+			notes = [msg for msg in track if not msg.is_meta]
+			big.tracks.append(MidiTrack(notes * copies))
+	big.save(path)
+
+
+def bench_stream(copies:int=50, bars:int=16, path:str="/tmp/bench_parser.mid"):
+	"""
+	Note tuples of every track of a large file with open_midi() and extract_midi_tracks(), 
+	and with MidiStream, keeping only the note arrays of each track, or only the first few bars.
+	"""
+	_big_midi(path, copies)
+	print(f"{os.path.getsize(path)/2**20:.1f}MB, {bars} bars")
+
+	def eager():
+		mid = mcc_parser.open_midi(path)
+		return [mcc_parser.midi_to_notes(t, mid.ticks_per_beat) for t in mcc_parser.extract_midi_tracks(mid.tracks)]
+
+	def streamed(max_ticks=None):
+		with mcc_parser.MidiStream(path) as stream:
+			return [mcc_parser.midi_to_notes(list(t), stream.ticks_per_beat) for t in stream.tracks(max_ticks)]
+
+	for name, fn, args in [("open_midi", eager, ()), ("MidiStream", streamed, ()), 
+			(f"MidiStream, {bars} bars", streamed, (bars*4*192,))]:
+		t, top = peak(fn, *args)
+		print(f"{name}: {t:.2f}s, peak {top/2**20:.1f}MB")
+	os.remove(path)
+
+
+def bench_cache(directory:str="/tmp/bench_parser_cache/"):
+	"""
+	Parse the bundled songs with mido as the interface used to, with parse_midi(), 
+	and through a cold and a warm ParseCache.
+	"""
+	paths = [f"./data/{song}" for song in sorted(os.listdir("./data"))]
+
+	def with_mido():
+		for path in paths:
+			mid = mcc_parser.open_midi(path)
+			mcc_parser.extract_midi_info(mid.tracks[0])
+			[mcc_parser.midi_to_rtttl(t, mid.ticks_per_beat) for t in mcc_parser.extract_midi_tracks(mid.tracks)]
+
+	shutil.rmtree(directory, ignore_errors=True)
+	cache = mcc_parser.ParseCache(directory)
+	t_mido = timed(with_mido)
+	t_parse = timed(lambda: [mcc_parser.parse_midi(path) for path in paths])
+	t_cold = timed(lambda: [cache.parse(path) for path in paths], repeat=1)
+	t_warm = timed(lambda: [cache.parse(path) for path in paths])
+	size = sum(os.path.getsize(os.path.join(directory, f)) for f in os.listdir(directory))
+	print(f"{len(paths)} files: mido {1e3*t_mido:.1f}ms  parse_midi {1e3*t_parse:.1f}ms  "
+		f"cold cache {1e3*t_cold:.1f}ms  warm cache {1e3*t_warm:.1f}ms ({size/1024:.0f}KB cached)")
+	shutil.rmtree(directory)
+
+
+def bench_tempo_map(changes:int=1000, events:int=10**6, ticks_per_beat:int=480):
+	"""
+	Convert the ticks of many events to seconds in a song with many tempo changes: 
+	walking the events in order with mido.tick2second, and with one TempoMap.seconds() call.
+	"""
+	rng = np.random.default_rng(0)
+	tempo_ticks = np.sort(rng.integers(1, 10**7, changes))
+	tempos = rng.integers(200000, 1000000, changes)
+	tempo_map = mcc_parser.TempoMap(list(zip([0] + tempo_ticks.tolist(), [500000] + tempos.tolist())), ticks_per_beat)
+	ticks = np.sort(rng.integers(0, 10**7, events))
+
+	def walk():
+		# Seconds of each event, following the tempo changes as they are passed.
+		out, now, last, j, tempo = [], 0.0, 0, 0, 500000
+		for tick in ticks.tolist():
+			while j < changes and tempo_ticks[j] <= tick:
+				now += tick2second(int(tempo_ticks[j]) - last, ticks_per_beat, tempo)
+				last, tempo, j = int(tempo_ticks[j]), int(tempos[j]), j + 1
+			out.append(now + tick2second(tick - last, ticks_per_beat, tempo))
+		return out
+
+	t_walk = timed(walk, repeat=1)
+	t_map = timed(tempo_map.seconds, ticks)
+	assert np.allclose(walk(), tempo_map.seconds(ticks))
+	print(f"{events} events, {changes} tempo changes: walk {t_walk:.2f}s  TempoMap {1e3*t_map:.1f}ms")
+
+
+if __name__ == "__main__":
+	bench_notes()
+	bench_stream()
+	bench_cache()
+	bench_tempo_map()
@@ -0,0 +1,57 @@
+# Benchmarks for parallel rendering in mcc_render.
+# Run from the /src directory: python scripts/bench_render.py [song]
+
+import os
+import sys
+import time
+import numpy as np
+sys.path.insert(0, '.')
+from modules import mcc_parser, mcc_waves, mcc_render
+
+
+def timed(fn, *args, **kwargs) -> tuple:
+	"""
+	Wall-clock time of one call with an empty note cache, and its result.
+	"""
+	mcc_waves.NOTE_CACHE.clear()
+	t0 = time.perf_counter()
+	res = fn(*args, **kwargs)
+	return time.perf_counter() - t0, res
+
+
+def bench_workers(song:str="zeldaund.mid"):
+	"""
+	Render a song's timelines in one go, then in parallel with 1, 2, 4, ... threads and
+	processes up to the number of CPUs, and check every run gives the same samples.
+	"""
+	parsed = mcc_parser.parse_midi(f"./data/{song}")
+	timelines, tempo_map = parsed["timelines"], parsed["tempo_map"]
+	cpus = os.cpu_count() or 1
+	counts = sorted(set([1] + [2**i for i in range(1, cpus.bit_length()) if 2**i <= cpus] + [cpus]))
+	t_base, ref = timed(mcc_waves.timeline_to_waveform, timelines, tempo_map, wave_function=mcc_waves.triangle_wave)
+	print(f"{song}: {len(timelines)} tracks, {len(ref)/44100:.0f}s, {cpus} CPUs")
+	print(f"timeline_to_waveform: {t_base:.2f}s")
+	print("executor\tworkers\ttime (s)\tspeedup")
+	for executor in ["thread", "process"]:
+		for workers in counts:
+			t, res = timed(mcc_render.render_parallel, timelines, tempo_map, wave_function=mcc_waves.triangle_wave,
+				workers=workers, executor=executor)
+			assert np.array_equal(res, ref)
+			print(f"{executor}\t\t{workers}\t{t:.2f}\t\t{t_base/t:.2f}x")
+
+
+def bench_tracks(song:str="zeldaund.mid"):
+	"""
+	Render a song's tracks of notes one after the other, and on one thread each.
+	"""
+	parsed = mcc_parser.parse_midi(f"./data/{song}")
+	bpm = parsed["info"]["tempo"][0]
+	t_loop, ref = timed(lambda: [mcc_waves.notes_to_waveform(t, bpm, wave_function=mcc_waves.triangle_wave) for t in parsed["tracks"]])
+	t_pool, res = timed(mcc_render.notes_to_waveforms, parsed["tracks"], bpm, wave_function=mcc_waves.triangle_wave)
+	assert all(np.array_equal(a, b) for a, b in zip(ref, res))
+	print(f"{len(ref)} tracks of notes: one by one {t_loop:.2f}s  threads {t_pool:.2f}s")
+
+
+if __name__ == "__main__":
+	bench_workers(*sys.argv[1:2])
+	bench_tracks(*sys.argv[1:2])
@@ -0,0 +1,79 @@
+# Benchmarks for the generation service in mcc_server, entirely on localhost.
+# Run from the /src directory: python scripts/bench_server.py [song] [clients]
+
+import asyncio
+import io
+import json
+import sys
+import threading
+import time
+import wave
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+sys.path.insert(0, '.')
+from mcc_server import Server
+
+
+def start_server(**kwargs) -> tuple:
+	"""
+	Run a Server on its own event loop in a background thread, on a free port of 127.0.0.1.
+	Returns the server, its loop and its base URL.
+	"""
+	server = Server("./data", **kwargs)
+	loop = asyncio.new_event_loop()
+	threading.Thread(target=loop.run_forever, daemon=True).start()
+	port = asyncio.run_coroutine_threadsafe(server.start("127.0.0.1", 0), loop).result()
+	return server, loop, f"http://127.0.0.1:{port}"
+
+
+def fetch(url:str) -> tuple:
+	"""
+	GET a URL. Returns the seconds to the first byte of the body, the seconds to the last, and the body.
+	"""
+	t0 = time.perf_counter()
+	with urllib.request.urlopen(url) as res:
+		first = res.read(1)
+		t_first = time.perf_counter() - t0
+		body = first + res.read()
+	return t_first, time.perf_counter() - t0, body
+
+
+def bench_requests(base:str, song:str="zeldaund.mid", clients:int=8, rounds:int=3):
+	"""
+	Send rounds of `clients` concurrent /generate requests for a song, without a seed so
+	they can be batched, and check each answer is a whole WAV file. The first round
+	parses and fits the song; the later ones find it warm.
+	"""
+	url = f"{base}/generate?song={song}&length=100&format=pcm16"
+	print("round\tclients\tfirst byte (ms)\ttotal (ms)\twall (s)")
+	with ThreadPoolExecutor(max_workers=clients) as pool:
+		for r in range(rounds):
+			t0 = time.perf_counter()
+			results = list(pool.map(fetch, [url] * clients))
+			wall = time.perf_counter() - t0
+			for _, _, body in results:
+				with wave.open(io.BytesIO(body)) as w:
+					assert w.getnframes() > 0 and len(body) == 44 + 2 * w.getnframes()
+			first = sum(t for t, _, _ in results) / clients
+			total = sum(t for _, t, _ in results) / clients
+			print(f"{r}\t{clients}\t{1e3*first:.0f}\t\t{1e3*total:.0f}\t\t{wall:.2f}")
+
+
+def bench_seeded(base:str, song:str="zeldaund.mid"):
+	"""
+	Requests with the same seed get the same file, whether they're batched together or not.
+	"""
+	url = f"{base}/generate?song={song}&length=50&seed=7&format=pcm16"
+	with ThreadPoolExecutor(max_workers=4) as pool:
+		bodies = [body for _, _, body in pool.map(fetch, [url] * 4)]
+	bodies.append(fetch(url)[2])
+	assert all(body == bodies[0] for body in bodies)
+	print(f"seeded: {len(bodies)} identical files of {len(bodies[0])} bytes")
+
+
+if __name__ == "__main__":
+	server, loop, base = start_server()
+	bench_requests(base, *sys.argv[1:2], *map(int, sys.argv[2:3]))
+	bench_seeded(base, *sys.argv[1:2])
+	print(json.dumps(json.loads(fetch(f"{base}/metrics")[2]), indent=1))
+	asyncio.run_coroutine_threadsafe(server.close(), loop).result()
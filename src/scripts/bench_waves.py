@@ -0,0 +1,230 @@
+# Benchmarks for waveform rendering in mcc_waves.
+# Run from the /src directory: python scripts/bench_waves.py
+
+import os
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+sys.path.insert(0, '.')
+from modules import mcc_parser, mcc_waves
+
+NOTES = "16e6,16e6,32p,8e6,16c6,8e6,8g6,8p,8g,8p,8c6,4a.5,16f#5,2b4,32d7"
+
+
+def _old_notes_to_waveform(notes, bpm, wave_function=mcc_waves.square_wave):
+	"""
+	The original renderer, which grows the waveform with np.hstack per note.
+	"""
+	waveform = np.zeros((0,))
+	for duration, frequency in mcc_waves.parse_notes(notes, bpm):
+		wave = wave_function(frequency, duration)
+		envl = mcc_waves.adsr_envelope(duration)
+		wavelen = min(len(wave), len(envl))
+		waveform = np.hstack((waveform, wave[:wavelen] * envl[:wavelen]))
+	return waveform
+
+
+def bench(fn, *args, repeat=3, **kwargs) -> float:
+	best = float("inf")
+	for _ in range(repeat):
+		t0 = time.perf_counter()
+		fn(*args, **kwargs)
+		best = min(best, time.perf_counter() - t0)
+	return best
+
+
+def bench_scaling():
+	"""
+	Time per note should stay flat as tracks get longer for a linear renderer.
+	"""
+	print("notes\thstack (s)\tus/note\tprealloc (s)\tus/note")
+	for reps in [10, 40, 160, 640]:
+		notes = ",".join([NOTES]*reps)
+		n = len(notes.split(","))
+		t_new = bench(mcc_waves.notes_to_waveform, notes, 240)
+		# The quadratic renderer takes minutes past a couple thousand notes.
+		if reps <= 160:
+			t_old = bench(_old_notes_to_waveform, notes, 240, repeat=1)
+			print(f"{n}\t{t_old:.3f}\t\t{1e6*t_old/n:.1f}\t{t_new:.3f}\t\t{1e6*t_new/n:.1f}")
+		else:
+			print(f"{n}\t-\t\t-\t{t_new:.3f}\t\t{1e6*t_new/n:.1f}")
+
+	# Rests are silent now, where the original rendered them as the envelope of a flat wave.
+	notes = ",".join([n for n in NOTES.split(",") if "p" not in n]*10)
+	assert np.array_equal(_old_notes_to_waveform(notes, 240), mcc_waves.notes_to_waveform(notes, 240))
+
+
+def _load_tracks() -> list:
+	"""
+	RTTTL tracks and tempos of every bundled MIDI file.
+	"""
+	tracks = []
+	for song in sorted(os.listdir("./data")):
+		mid = mcc_parser.open_midi(f"./data/{song}")
+		info = mcc_parser.extract_midi_info(mid.tracks[0])
+		for track in mcc_parser.extract_midi_tracks(mid.tracks):
+			rtttl = mcc_parser.midi_to_rtttl(track, mid.ticks_per_beat)
+			if len(rtttl) > 0:
+				tracks.append((rtttl, info["tempo"][0]))
+	return tracks
+
+
+def bench_cache():
+	"""
+	Render the bundled songs with and without the shared note cache, 
+	then again from several threads sharing one cache.
+	"""
+	tracks = _load_tracks()
+	render = lambda cache: [mcc_waves.notes_to_waveform(t, bpm, wave_function=mcc_waves.triangle_wave, cache=cache) for t, bpm in tracks]
+
+	t_none = bench(render, None, repeat=1)
+	cache = mcc_waves.NoteCache()
+	t_cold = bench(render, cache, repeat=1)
+	t_warm = bench(render, cache, repeat=1)
+	print(f"no cache: {t_none:.2f}s  cold cache: {t_cold:.2f}s  warm cache: {t_warm:.2f}s")
+	print("stats:", cache.stats())
+
+	cache = mcc_waves.NoteCache(max_bytes=8*2**20)
+	with ThreadPoolExecutor(4) as pool:
+		t0 = time.perf_counter()
+		list(pool.map(lambda tb: mcc_waves.notes_to_waveform(tb[0], tb[1], wave_function=mcc_waves.triangle_wave, cache=cache), tracks))
+		print(f"4 threads, 8MB cache: {time.perf_counter()-t0:.2f}s  stats: {cache.stats()}")
+
+
+def bench_oscillator():
+	"""
+	Render the bundled songs note by note (no cache) and with one Oscillator per track.
+	"""
+	tracks = _load_tracks()
+	for wave, shape in [(mcc_waves.triangle_wave, mcc_waves.triangle_shape), (mcc_waves.square_wave, mcc_waves.square_shape), 
+			(mcc_waves.sawtooth_wave, mcc_waves.sawtooth_shape)]:
+		t_notes = bench(lambda: [mcc_waves.notes_to_waveform(t, bpm, wave_function=wave, cache=None) for t, bpm in tracks], repeat=1)
+		t_osc = bench(lambda: [mcc_waves.notes_to_waveform(t, bpm, wave_function=mcc_waves.Oscillator(shape)) for t, bpm in tracks], repeat=1)
+		print(f"{wave.__name__}: per note {t_notes:.2f}s  oscillator {t_osc:.2f}s  ({t_notes/t_osc:.1f}x)")
+
+
+def _aliasing(wave:np.array, freq:float, sr:int=44100) -> float:
+	"""
+	Fraction of a one second note's energy that lies away from its harmonics.
+	"""
+	spectrum = np.abs(np.fft.rfft(wave * np.hanning(len(wave))))**2
+	bins = np.arange(len(spectrum)) * sr / len(wave)
+	harmonic = np.abs(bins/freq - np.round(bins/freq)) * freq < 4
+	return spectrum[~harmonic].sum() / spectrum.sum()
+
+
+def bench_wavetable():
+	"""
+	Compare wavetables with the current wave functions: distance from the current 
+	output, energy lost to aliasing on a high note, and rendering time on the bundled songs.
+	"""
+	tracks = _load_tracks()
+	freqs = [mcc_waves._midi_to_freq(p) for p in range(24, 108)]
+	for wave in [mcc_waves.triangle_wave, mcc_waves.square_wave, mcc_waves.sawtooth_wave]:
+		table = mcc_waves.Wavetable(wave.__name__.replace("_wave", ""))
+		rms = [np.sqrt(np.mean((wave(f, 0.25) - table(f, 0.25))**2)) for f in freqs]
+		alias_old = _aliasing(wave(freqs[-6], 1.0), freqs[-6])
+		alias_new = _aliasing(table(freqs[-6], 1.0), freqs[-6])
+		t_old = bench(lambda: [mcc_waves.notes_to_waveform(t, bpm, wave_function=wave, cache=None) for t, bpm in tracks], repeat=1)
+		t_new = bench(lambda: [mcc_waves.notes_to_waveform(t, bpm, wave_function=table, cache=None) for t, bpm in tracks], repeat=1)
+		print(f"{wave.__name__}: rms diff mean {np.mean(rms):.4f} max {np.max(rms):.4f}  "
+			f"aliasing {alias_old:.2e} -> {alias_new:.2e}  time {t_old:.2f}s -> {t_new:.2f}s")
+
+
+def bench_timeline():
+	"""
+	Render each bundled song track by track from RTTTL-style notes and from its timelines. 
+	Drift is how far the end of a track rendered from notes is from where its last note 
+	really ends (the end of its timeline), at worst over the song's tracks.
+	"""
+	print("song\t\t\ttracks\tnotes drift (ms)\tnotes (s)\ttimeline (s)")
+	for song in sorted(os.listdir("./data")):
+		parsed = mcc_parser.parse_midi(f"./data/{song}")
+		bpm = parsed["info"]["tempo"][0]
+		t_notes = bench(lambda: [mcc_waves.notes_to_waveform(t, bpm, wave_function=mcc_waves.triangle_wave) for t in parsed["tracks"]], repeat=1)
+		t_timeline = bench(mcc_waves.timeline_to_waveform, parsed["timelines"], parsed["tempo_map"], 
+			wave_function=mcc_waves.triangle_wave, repeat=1)
+
+		ends = [len(mcc_waves.notes_to_waveform(t, bpm, wave_function=mcc_waves.triangle_wave)) for t in parsed["tracks"]]
+		true_ends = [int((start + n).max()) for start, n in (mcc_waves.timeline_offsets(t, parsed["tempo_map"]) for t in parsed["timelines"])]
+		drift = max(abs(a - b) for a, b in zip(ends, true_ends)) / 44.1
+		print(f"{song[:20]:<20}\t{len(ends)}\t{drift:.0f}\t\t\t{t_notes:.2f}\t\t{t_timeline:.2f}")
+
+def _per_note_envelopes(notes, bpm, wave_function):
+	"""
+	notes_to_waveform before envelope templates: a fresh adsr_envelope() and a product 
+	array for every note, rests included.
+	"""
+	parsed = mcc_waves.parse_notes(notes, bpm)
+	lengths = [mcc_waves._note_samples(duration, 44100) for duration, _ in parsed]
+	waveform = np.empty(sum(lengths))
+	offset = 0
+	for (duration, frequency), n in zip(parsed, lengths):
+		wave = wave_function(frequency, duration)
+		waveform[offset:offset+n] = wave[:n] * mcc_waves.adsr_envelope(duration)[:n]
+		offset += n
+	return waveform
+
+
+def bench_envelope():
+	"""
+	Render the bundled songs with an envelope made per note, and with cached envelope 
+	templates applied in place. Both render every note's wave (no note cache), so the 
+	difference is the envelope work. Then time just the envelopes of every note.
+	"""
+	tracks = _load_tracks()
+	wave = mcc_waves.Wavetable("triangle")
+	t_old = bench(lambda: [_per_note_envelopes(t, bpm, wave) for t, bpm in tracks], repeat=1)
+	t_new = bench(lambda: [mcc_waves.notes_to_waveform(t, bpm, wave_function=wave, cache=None) for t, bpm in tracks], repeat=1)
+	print(f"render: per-note envelopes {t_old:.2f}s  templates {t_new:.2f}s  ({t_old/t_new:.1f}x)")
+
+	notes = [(duration, mcc_waves._note_samples(duration)) for t, bpm in tracks for duration, _ in mcc_waves.parse_notes(t, bpm)]
+	out = np.ones(max(n for _, n in notes))
+	t_old = bench(lambda: [mcc_waves.adsr_envelope(d)[:n] * out[:n] for d, n in notes], repeat=1)
+	t_new = bench(lambda: [mcc_waves.DEFAULT_ENVELOPE.apply(out[:n], d) for d, n in notes], repeat=1)
+	print(f"{len(notes)} envelopes: adsr_envelope {t_old:.2f}s  Envelope.apply {t_new:.2f}s  ({t_old/t_new:.1f}x)")
+
+
+def bench_voices():
+	"""
+	Render each bundled song from its timelines note by note with one wave function, and 
+	batched per voice with timeline_to_voices(). Also check that a single pulse voice 
+	renders the same samples as square_wave note by note.
+	"""
+	print("song\t\t\tnotes\tdrums\tvoices\tper note (s)\tper voice (s)")
+	for song in sorted(os.listdir("./data")):
+		parsed = mcc_parser.parse_midi(f"./data/{song}")
+		timelines, tempo_map = parsed["timelines"], parsed["tempo_map"]
+		notes = sum(len(t) for t in timelines)
+		drums = sum(int((t["channel"] == mcc_waves.PERCUSSION_CHANNEL).sum()) for t in timelines)
+		voices = len(set(id(mcc_waves.voice_for(p, c)) for t in timelines for p, c in zip(t["program"].tolist(), t["channel"].tolist())))
+		t_note = bench(mcc_waves.timeline_to_waveform, timelines, tempo_map, cache=None, repeat=1)
+		t_voice = bench(mcc_waves.timeline_to_voices, timelines, tempo_map, seed=0, repeat=1)
+		print(f"{song[:20]:<20}\t{notes}\t{drums}\t{voices}\t{t_note:.2f}\t\t{t_voice:.2f}")
+
+	pulse = mcc_waves.Voice("pulse", 0.5)
+	by_voice = mcc_waves.timeline_to_voices(timelines, tempo_map, route=lambda program, channel: pulse)
+	by_note = mcc_waves.timeline_to_waveform(timelines, tempo_map, wave_function=mcc_waves.square_wave, cache=None)
+	assert np.allclose(by_voice, by_note)
+
+	# The bundled songs have long notes, so the work is mostly per sample. With many short 
+	# notes, the per-note overhead that batching removes matters more.
+	timeline = np.zeros(50000, dtype=mcc_parser.TIMELINE_DTYPE)
+	timeline["onset"] = np.arange(50000) * 2
+	timeline["length"] = 2
+	timeline["pitch"] = 60 + np.arange(50000) % 24
+	tempo_map = mcc_parser.TempoMap([], 96)
+	t_note = bench(mcc_waves.timeline_to_waveform, [timeline], tempo_map, wave_function=mcc_waves.square_wave, cache=None, repeat=1)
+	t_voice = bench(mcc_waves.timeline_to_voices, [timeline], tempo_map, route=lambda program, channel: pulse, repeat=1)
+	print(f"50000 notes of 1/48 beat: per note {t_note:.2f}s  per voice {t_voice:.2f}s")
+
+
+if __name__ == "__main__":
+	bench_scaling()
+	bench_cache()
+	bench_oscillator()
+	bench_wavetable()
+	bench_timeline()
+	bench_envelope()
+	bench_voices()